@@ -41,10 +41,14 @@ class SwagFormatter(logging.Formatter):
       except (ValueError, TypeError):
         record_dict['msg'] = [record.msg]+record.args
 
-    record_dict['ctx'] = self.swaglogger.get_ctx()
+    # ctx of the thread that logged it, when formatted on another one
+    ctx = getattr(record, 'swaglog_ctx', None)
+    record_dict['ctx'] = ctx if ctx is not None else self.swaglogger.get_ctx()
 
     if record.exc_info:
       record_dict['exc_info'] = self.formatException(record.exc_info)
+    elif record.exc_text:
+      record_dict['exc_info'] = record.exc_text
 
     record_dict['level'] = record.levelname
     record_dict['levelnum'] = record.levelno
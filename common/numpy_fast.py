@@ -1,3 +1,8 @@
+from bisect import bisect_left
+from math import isfinite
+
+import numpy as np
+
 def int_rnd(x):
   return int(round(x))
 
@@ -8,15 +13,70 @@ def interp(x, xp, fp):
   N = len(xp)
 
   def get_interp(xv):
-    hi = 0
-    while hi < N and xv > xp[hi]:
-      hi += 1
+    # first breakpoint not below xv
+    hi = bisect_left(xp, xv)
+    if hi == N:
+      return fp[-1]
+    if hi == 0:
+      return fp[0]
     low = hi - 1
-    return fp[-1] if hi == N and xv > xp[low] else (
-      fp[0] if hi == 0 else
-      (xv - xp[low]) * (fp[hi] - fp[low]) / (xp[hi] - xp[low]) + fp[low])
+    return (xv - xp[low]) * (fp[hi] - fp[low]) / (xp[hi] - xp[low]) + fp[low]
 
   return [get_interp(v) for v in x] if hasattr(x, '__iter__') else get_interp(x)
 
 def mean(x):
   return sum(x) / len(x)
+
+
+class InterpTable():
+  """interp() with the breakpoints checked and the differences taken once.
+     Scalars are looked up with a binary search and give the same result as
+     interp(), arrays are done in one go with numpy and return an array."""
+  def __init__(self, xp, fp):
+    if len(xp) != len(fp) or len(xp) == 0:
+      raise ValueError(f"breakpoints and values differ in length or are empty: {len(xp)}, {len(fp)}")
+    xp = tuple(xp)
+    if any(a > b for a, b in zip(xp, xp[1:])):
+      raise ValueError(f"breakpoints not sorted: {xp}")
+
+    self.xp = xp
+    self.fp = tuple(fp)
+    self.N = len(xp)
+    self.dxp = tuple(b - a for a, b in zip(xp, xp[1:]))
+    self.dfp = tuple(b - a for a, b in zip(self.fp, self.fp[1:]))
+
+    # row i is the segment for xp[i-1] < x <= xp[i] as (xp, dfp, dxp, fp), with a
+    # flat one on either end so the batch path needs no special cases for points
+    # outside the breakpoints
+    self.xp_arr = np.array(self.xp, dtype=np.float64)
+    self.segments = np.array([(self.xp[0], 0., 1., self.fp[0])] +
+                             list(zip(self.xp, self.dfp, self.dxp, self.fp)) +
+                             [(self.xp[-1], 0., 1., self.fp[-1])], dtype=np.float64)
+
+  def __call__(self, x):
+    if not hasattr(x, '__iter__'):
+      hi = bisect_left(self.xp, x)
+      if hi == self.N:
+        return self.fp[-1]
+      if hi == 0:
+        return self.fp[0]
+      low = hi - 1
+      return (x - self.xp[low]) * self.dfp[low] / self.dxp[low] + self.fp[low]
+    return self.batch(x)
+
+  def batch(self, x):
+    x = np.asarray(x, dtype=np.float64)
+    # the sum is a cheap check, it is only not finite if some x isn't or it overflows
+    if isfinite(x.sum()):
+      return self._batch(x)
+
+    with np.errstate(invalid='ignore'):
+      y = self._batch(x)
+    # interp() puts nan below the first breakpoint, searchsorted above the last
+    y[np.isnan(x) | (x == -np.inf)] = self.fp[0]
+    y[x == np.inf] = self.fp[-1]
+    return y
+
+  def _batch(self, x):
+    seg = self.segments.take(np.searchsorted(self.xp_arr, x, side='left'), axis=0)
+    return (x - seg[..., 0]) * seg[..., 1] / seg[..., 2] + seg[..., 3]
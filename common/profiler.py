@@ -1,45 +1,181 @@
 import time
 
+# checkpoint slots are preallocated, names past this are only counted in the iteration total
+MAX_CHECKPOINTS = 32
+
+# log-linear latency buckets in us, 4 per power of two: exact below 8us, within 25% above
+SUB_BUCKET_BITS = 2
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+NUM_BUCKETS = 80  # the last bucket holds everything above ~1s
+
+
+def bucket_index(us):
+  if us < 2 * SUB_BUCKETS:
+    return us
+  shift = us.bit_length() - SUB_BUCKET_BITS - 1
+  return min(shift * SUB_BUCKETS + (us >> shift), NUM_BUCKETS - 1)
+
+
+def bucket_upper_us(idx):
+  if idx < 2 * SUB_BUCKETS:
+    return idx + 1
+  shift = idx // SUB_BUCKETS - 1
+  return (idx % SUB_BUCKETS + SUB_BUCKETS + 1) << shift
+
+
+class Histogram():
+  """Fixed bucket latency histogram, recording is allocation free."""
+  def __init__(self):
+    self.buckets = [0] * NUM_BUCKETS
+    self.reset()
+
+  def reset(self):
+    for i in range(NUM_BUCKETS):
+      self.buckets[i] = 0
+    self.count = 0
+    self.total_ns = 0
+    self.max_ns = 0
+
+  def add(self, dt_ns):
+    self.buckets[bucket_index(dt_ns // 1000)] += 1
+    self.count += 1
+    self.total_ns += dt_ns
+    if dt_ns > self.max_ns:
+      self.max_ns = dt_ns
+
+  def percentile_ms(self, p):
+    # upper bound of the bucket holding the percentile, capped at the max seen
+    if self.count == 0:
+      return 0.
+    target = p / 100. * self.count
+    seen = 0
+    for idx, n in enumerate(self.buckets):
+      seen += n
+      if n and seen >= target:
+        return min(bucket_upper_us(idx) * 1e-3, self.max_ns * 1e-6)
+    return self.max_ns * 1e-6
+
+  def stats(self):
+    return {
+      "count": self.count,
+      "meanMs": self.total_ns * 1e-6 / self.count if self.count else 0.,
+      "p50Ms": self.percentile_ms(50),
+      "p99Ms": self.percentile_ms(99),
+      "maxMs": self.max_ns * 1e-6,
+    }
+
+
 class Profiler():
-  def __init__(self, enabled=False):
-    self.enabled = enabled
-    self.cp = {}
-    self.cp_ignored = []
-    self.iter = 0
-    self.start_time = time.time()
-    self.last_time = self.start_time
-    self.tot = 0.
+  """Time between checkpoints of a loop, cheap enough to stay enabled.
+
+     Every checkpoint name gets a slot with a latency histogram, and the
+     non-ignored time of an iteration goes into the iteration histogram.
+     end_iteration() closes an iteration and returns True once per interval,
+     when summary() should be sent."""
+  def __init__(self, enabled=False, name="", budget=None, interval=1.):
+    self.name = name
+    self.budget_ns = int(budget * 1e9) if budget is not None else None
+    self.interval_ns = int(interval * 1e9)
+
+    self.slots = {}
+    self.names = [""] * MAX_CHECKPOINTS
+    self.ignored = [False] * MAX_CHECKPOINTS
+    self.hists = [Histogram() for _ in range(MAX_CHECKPOINTS)]
+    # overruns in which the slot was the slowest stage
+    self.worst = [0] * MAX_CHECKPOINTS
+    self.iter_hist = Histogram()
+    self.reset(enabled)
 
   def reset(self, enabled=False):
     self.enabled = enabled
-    self.cp = {}
-    self.cp_ignored = []
+    self.slots.clear()
+    for hist in self.hists:
+      hist.reset()
+    self.iter_hist.reset()
+    self._reset_window()
     self.iter = 0
-    self.start_time = time.time()
-    self.last_time = self.start_time
+    self.last_time = time.monotonic_ns()
+    self.iter_ns = 0
+    self.iter_worst_slot = -1
+    self.iter_worst_ns = 0
+
+  def _reset_window(self):
+    for i in range(MAX_CHECKPOINTS):
+      self.worst[i] = 0
+    self.overruns = 0
+    self.window_start = time.monotonic_ns()
 
   def checkpoint(self, name, ignore=False):
     # ignore flag needed when benchmarking threads with ratekeeper
     if not self.enabled:
       return
-    tt = time.time()
-    if name not in self.cp:
-      self.cp[name] = 0.
-      if ignore:
-        self.cp_ignored.append(name)
-    self.cp[name] += tt - self.last_time
-    if not ignore:
-      self.tot += tt - self.last_time
+    tt = time.monotonic_ns()
+    dt = tt - self.last_time
     self.last_time = tt
 
+    slot = self.slots.get(name)
+    if slot is None and len(self.slots) < MAX_CHECKPOINTS:
+      slot = self.slots[name] = len(self.slots)
+      self.names[slot] = name
+      self.ignored[slot] = ignore
+
+    if slot is not None:
+      self.hists[slot].add(dt)
+    if not ignore:
+      self.iter_ns += dt
+      if dt > self.iter_worst_ns:
+        self.iter_worst_ns = dt
+        self.iter_worst_slot = -1 if slot is None else slot
+
+  def end_iteration(self):
+    if not self.enabled:
+      return False
+    self.iter += 1
+    self.iter_hist.add(self.iter_ns)
+    if self.budget_ns is not None and self.iter_ns > self.budget_ns:
+      self.overruns += 1
+      if self.iter_worst_slot >= 0:
+        self.worst[self.iter_worst_slot] += 1
+    self.iter_ns = 0
+    self.iter_worst_slot = -1
+    self.iter_worst_ns = 0
+    return self.last_time - self.window_start >= self.interval_ns
+
+  def stats(self):
+    """Stats since the previous summary, as a profilerSummary message dict."""
+    return {
+      "name": self.name,
+      "budgetMs": self.budget_ns * 1e-6 if self.budget_ns is not None else 0.,
+      "overruns": self.overruns,
+      "iterations": self.iter_hist.stats(),
+      "checkpoints": [{
+        "name": self.names[slot],
+        "ignored": self.ignored[slot],
+        "worstInOverruns": self.worst[slot],
+        "stats": self.hists[slot].stats(),
+      } for slot in range(len(self.slots))],
+    }
+
+  def summary(self):
+    """stats(), then starts a new window"""
+    ret = self.stats()
+    for hist in self.hists:
+      hist.reset()
+    self.iter_hist.reset()
+    self._reset_window()
+    return ret
+
   def display(self):
+    # closes the iteration and prints the stats of the window so far, every call
     if not self.enabled:
       return
-    self.iter += 1
-    print("******* Profiling %d *******" % self.iter)
-    for n, ms in sorted(self.cp.items(), key=lambda x: -x[1]):
-      if n in self.cp_ignored:
-        print("%30s: %9.2f  avg: %7.2f  percent: %3.0f   IGNORED" % (n, ms*1000.0, ms*1000.0/self.iter, ms/self.tot*100))
-      else:
-        print("%30s: %9.2f  avg: %7.2f  percent: %3.0f" % (n, ms*1000.0, ms*1000.0/self.iter, ms/self.tot*100))
-    print("Iter clock: %2.6f   TOTAL: %2.2f" % (self.tot/self.iter, self.tot))
+    self.end_iteration()
+    s = self.stats()
+    print("******* Profiling %s %d *******" % (self.name, self.iter))
+    for cp in sorted(s["checkpoints"], key=lambda c: -c["stats"]["meanMs"]):
+      st = cp["stats"]
+      print("%30s: avg: %7.3f  p50: %7.3f  p99: %7.3f  max: %7.3f%s" % (cp["name"], st["meanMs"], st["p50Ms"], st["p99Ms"],
+                                                                          st["maxMs"], "   IGNORED" if cp["ignored"] else ""))
+    st = s["iterations"]
+    print("Iter clock: avg: %7.3f  p50: %7.3f  p99: %7.3f  max: %7.3f  overruns: %d" % (st["meanMs"], st["p50Ms"], st["p99Ms"],
+                                                                                          st["maxMs"], s["overruns"]))
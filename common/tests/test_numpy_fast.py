@@ -0,0 +1,78 @@
+import random
+import timeit
+import unittest
+
+import numpy as np
+
+from common.numpy_fast import interp, InterpTable
+
+
+def interp_old(x, xp, fp):
+  N = len(xp)
+
+  def get_interp(xv):
+    hi = 0
+    while hi < N and xv > xp[hi]:
+      hi += 1
+    low = hi - 1
+    return fp[-1] if hi == N and xv > xp[low] else (
+      fp[0] if hi == 0 else
+      (xv - xp[low]) * (fp[hi] - fp[low]) / (xp[hi] - xp[low]) + fp[low])
+
+  return [get_interp(v) for v in x] if hasattr(x, '__iter__') else get_interp(x)
+
+
+TABLES = [
+  ([0.], [1.]),
+  ([0., 5., 10., 20.], [1.2, 0.8, 0.65, 0.4]),
+  ([-1., 0., 0., 1.], [3., 2., 1., 0.]),  # duplicate breakpoint
+  ([4., 6., 8., 11., 14., 20., 30., 40.], [0.4, 0.38, 0.35, 0.3, 0.25, 0.2, 0.15, 0.1]),
+]
+
+
+class TestInterp(unittest.TestCase):
+  def check(self, x, xp, fp):
+    expected = interp_old(x, xp, fp)
+    self.assertEqual(interp(x, xp, fp), expected)
+    table = InterpTable(xp, fp)
+    if hasattr(x, '__iter__'):
+      np.testing.assert_array_equal(table(x), expected)
+    else:
+      self.assertEqual(table(x), expected)
+
+  def test_old_equal_new(self):
+    for xp, fp in TABLES:
+      points = list(xp) + [xp[0] - 1., xp[-1] + 1.] + [random.uniform(xp[0] - 5., xp[-1] + 5.) for _ in range(1000)]
+      for x in points:
+        self.check(x, xp, fp)
+      self.check(points, xp, fp)
+
+  def test_not_finite(self):
+    for xp, fp in TABLES:
+      self.assertEqual(InterpTable(xp, fp)(float('nan')), fp[0])
+      self.check([float('nan'), float('inf'), float('-inf'), xp[-1]], xp, fp)
+
+  def test_invalid(self):
+    with self.assertRaises(ValueError):
+      InterpTable([0., 1.], [0.])
+    with self.assertRaises(ValueError):
+      InterpTable([], [])
+    with self.assertRaises(ValueError):
+      InterpTable([1., 0.], [0., 1.])
+
+  def test_new_is_faster(self):
+    setup = """
+from common.numpy_fast import InterpTable
+from common.tests.test_numpy_fast import interp_old
+xp = [4., 6., 8., 11., 14., 20., 30., 40.]
+fp = [0.4, 0.38, 0.35, 0.3, 0.25, 0.2, 0.15, 0.1]
+table = InterpTable(xp, fp)
+"""
+    n = 10000
+    time_old = min(timeit.repeat("interp_old(35., xp, fp)", setup=setup, number=n, repeat=3))
+    time_new = min(timeit.repeat("table(35.)", setup=setup, number=n, repeat=3))
+    self.assertLess(time_new, time_old)
+
+
+if __name__ == "__main__":
+  unittest.main()
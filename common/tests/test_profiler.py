@@ -0,0 +1,57 @@
+import unittest
+from unittest import mock
+
+from common import profiler
+from common.profiler import Profiler
+
+
+class FakeClock():
+  def __init__(self):
+    self.ns = 0
+
+  def __call__(self):
+    return self.ns
+
+  def advance(self, ms):
+    self.ns += int(ms * 1e6)
+
+
+class TestProfiler(unittest.TestCase):
+  def setUp(self):
+    self.clock = FakeClock()
+    patcher = mock.patch.object(profiler.time, "monotonic_ns", self.clock)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def step(self, prof, wait_ms, work_ms):
+    self.clock.advance(wait_ms)
+    prof.checkpoint("Wait", ignore=True)
+    self.clock.advance(work_ms)
+    prof.checkpoint("Work")
+    return prof.end_iteration()
+
+  def test_ignored_not_in_budget(self):
+    prof = Profiler(True, "test", budget=0.01, interval=1.)
+    for _ in range(10):
+      self.step(prof, 9.5, 1.)
+    self.step(prof, 1., 11.)
+    s = prof.summary()
+
+    self.assertEqual(s["overruns"], 1)
+    self.assertEqual(s["iterations"]["count"], 11)
+    self.assertAlmostEqual(s["iterations"]["maxMs"], 11.)
+    cps = {cp["name"]: cp for cp in s["checkpoints"]}
+    self.assertTrue(cps["Wait"]["ignored"])
+    self.assertEqual(cps["Wait"]["worstInOverruns"], 0)
+    self.assertEqual(cps["Work"]["worstInOverruns"], 1)
+
+  def test_interval(self):
+    prof = Profiler(True, "test", budget=0.01, interval=1.)
+    due = [self.step(prof, 9., 1.) for _ in range(150)]
+    self.assertEqual(due.index(True), 99)
+    prof.summary()
+    self.assertEqual(prof.stats()["iterations"]["count"], 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import base64
+import bisect
 import hashlib
 import io
 import json
@@ -11,9 +12,10 @@ import select
 import socket
 import threading
 import time
-from collections import namedtuple
+import zlib
+from collections import OrderedDict, namedtuple
 from functools import partial
-from typing import Any
+from typing import Any, Dict, List, Set, Tuple
 
 import requests
 from jsonrpc import JSONRPCResponseManager, dispatcher
@@ -26,8 +28,9 @@ from common.basedir import PERSIST
 from common.params import Params
 from common.realtime import sec_since_boot
 from selfdrive.hardware import HARDWARE, PC, TICI
-from selfdrive.loggerd.config import ROOT
-from selfdrive.loggerd.xattr_cache import getxattr, setxattr
+from selfdrive.loggerd.config import ATHENA_UPLOAD_PROGRESS, ROOT
+from selfdrive.loggerd.upload_engine import UPLOAD_WORKERS, UploadEngine
+from selfdrive.loggerd.xattr_cache import getxattr, invalidate, setxattr
 from selfdrive.swaglog import cloudlog, SWAGLOG_DIR
 from selfdrive.version import version, get_version, get_git_remote, get_git_branch, get_git_commit
 
@@ -36,7 +39,16 @@ HANDLER_THREADS = int(os.getenv('HANDLER_THREADS', "4"))
 LOCAL_PORT_WHITELIST = set([8022])
 
 LOG_ATTR_NAME = 'user.upload'
-LOG_ATTR_VALUE_MAX_UNIX_TIME = int.to_bytes(2147483647, 4, sys.byteorder)
+LOG_ATTR_MAX_UNIX_TIME = 2147483647
+LOG_ATTR_VALUE_MAX_UNIX_TIME = int.to_bytes(LOG_ATTR_MAX_UNIX_TIME, 4, sys.byteorder)
+LOG_WINDOW = 4  # forwardLogs requests waiting for a response
+LOG_BATCH_BYTES = 256 * 1024  # small logs are concatenated into one request up to this size
+LOG_RESPONSE_TIMEOUT = 100  # seconds
+LOG_RESCAN_INTERVAL = 10  # seconds
+LOG_RETRY_INTERVAL = 3600  # assume send failed and we lost the response if sent more than one hour ago
+LOG_MAX_EXPIRED = 100  # timed out requests whose files are still marked when a late response comes
+# zlib and base64 the logs, needs a server that knows the compression param
+LOG_COMPRESSION = os.getenv("ATHENA_LOG_COMPRESSION") is not None
 RECONNECT_TIMEOUT_S = 70
 
 RETRY_DELAY = 10  # seconds
@@ -49,7 +61,8 @@ upload_queue: Any = queue.Queue()
 log_send_queue: Any = queue.Queue()
 log_recv_queue: Any = queue.Queue()
 cancelled_uploads: Any = set()
-UploadItem = namedtuple('UploadItem', ['path', 'url', 'headers', 'created_at', 'id', 'retry_count'], defaults=(0,))
+UploadItem = namedtuple('UploadItem', ['path', 'url', 'headers', 'created_at', 'id', 'retry_count', 'resumable'], defaults=(0, False))
+upload_engine = UploadEngine(progress_path=ATHENA_UPLOAD_PROGRESS)
 
 
 def handle_long_poll(ws):
@@ -58,8 +71,10 @@ def handle_long_poll(ws):
   threads = [
     threading.Thread(target=ws_recv, args=(ws, end_event), name='ws_recv'),
     threading.Thread(target=ws_send, args=(ws, end_event), name='ws_send'),
-    threading.Thread(target=upload_handler, args=(end_event,), name='upload_handler'),
     threading.Thread(target=log_handler, args=(end_event,), name='log_handler'),
+  ] + [
+    threading.Thread(target=upload_handler, args=(end_event,), name=f'upload_handler_{x}')
+    for x in range(UPLOAD_WORKERS)
   ] + [
     threading.Thread(target=jsonrpc_handler, args=(end_event,), name=f'worker_{x}')
     for x in range(HANDLER_THREADS)
@@ -99,6 +114,32 @@ def jsonrpc_handler(end_event):
       send_queue.put_nowait(json.dumps({"error": str(e)}))
 
 
+class UploadNetwork():
+  """Follows deviceState.networkType for the upload engine's bandwidth budget.
+     One subscriber is shared by all upload handlers, it's only read when an
+     upload is about to start."""
+  def __init__(self, engine):
+    self.engine = engine
+    self.sm = None
+    self.network_type = None
+    self.lock = threading.Lock()
+
+  def update(self):
+    with self.lock:
+      if self.sm is None:
+        self.sm = messaging.SubMaster(['deviceState'])
+      self.sm.update(0)
+      if self.sm.rcv_time['deviceState'] == 0:
+        return  # nothing received yet, keep the engine's budget
+      network_type = self.sm['deviceState'].networkType
+      if network_type != self.network_type:
+        self.engine.set_network_type(network_type)
+        self.network_type = network_type
+
+
+upload_network = UploadNetwork(upload_engine)
+
+
 def upload_handler(end_event):
   while not end_event.is_set():
     try:
@@ -107,6 +148,8 @@ def upload_handler(end_event):
         cancelled_uploads.remove(item.id)
         continue
 
+      upload_network.update()
+
       try:
         _do_upload(item)
       except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.SSLError) as e:
@@ -127,12 +170,7 @@ def upload_handler(end_event):
 
 
 def _do_upload(upload_item):
-  with open(upload_item.path, "rb") as f:
-    size = os.fstat(f.fileno()).st_size
-    return requests.put(upload_item.url,
-                        data=f,
-                        headers={**upload_item.headers, 'Content-Length': str(size)},
-                        timeout=30)
+  return upload_engine.upload(upload_item.path, upload_item.url, upload_item.headers, resumable=upload_item.resumable)
 
 
 # security: user should be able to request any message from their car
@@ -194,14 +232,14 @@ def reboot():
 
 
 @dispatcher.add_method
-def uploadFileToUrl(fn, url, headers):
+def uploadFileToUrl(fn, url, headers, resumable=False):
   if len(fn) == 0 or fn[0] == '/' or '..' in fn:
     return 500
   path = os.path.join(ROOT, fn)
   if not os.path.exists(path):
     return 404
 
-  item = UploadItem(path=path, url=url, headers=headers, created_at=int(time.time() * 1000), id=None)
+  item = UploadItem(path=path, url=url, headers=headers, created_at=int(time.time() * 1000), id=None, resumable=resumable)
   upload_id = hashlib.sha1(str(item).encode()).hexdigest()
   item = item._replace(id=upload_id)
 
@@ -314,83 +352,179 @@ def takeSnapshot():
     raise Exception("not available while camerad is started")
 
 
-def get_logs_to_send_sorted():
-  # TODO: scan once then use inotify to detect file creation/deletion
-  curr_time = int(time.time())
+class SwaglogIndex():
+  """Swaglogs waiting to be forwarded, newest last. A rescan only lists the
+  directory, the sent time of a file is read once when it shows up."""
+  def __init__(self, path):
+    self.path = path
+    self.known: Set[str] = set()
+    self.pending: List[str] = []
+    # entry -> unix time it's sent again, unless a response comes first
+    self.retry: Dict[str, int] = {}
+
+  def rescan(self, curr_time):
+    entries = set(os.listdir(self.path))
+    # excluding most recent (active) log file
+    entries.discard(max(entries, default=None))
+
+    removed = self.known - entries
+    for entry in removed:
+      invalidate(os.path.join(self.path, entry))
+      self.retry.pop(entry, None)
+    if removed:
+      self.pending = [e for e in self.pending if e in entries]
+
+    for entry in entries - self.known:
+      try:
+        time_sent = int.from_bytes(getxattr(os.path.join(self.path, entry), LOG_ATTR_NAME), sys.byteorder)
+      except (ValueError, TypeError):
+        time_sent = 0
+      except OSError:
+        continue  # file could be deleted by log rotation
+      if time_sent != LOG_ATTR_MAX_UNIX_TIME:
+        self.retry[entry] = time_sent + LOG_RETRY_INTERVAL
+    self.known = entries
+
+    for entry, retry_time in list(self.retry.items()):
+      if retry_time < curr_time:
+        del self.retry[entry]
+        bisect.insort(self.pending, entry)
+
+  def pop_batch(self, max_bytes):
+    """Takes the newest pending files, up to max_bytes unless a single file is larger"""
+    batch: List[str] = []
+    size = 0
+    while len(self.pending):
+      try:
+        sz = os.path.getsize(os.path.join(self.path, self.pending[-1]))
+      except OSError:
+        self.pending.pop()
+        continue
+      if len(batch) and size + sz > max_bytes:
+        break
+      batch.append(self.pending.pop())
+      size += sz
+    return sorted(batch)
+
+  def sent(self, entries, curr_time):
+    for entry in entries:
+      self.retry[entry] = curr_time + LOG_RETRY_INTERVAL
+
+  def done(self, entries):
+    for entry in entries:
+      self.retry.pop(entry, None)
+
+  def requeue(self, entries):
+    for entry in entries:
+      if self.retry.pop(entry, None) is not None and entry in self.known:
+        bisect.insort(self.pending, entry)
+
+
+swaglog_index = SwaglogIndex(SWAGLOG_DIR)
+
+
+def get_logs_request(entries, curr_time):
+  """Marks the files as sent and returns the forwardLogs request of those still there"""
   logs = []
-  for log_entry in os.listdir(SWAGLOG_DIR):
+  sent = []
+  for log_entry in entries:
     log_path = os.path.join(SWAGLOG_DIR, log_entry)
     try:
-      time_sent = int.from_bytes(getxattr(log_path, LOG_ATTR_NAME), sys.byteorder)
-    except (ValueError, TypeError):
-      time_sent = 0
-    # assume send failed and we lost the response if sent more than one hour ago
-    if not time_sent or curr_time - time_sent > 3600:
-      logs.append(log_entry)
-  # excluding most recent (active) log file
-  return sorted(logs)[:-1]
+      setxattr(log_path, LOG_ATTR_NAME, int.to_bytes(curr_time, 4, sys.byteorder))
+      with open(log_path, "r") as f:
+        dat = f.read()
+    except OSError:
+      continue  # file could be deleted by log rotation
+    if len(logs) and not logs[-1].endswith("\n"):
+      logs.append("\n")
+    logs.append(dat)
+    sent.append(log_entry)
+
+  if not len(sent):
+    return [], None
+
+  params = {"logs": "".join(logs)}
+  if LOG_COMPRESSION:
+    params = {"logs": base64.b64encode(zlib.compress(params["logs"].encode())).decode(), "compression": "zlib"}
+
+  # a batch goes by the name of its newest file
+  return sent, {
+    "method": "forwardLogs",
+    "params": params,
+    "jsonrpc": "2.0",
+    "id": sent[-1],
+  }
 
 
 def log_handler(end_event):
   if PC:
     return
 
-  log_files = []
-  last_scan = 0
-  while not end_event.is_set():
-    try:
-      curr_scan = sec_since_boot()
-      if curr_scan - last_scan > 10:
-        log_files = get_logs_to_send_sorted()
-        last_scan = curr_scan
-
-      # send one log
-      curr_log = None
-      if len(log_files) > 0:
-        log_entry = log_files.pop() # newest log file
-        cloudlog.debug(f"athena.log_handler.forward_request {log_entry}")
-        try:
+  # log id -> (files, time sent) of requests waiting for a response
+  outstanding: Dict[str, Tuple[List[str], float]] = {}
+  expired: Dict[str, List[str]] = OrderedDict()
+  last_scan = 0.
+  try:
+    while not end_event.is_set():
+      try:
+        curr_scan = sec_since_boot()
+        if curr_scan - last_scan > LOG_RESCAN_INTERVAL:
+          swaglog_index.rescan(int(time.time()))
+          last_scan = curr_scan
+
+        # keep the window of requests full, newest logs first
+        while len(outstanding) < LOG_WINDOW:
+          entries = swaglog_index.pop_batch(LOG_BATCH_BYTES)
+          if not len(entries):
+            break
           curr_time = int(time.time())
-          log_path = os.path.join(SWAGLOG_DIR, log_entry)
-          setxattr(log_path, LOG_ATTR_NAME, int.to_bytes(curr_time, 4, sys.byteorder))
-          with open(log_path, "r") as f:
-            jsonrpc = {
-              "method": "forwardLogs",
-              "params": {
-                "logs": f.read()
-              },
-              "jsonrpc": "2.0",
-              "id": log_entry
-            }
-            log_send_queue.put_nowait(json.dumps(jsonrpc))
-            curr_log = log_entry
-        except OSError:
-          pass  # file could be deleted by log rotation
+          sent, jsonrpc = get_logs_request(entries, curr_time)
+          if jsonrpc is None:
+            continue
+          cloudlog.debug(f"athena.log_handler.forward_request {jsonrpc['id']} ({len(sent)} files)")
+          swaglog_index.sent(sent, curr_time)
+          outstanding[jsonrpc["id"]] = (sent, sec_since_boot())
+          log_send_queue.put_nowait(json.dumps(jsonrpc))
 
-      # wait for response up to ~100 seconds
-      # always read queue at least once to process any old responses that arrive
-      for _ in range(100):
-        if end_event.is_set():
-          break
         try:
           log_resp = json.loads(log_recv_queue.get(timeout=1))
           log_entry = log_resp.get("id")
           log_success = "result" in log_resp and log_resp["result"].get("success")
           cloudlog.debug(f"athena.log_handler.forward_response {log_entry} {log_success}")
-          if log_entry and log_success:
-            log_path = os.path.join(SWAGLOG_DIR, log_entry)
-            try:
-              setxattr(log_path, LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
-            except OSError:
-              pass  # file could be deleted by log rotation
-          if curr_log == log_entry:
-            break
+          if log_entry:
+            if log_entry in outstanding:
+              entries = outstanding.pop(log_entry)[0]
+            else:
+              entries = expired.pop(log_entry, [log_entry])
+            if log_success:
+              for e in entries:
+                try:
+                  setxattr(os.path.join(SWAGLOG_DIR, e), LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
+                except OSError:
+                  pass  # file could be deleted by log rotation
+              swaglog_index.done(entries)
         except queue.Empty:
-          if curr_log is None:
-            break
+          pass
 
-    except Exception:
-      cloudlog.exception("athena.log_handler.exception")
+        # no response, the files are sent again after LOG_RETRY_INTERVAL
+        for log_entry, (entries, t) in list(outstanding.items()):
+          if sec_since_boot() - t > LOG_RESPONSE_TIMEOUT:
+            del outstanding[log_entry]
+            expired[log_entry] = entries
+            if len(expired) > LOG_MAX_EXPIRED:
+              expired.popitem(last=False)
+
+      except Exception:
+        cloudlog.exception("athena.log_handler.exception")
+  finally:
+    # the connection is gone, send what's in flight again on the next one
+    for entries, _ in outstanding.values():
+      for e in entries:
+        try:
+          setxattr(os.path.join(SWAGLOG_DIR, e), LOG_ATTR_NAME, int.to_bytes(0, 4, sys.byteorder))
+        except OSError:
+          pass
+      swaglog_index.requeue(entries)
 
 
 def ws_proxy_recv(ws, local_sock, ssock, end_event, global_end_event):
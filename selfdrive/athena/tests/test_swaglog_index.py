@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from selfdrive.athena import athenad
+from selfdrive.loggerd.xattr_cache import setxattr
+
+
+class TestSwaglogIndex(unittest.TestCase):
+  def setUp(self):
+    self.log_dir = tempfile.mkdtemp()
+    self.orig_dir = athenad.SWAGLOG_DIR
+    athenad.SWAGLOG_DIR = self.log_dir
+
+  def tearDown(self):
+    athenad.SWAGLOG_DIR = self.orig_dir
+    shutil.rmtree(self.log_dir)
+
+  def write_log(self, idx, size=100):
+    with open(os.path.join(self.log_dir, f"swaglog.{idx:010}"), "w") as f:
+      f.write(json.dumps({"msg": "x" * size}) + "\n")
+
+  def test_pending(self):
+    for i in range(5):
+      self.write_log(i)
+    setxattr(os.path.join(self.log_dir, "swaglog.0000000001"), athenad.LOG_ATTR_NAME, athenad.LOG_ATTR_VALUE_MAX_UNIX_TIME)
+    setxattr(os.path.join(self.log_dir, "swaglog.0000000002"), athenad.LOG_ATTR_NAME, int.to_bytes(1000, 4, sys.byteorder))
+
+    index = athenad.SwaglogIndex(self.log_dir)
+    index.rescan(4000)
+    # sent ones are skipped until their response is overdue, the active log is never sent
+    self.assertEqual(index.pending, ["swaglog.0000000000", "swaglog.0000000003"])
+    index.rescan(5000)
+    self.assertEqual(index.pending, ["swaglog.0000000000", "swaglog.0000000002", "swaglog.0000000003"])
+
+    # a new log releases the previous active one
+    self.write_log(5)
+    os.unlink(os.path.join(self.log_dir, "swaglog.0000000000"))
+    index.rescan(5000)
+    self.assertEqual(index.pending, ["swaglog.0000000002", "swaglog.0000000003", "swaglog.0000000004"])
+
+  def test_batch(self):
+    for i in range(10):
+      self.write_log(i, size=1000 if i < 8 else 100000)
+    index = athenad.SwaglogIndex(self.log_dir)
+    index.rescan(5000)
+
+    # big logs go alone, newest first
+    self.assertEqual(index.pop_batch(50000), ["swaglog.0000000008"])
+    batch = index.pop_batch(50000)
+    self.assertEqual(batch, [f"swaglog.{i:010}" for i in range(8)])
+
+    sent, jsonrpc = athenad.get_logs_request(batch, 6000)
+    self.assertEqual(sent, batch)
+    self.assertEqual(jsonrpc["id"], batch[-1])
+    self.assertEqual(len(jsonrpc["params"]["logs"].splitlines()), 8)
+
+    # in flight until a response or the connection drops
+    index.sent(sent, 6000)
+    index.rescan(7000)
+    self.assertEqual(index.pending, [])
+    index.requeue(sent)
+    self.assertEqual(index.pending, batch)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,9 +1,9 @@
 import os
 from common.params import Params
 from common.basedir import BASEDIR
-from selfdrive.car.fingerprints import eliminate_incompatible_cars, all_legacy_fingerprint_cars
-from selfdrive.car.vin import get_vin, VIN_UNKNOWN
-from selfdrive.car.fw_versions import get_fw_versions, match_fw_to_car
+from selfdrive.car.fingerprints import get_fingerprint_index, all_legacy_fingerprint_cars
+from selfdrive.car.vin import VIN_UNKNOWN
+from selfdrive.car.fw_versions import get_vin_and_fw_versions, match_fw_to_car
 from selfdrive.swaglog import cloudlog
 import cereal.messaging as messaging
 from selfdrive.car import gen_empty_fingerprint
@@ -78,8 +78,12 @@ interface_names = _get_interface_names()
 interfaces = load_interfaces(interface_names)
 
 
+TOYOTA_CARS = get_fingerprint_index().mask(c for c in all_legacy_fingerprint_cars() if "TOYOTA" in c or "LEXUS" in c)
+
+
 def only_toyota_left(candidate_cars):
-  return all(("TOYOTA" in c or "LEXUS" in c) for c in candidate_cars) and len(candidate_cars) > 0
+  # candidate_cars is a bitset of the fingerprint index
+  return candidate_cars != 0 and candidate_cars & ~TOYOTA_CARS == 0
 
 
 # **** for use live only ****
@@ -103,8 +107,8 @@ def fingerprint(logcan, sendcan, has_relay):
       car_fw = list(cached_params.carFw)
     else:
       cloudlog.warning("Getting VIN & FW versions")
-      _, vin = get_vin(logcan, sendcan, bus)
-      car_fw = get_fw_versions(logcan, sendcan, bus)
+      vin, car_fw, timing = get_vin_and_fw_versions(logcan, sendcan, bus)
+      cloudlog.event("fw query done", **timing)
 
     exact_fw_match, fw_candidates = match_fw_to_car(car_fw)
   else:
@@ -115,7 +119,8 @@ def fingerprint(logcan, sendcan, has_relay):
   Params().put("CarVin", vin)
 
   finger = gen_empty_fingerprint()
-  candidate_cars = {i: all_legacy_fingerprint_cars() for i in [0, 1]}  # attempt fingerprint on both bus 0 and 1
+  index = get_fingerprint_index()
+  candidate_cars = {i: index.all for i in [0, 1]}  # attempt fingerprint on both bus 0 and 1
   frame = 0
   frame_fingerprint = 10  # 0.1s
   car_fingerprint = None
@@ -135,7 +140,7 @@ def fingerprint(logcan, sendcan, has_relay):
       for b in candidate_cars:
         if (can.src == b or (only_toyota_left(candidate_cars[b]) and can.src == 2)) and \
            can.address < 0x800 and can.address not in [0x7df, 0x7e0, 0x7e8]:
-          candidate_cars[b] = eliminate_incompatible_cars(can, candidate_cars[b])
+          candidate_cars[b] = index.eliminate(can, candidate_cars[b])
 
     # if we only have one car choice and the time since we got our first
     # message has elapsed, exit
@@ -143,12 +148,14 @@ def fingerprint(logcan, sendcan, has_relay):
       # Toyota needs higher time to fingerprint, since DSU does not broadcast immediately
       if only_toyota_left(candidate_cars[b]):
         frame_fingerprint = 100  # 1s
-      if len(candidate_cars[b]) == 1 and frame > frame_fingerprint:
+      # exactly one car left
+      one_left = candidate_cars[b] != 0 and candidate_cars[b] & (candidate_cars[b] - 1) == 0
+      if one_left and frame > frame_fingerprint:
           # fingerprint done
-          car_fingerprint = candidate_cars[b][0]
+          car_fingerprint = index.to_list(candidate_cars[b])[0]
 
     # bail if no cars left or we've been waiting for more than 2s
-    failed = (all(len(cc) == 0 for cc in candidate_cars.values()) and frame > frame_fingerprint) or frame > 200
+    failed = (all(cc == 0 for cc in candidate_cars.values()) and frame > frame_fingerprint) or frame > 200
     succeeded = car_fingerprint is not None
     done = failed or succeeded
 
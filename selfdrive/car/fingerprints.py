@@ -45,6 +45,50 @@ def is_valid_for_fingerprint(msg, car_fingerprint):
   return (adr in car_fingerprint and car_fingerprint[adr] == len(msg.dat)) or adr >= 0x800
 
 
+class FingerprintIndex():
+  """The FPv1 fingerprints compiled into (address, length) -> bitset of the cars
+     that can send it, bit i being cars[i]. Eliminating the cars that could not
+     have sent a message is a single AND with the candidate bitset."""
+  def __init__(self, fingerprints):
+    self.cars = list(fingerprints.keys())
+    self.bits = {c: 1 << i for i, c in enumerate(self.cars)}
+    self.all = (1 << len(self.cars)) - 1
+
+    self.compatible = {}
+    for car_name, car_fingerprints in fingerprints.items():
+      bit = self.bits[car_name]
+      for fingerprint in car_fingerprints:
+        # add alien debug address
+        for adr, length in {**fingerprint, **_DEBUG_ADDRESS}.items():
+          self.compatible[(adr, length)] = self.compatible.get((adr, length), 0) | bit
+
+  def mask(self, car_names):
+    ret = 0
+    for c in car_names:
+      ret |= self.bits[c]
+    return ret
+
+  def eliminate(self, msg, candidates):
+    adr = msg.address
+    # ignore addresses that are more than 11 bits
+    if adr >= 0x800:
+      return candidates
+    return candidates & self.compatible.get((adr, len(msg.dat)), 0)
+
+  def to_list(self, candidates):
+    return [c for c in self.cars if candidates & self.bits[c]]
+
+
+_fingerprint_index = None
+
+
+def get_fingerprint_index():
+  global _fingerprint_index
+  if _fingerprint_index is None:
+    _fingerprint_index = FingerprintIndex(_FINGERPRINTS)
+  return _fingerprint_index
+
+
 def eliminate_incompatible_cars(msg, candidate_cars):
   """Removes cars that could not have sent msg.
 
@@ -55,19 +99,9 @@ def eliminate_incompatible_cars(msg, candidate_cars):
      Returns:
       A list containing the subset of candidate_cars that could have sent msg.
   """
-  compatible_cars = []
-
-  for car_name in candidate_cars:
-    car_fingerprints = _FINGERPRINTS[car_name]
-
-    for fingerprint in car_fingerprints:
-      fingerprint.update(_DEBUG_ADDRESS)  # add alien debug address
-
-      if is_valid_for_fingerprint(msg, fingerprint):
-        compatible_cars.append(car_name)
-        break
-
-  return compatible_cars
+  index = get_fingerprint_index()
+  compatible = index.eliminate(msg, index.all)
+  return [c for c in candidate_cars if compatible & index.bits[c]]
 
 
 def all_known_cars():
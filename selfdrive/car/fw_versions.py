@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
 import struct
+import time
 import traceback
 from typing import Any
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 from tqdm import tqdm
 
 import panda.python.uds as uds
 from cereal import car
 from selfdrive.car.fingerprints import FW_VERSIONS, get_attr_from_cars
-from selfdrive.car.isotp_parallel_query import IsoTpParallelQuery
+from selfdrive.car.isotp_parallel_query import IsoTpParallelQuery, IsoTpQueryScheduler
 from selfdrive.car.toyota.values import CAR as TOYOTA
+from selfdrive.car.vin import VIN_UNKNOWN, get_vin_query, parse_vin
 from selfdrive.swaglog import cloudlog
 
 Ecu = car.CarParams.Ecu
@@ -158,44 +160,138 @@ def build_fw_dict(fw_versions):
   return fw_versions_dict
 
 
+# These ECUs are known to be shared between models (EPS only between hybrid/ICE version)
+# Getting this exactly right isn't crucial, but excluding camera and radar makes it almost
+# impossible to get 3 matching versions, even if two models with shared parts are released at the same
+# time and only one is in our database.
+FUZZY_EXCLUDE_ECUS = [Ecu.fwdCamera, Ecu.fwdRadar, Ecu.eps]
+
+ESSENTIAL_ECUS = [Ecu.engine, Ecu.eps, Ecu.esp, Ecu.fwdRadar, Ecu.fwdCamera, Ecu.vsa]
+
+# Essential ECUs that may be missing on some models
+NON_ESSENTIAL_ECUS = {
+  Ecu.esp: [TOYOTA.RAV4, TOYOTA.COROLLA, TOYOTA.HIGHLANDER],
+  # On some Toyota models, the engine can show on two different addresses
+  Ecu.engine: [TOYOTA.CAMRY, TOYOTA.COROLLA_TSS2, TOYOTA.CHR, TOYOTA.LEXUS_IS],
+}
+
+
+# ECUs the car interfaces read from car_fw, an early exit still waits for their answers
+PARAMS_ECUS = [Ecu.dsu, Ecu.eps]
+
+
+class FwIndex():
+  """FW_VERSIONS compiled into bitsets of candidates, bit i being candidates[i],
+  so matching is a few lookups and bit operations per ECU."""
+  def __init__(self, fw_versions):
+    self.candidates = list(fw_versions.keys())
+    self.bits = {c: 1 << i for i, c in enumerate(self.candidates)}
+    self.all = (1 << len(self.candidates)) - 1
+
+    # (addr, subaddr) -> candidates with that ECU
+    self.ecu_candidates = defaultdict(int)
+    # candidate bit -> (addr, subaddr) of its ECUs
+    self.ecus = defaultdict(set)
+    # (addr, subaddr) -> candidates that don't match if the ECU is missing
+    self.required = defaultdict(int)
+    # (addr, subaddr, fw) -> candidates with that version
+    self.exact = defaultdict(int)
+    # (addr, subaddr, fw) -> candidates with that version, without ECUs shared between models
+    self.fuzzy = defaultdict(int)
+
+    for candidate, fw_by_addr in fw_versions.items():
+      bit = self.bits[candidate]
+
+      # an address listed for several ECU types has to match all of them
+      allowed = {}
+      for (ecu_type, addr, sub_addr), fws in fw_by_addr.items():
+        a = (addr, sub_addr)
+        allowed[a] = allowed[a] & set(fws) if a in allowed else set(fws)
+
+        if ecu_type in ESSENTIAL_ECUS and candidate not in NON_ESSENTIAL_ECUS.get(ecu_type, []):
+          self.required[a] |= bit
+        if ecu_type not in FUZZY_EXCLUDE_ECUS:
+          for f in fws:
+            self.fuzzy[(addr, sub_addr, f)] |= bit
+
+      for a, fws in allowed.items():
+        self.ecu_candidates[a] |= bit
+        self.ecus[bit].add(a)
+        for f in fws:
+          self.exact[(a[0], a[1], f)] |= bit
+
+  def to_set(self, bits):
+    return {c for c, bit in self.bits.items() if bits & bit}
+
+  def match_exact(self, fw_versions_dict):
+    invalid = 0
+    for a, bits in self.required.items():
+      if a not in fw_versions_dict:
+        invalid |= bits
+
+    for a, version in fw_versions_dict.items():
+      invalid |= self.ecu_candidates.get(a, 0) & ~self.exact.get((a[0], a[1], version), 0)
+
+    return self.all & ~invalid
+
+  def match_final(self, fw_versions_dict, final):
+    """Returns the bit of the car an exact match is sure to end up with while more versions
+    come in, or 0. Versions of the addresses in final won't change anymore, and the car must
+    be the only one they don't rule out, with all of its ECUs final."""
+    invalid = 0
+    for a in final:
+      if a in fw_versions_dict:
+        invalid |= self.ecu_candidates.get(a, 0) & ~self.exact.get((a[0], a[1], fw_versions_dict[a]), 0)
+      else:
+        invalid |= self.required.get(a, 0)
+
+    candidate = self.all & ~invalid
+    if candidate == 0 or candidate & (candidate - 1) or not self.ecus[candidate] <= final:
+      return 0
+    return candidate
+
+  def match_fuzzy(self, fw_versions_dict, exclude=None):
+    """Returns the bit of the only candidate uniquely matched by ECUs and the number
+    of those ECUs, or 0 if ECUs uniquely match different candidates."""
+    mask = self.all & ~self.bits.get(exclude, 0)
+
+    match_count = 0
+    candidate = 0
+    for addr, version in fw_versions_dict.items():
+      # All cars that have this FW response on the specified address
+      candidates = self.fuzzy.get((addr[0], addr[1], version), 0) & mask
+
+      # exactly one bit set
+      if candidates and not candidates & (candidates - 1):
+        match_count += 1
+        if candidate == 0:
+          candidate = candidates
+        # We uniquely matched two different cars. No fuzzy match possible
+        elif candidate != candidates:
+          return 0, 0
+
+    return candidate, match_count
+
+
+_fw_index = None
+
+
+def get_fw_index():
+  global _fw_index
+  if _fw_index is None:
+    _fw_index = FwIndex(FW_VERSIONS)
+  return _fw_index
+
+
 def match_fw_to_car_fuzzy(fw_versions_dict, log=True, exclude=None):
   """Do a fuzzy FW match. This function will return a match, and the number of firmware version
   that were matched uniquely to that specific car. If multiple ECUs uniquely match to different cars
   the match is rejected."""
-
-  # These ECUs are known to be shared between models (EPS only between hybrid/ICE version)
-  # Getting this exactly right isn't crucial, but excluding camera and radar makes it almost
-  # impossible to get 3 matching versions, even if two models with shared parts are released at the same
-  # time and only one is in our database.
-  exclude_types = [Ecu.fwdCamera, Ecu.fwdRadar, Ecu.eps]
-
-  # Build lookup table from (addr, subaddr, fw) to list of candidate cars
-  all_fw_versions = defaultdict(list)
-  for candidate, fw_by_addr in FW_VERSIONS.items():
-    if candidate == exclude:
-      continue
-
-    for addr, fws in fw_by_addr.items():
-      if addr[0] in exclude_types:
-        continue
-      for f in fws:
-        all_fw_versions[(addr[1], addr[2], f)].append(candidate)
-
-  match_count = 0
-  candidate = None
-  for addr, version in fw_versions_dict.items():
-    # All cars that have this FW response on the specified address
-    candidates = all_fw_versions[(addr[0], addr[1], version)]
-
-    if len(candidates) == 1:
-      match_count += 1
-      if candidate is None:
-        candidate = candidates[0]
-      # We uniquely matched two different cars. No fuzzy match possible
-      elif candidate != candidates[0]:
-        return set()
+  index = get_fw_index()
+  candidate, match_count = index.match_fuzzy(fw_versions_dict, exclude)
 
   if match_count >= 2:
+    candidate = index.to_set(candidate).pop()
     if log:
       cloudlog.error(f"Fingerprinted {candidate} using fuzzy match. {match_count} matching ECUs")
     return set([candidate])
@@ -208,31 +304,8 @@ def match_fw_to_car_exact(fw_versions_dict):
   FW versions for a list of "essential" ECUs. If an ECU is not considered
   essential the FW version can be missing to get a fingerprint, but if it's present it
   needs to match the database."""
-  invalid = []
-  candidates = FW_VERSIONS
-
-  for candidate, fws in candidates.items():
-    for ecu, expected_versions in fws.items():
-      ecu_type = ecu[0]
-      addr = ecu[1:]
-      found_version = fw_versions_dict.get(addr, None)
-      ESSENTIAL_ECUS = [Ecu.engine, Ecu.eps, Ecu.esp, Ecu.fwdRadar, Ecu.fwdCamera, Ecu.vsa]
-      if ecu_type == Ecu.esp and candidate in [TOYOTA.RAV4, TOYOTA.COROLLA, TOYOTA.HIGHLANDER] and found_version is None:
-        continue
-
-      # On some Toyota models, the engine can show on two different addresses
-      if ecu_type == Ecu.engine and candidate in [TOYOTA.CAMRY, TOYOTA.COROLLA_TSS2, TOYOTA.CHR, TOYOTA.LEXUS_IS] and found_version is None:
-        continue
-
-      # Ignore non essential ecus
-      if ecu_type not in ESSENTIAL_ECUS and found_version is None:
-        continue
-
-      if found_version not in expected_versions:
-        invalid.append(candidate)
-        break
-
-  return set(candidates.keys()) - set(invalid)
+  index = get_fw_index()
+  return index.to_set(index.match_exact(fw_versions_dict))
 
 
 def match_fw_to_car(fw_versions, allow_fuzzy=True):
@@ -250,13 +323,16 @@ def match_fw_to_car(fw_versions, allow_fuzzy=True):
   return exact_match, matches
 
 
-def get_fw_versions(logcan, sendcan, bus, extra=None, timeout=0.1, debug=False, progress=False):
+def get_fw_queries(logcan, sendcan, bus, extra=None, timeout=0.1, debug=False):
+  """Returns the ECU type of every address, the queries to run with their timeouts and
+  the addresses of the ECUs in PARAMS_ECUS. Each ECU gets its own queries so different
+  ECUs are queried concurrently."""
   ecu_types = {}
+  params_addrs = set()
 
   # Extract ECU addresses to query from fingerprints
   # ECUs using a subadress need be queried one by one, the rest can be done in parallel
   addrs = []
-  parallel_addrs = []
 
   versions = get_attr_from_cars('FW_VERSIONS', combine_brands=False)
   if extra is not None:
@@ -269,28 +345,90 @@ def get_fw_versions(logcan, sendcan, bus, extra=None, timeout=0.1, debug=False,
         if a not in ecu_types:
           ecu_types[(addr, sub_addr)] = ecu_type
 
-        if sub_addr is None:
-          if a not in parallel_addrs:
-            parallel_addrs.append(a)
-        else:
-          if [a] not in addrs:
-            addrs.append([a])
+        if a not in addrs:
+          addrs.append(a)
+        if ecu_type in PARAMS_ECUS:
+          params_addrs.add((addr, sub_addr))
+
+  # ECUs without subaddress go first
+  addrs.sort(key=lambda a: a[2] is not None)
 
-  addrs.insert(0, parallel_addrs)
+  # the scheduler keeps the order of the requests to one ECU, the last valid response wins
+  queries = []
+  for brand, request, response, response_offset in REQUESTS:
+    for b, addr, sub_addr in addrs:
+      if b not in (brand, 'any'):
+        continue
+      try:
+        query = IsoTpParallelQuery(sendcan, logcan, bus, [(addr, sub_addr)], request, response, response_offset, debug=debug)
+        queries.append((query, 2 * timeout if sub_addr is None else timeout))
+      except Exception:
+        cloudlog.warning(f"FW query exception: {traceback.format_exc()}")
+
+  return ecu_types, queries, params_addrs
+
+
+def get_vin_and_fw_versions(logcan, sendcan, bus, extra=None, timeout=0.1, vin_retry=5, early_exit=True, debug=False, progress=False):
+  """Queries the VIN and FW versions concurrently. With early_exit, the FW queries stop
+  as soon as the versions so far are sure to exact match a single car, and the ECUs the
+  car interfaces read from car_fw have answered. Returns the VIN, the FW versions and the
+  timing of the queries."""
+  start_time = time.monotonic()
+  ecu_types, queries, params_addrs = get_fw_queries(logcan, sendcan, bus, extra=extra, timeout=timeout, debug=debug)
+
+  scheduler = IsoTpQueryScheduler(logcan)
+  vin_query = None
+  vin_tries = 0
+  vin = VIN_UNKNOWN
+  if vin_retry > 0:
+    vin_query = get_vin_query(logcan, sendcan, bus, debug=debug)
+    vin_tries = 1
+    scheduler.add(vin_query, timeout)
+  for query, t in queries:
+    scheduler.add(query, t)
+
+  # queries left per address, its version is final once they are done
+  pending = Counter(a for query, _ in queries for a in query.real_addrs)
+  index = get_fw_index()
+  final = {a for a in index.ecu_candidates if pending[a] == 0}
 
   fw_versions = {}
-  for i, addr in enumerate(tqdm(addrs, disable=not progress)):
-    for addr_chunk in chunks(addr):
-      for brand, request, response, response_offset in REQUESTS:
-        try:
-          addrs = [(a, s) for (b, a, s) in addr_chunk if b in (brand, 'any')]
-
-          if addrs:
-            query = IsoTpParallelQuery(sendcan, logcan, bus, addrs, request, response, response_offset, debug=debug)
-            t = 2 * timeout if i == 0 else timeout
-            fw_versions.update(query.get_data(t))
-        except Exception:
-          cloudlog.warning(f"FW query exception: {traceback.format_exc()}")
+  timing = {"vin_time": None, "fingerprint_time": None, "queries": len(queries), "queries_done": 0}
+  match = 0
+  with tqdm(total=len(queries), disable=not progress) as pbar:
+    for query, results in scheduler.run():
+      if query is vin_query:
+        ret = parse_vin(results)
+        if ret is not None:
+          vin = ret[1]
+        elif vin_tries < vin_retry:
+          vin_query = get_vin_query(logcan, sendcan, bus, debug=debug)
+          vin_tries += 1
+          scheduler.add(vin_query, timeout)
+          continue
+
+        vin_query = None
+        timing["vin_time"] = time.monotonic() - start_time
+      else:
+        fw_versions.update(results)
+        timing["queries_done"] += 1
+        pbar.update()
+
+        for a in query.real_addrs:
+          pending[a] -= 1
+          if pending[a] == 0 and a in index.ecu_candidates:
+            final.add(a)
+
+        if early_exit and not match:
+          match = index.match_final(fw_versions, final)
+          if match:
+            timing["fingerprint_time"] = time.monotonic() - start_time
+
+      # an ECU missing from car_fw changes the params, e.g. enableDsu on Toyota
+      if match and vin_query is None and all(pending[a] == 0 for a in params_addrs):
+        break
+
+  timing["total_time"] = time.monotonic() - start_time
 
   # Build capnp list to put into CarParams
   car_fw = []
@@ -306,18 +444,23 @@ def get_fw_versions(logcan, sendcan, bus, extra=None, timeout=0.1, debug=False,
 
     car_fw.append(f)
 
+  return vin, car_fw, timing
+
+
+def get_fw_versions(logcan, sendcan, bus, extra=None, timeout=0.1, debug=False, progress=False):
+  _, car_fw, _ = get_vin_and_fw_versions(logcan, sendcan, bus, extra=extra, timeout=timeout, vin_retry=0, early_exit=False,
+                                         debug=debug, progress=progress)
   return car_fw
 
 
 if __name__ == "__main__":
-  import time
   import argparse
   import cereal.messaging as messaging
-  from selfdrive.car.vin import get_vin
 
   parser = argparse.ArgumentParser(description='Get firmware version of ECUs')
   parser.add_argument('--scan', action='store_true')
   parser.add_argument('--debug', action='store_true')
+  parser.add_argument('--early-exit', action='store_true', help='stop once the FW versions match a car')
   args = parser.parse_args()
 
   logcan = messaging.sub_sock('can')
@@ -335,17 +478,16 @@ if __name__ == "__main__":
 
   time.sleep(1.)
 
-  t = time.time()
-  print("Getting vin...")
-  addr, vin = get_vin(logcan, sendcan, 1, retry=10, debug=args.debug)
-  print(f"VIN: {vin}")
-  print("Getting VIN took %.3f s" % (time.time() - t))
-  print()
-
-  t = time.time()
-  fw_vers = get_fw_versions(logcan, sendcan, 1, extra=extra, debug=args.debug, progress=True)
+  print("Getting vin and fw...")
+  vin, fw_vers, timing = get_vin_and_fw_versions(logcan, sendcan, 1, extra=extra, vin_retry=10, early_exit=args.early_exit,
+                                                 debug=args.debug, progress=True)
   _, candidates = match_fw_to_car(fw_vers)
 
+  print()
+  print(f"VIN: {vin}")
+  if timing["vin_time"] is not None:
+    print("Getting VIN took %.3f s" % timing["vin_time"])
+
   print()
   print("Found FW versions")
   print("{")
@@ -356,4 +498,6 @@ if __name__ == "__main__":
 
   print()
   print("Possible matches:", candidates)
-  print("Getting fw took %.3f s" % (time.time() - t))
+  if timing["fingerprint_time"] is not None:
+    print("Fingerprinting took %.3f s" % timing["fingerprint_time"])
+  print("Getting fw took %.3f s (%d/%d queries)" % (timing["total_time"], timing["queries_done"], timing["queries"]))
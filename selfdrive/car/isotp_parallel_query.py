@@ -1,4 +1,5 @@
 import time
+import traceback
 from collections import defaultdict
 from functools import partial
 from typing import Optional
@@ -29,19 +30,38 @@ class IsoTpParallelQuery:
     self.msg_addrs = {tx_addr: get_rx_addr_for_tx_addr(tx_addr[0], rx_offset=response_offset) for tx_addr in self.real_addrs}
     self.msg_buffer = defaultdict(list)
 
+    if functional_addr:
+      # any ECU can answer, and the rest of the query goes to the physical address of the first response
+      self.rx_addrs = set(range(0x7E8, 0x7F0)) | set(range(0x18DAF100, 0x18DAF200))
+      tx_addrs = set(FUNCTIONAL_ADDRS) | set(range(0x7E0, 0x7E8)) | {0x18DA00F1 + (i << 8) for i in range(0x100)}
+    else:
+      self.rx_addrs = set(self.msg_addrs.values())
+      tx_addrs = {tx_addr for tx_addr, _ in self.real_addrs}
+    # addresses the query sends or listens on, queries sharing one can't run at the same time
+    self.bus_addrs = self.rx_addrs | tx_addrs
+
+    self.msgs = {}
+    self.request_counter = {}
+    self.request_done = {}
+    self.results = {}
+    self.timeout = 0.
+    self.start_time = 0.
+
   def rx(self):
     """Drain can socket and sort messages into buffers based on address"""
     can_packets = messaging.drain_sock(self.logcan, wait_for_one=True)
 
     for packet in can_packets:
       for msg in packet.can:
-        if msg.src == self.bus:
-          if self.functional_addr:
-            if (0x7E8 <= msg.address <= 0x7EF) or (0x18DAF100 <= msg.address <= 0x18DAF1FF):
-              fn_addr = next(a for a in FUNCTIONAL_ADDRS if msg.address - a <= 32)
-              self.msg_buffer[fn_addr].append((msg.address, msg.busTime, msg.dat, msg.src))
-          elif msg.address in self.msg_addrs.values():
-            self.msg_buffer[msg.address].append((msg.address, msg.busTime, msg.dat, msg.src))
+        if msg.src == self.bus and msg.address in self.rx_addrs:
+          self.buffer_msg(msg)
+
+  def buffer_msg(self, msg):
+    if self.functional_addr:
+      fn_addr = next(a for a in FUNCTIONAL_ADDRS if msg.address - a <= 32)
+      self.msg_buffer[fn_addr].append((msg.address, msg.busTime, msg.dat, msg.src))
+    else:
+      self.msg_buffer[msg.address].append((msg.address, msg.busTime, msg.dat, msg.src))
 
   def _can_tx(self, tx_addr, dat, bus):
     """Helper function to send single message"""
@@ -71,13 +91,15 @@ class IsoTpParallelQuery:
     messaging.drain_sock(self.logcan)
     self.msg_buffer = defaultdict(list)
 
-  def get_data(self, timeout):
-    self._drain_rx()
+  def start(self, timeout):
+    """Sends the first request to every address, responses are then handled by update()"""
+    self.msg_buffer = defaultdict(list)
 
     # Create message objects
-    msgs = {}
-    request_counter = {}
-    request_done = {}
+    self.msgs = {}
+    self.request_counter = {}
+    self.request_done = {}
+    self.results = {}
     for tx_addr, rx_addr in self.msg_addrs.items():
       # rx_addr not set when using functional tx addr
       id_addr = rx_addr or tx_addr[0]
@@ -91,40 +113,115 @@ class IsoTpParallelQuery:
       msg = IsoTpMessage(can_client, timeout=0, max_len=max_len, debug=self.debug)
       msg.send(self.request[0])
 
-      msgs[tx_addr] = msg
-      request_counter[tx_addr] = 0
-      request_done[tx_addr] = False
+      self.msgs[tx_addr] = msg
+      self.request_counter[tx_addr] = 0
+      self.request_done[tx_addr] = False
 
-    results = {}
-    start_time = time.time()
-    while True:
-      self.rx()
+    self.timeout = timeout
+    self.start_time = time.monotonic()
 
-      if all(request_done.values()):
-        break
+  def update(self):
+    """Handles the buffered responses, returns True once the query is done"""
+    if all(self.request_done.values()):
+      return True
 
-      for tx_addr, msg in msgs.items():
-        dat: Optional[bytes] = msg.recv()
+    for tx_addr, msg in self.msgs.items():
+      dat: Optional[bytes] = msg.recv()
 
-        if not dat:
-          continue
+      if not dat:
+        continue
 
-        counter = request_counter[tx_addr]
-        expected_response = self.response[counter]
-        response_valid = dat[:len(expected_response)] == expected_response
+      counter = self.request_counter[tx_addr]
+      expected_response = self.response[counter]
+      response_valid = dat[:len(expected_response)] == expected_response
 
-        if response_valid:
-          if counter + 1 < len(self.request):
-            msg.send(self.request[counter + 1])
-            request_counter[tx_addr] += 1
-          else:
-            results[tx_addr] = dat[len(expected_response):]
-            request_done[tx_addr] = True
+      if response_valid:
+        if counter + 1 < len(self.request):
+          msg.send(self.request[counter + 1])
+          self.request_counter[tx_addr] += 1
         else:
-          request_done[tx_addr] = True
-          cloudlog.warning(f"iso-tp query bad response: 0x{dat.hex()}")
+          self.results[tx_addr] = dat[len(expected_response):]
+          self.request_done[tx_addr] = True
+      else:
+        self.request_done[tx_addr] = True
+        cloudlog.warning(f"iso-tp query bad response: 0x{dat.hex()}")
 
-      if time.time() - start_time > timeout:
+    return all(self.request_done.values()) or time.monotonic() - self.start_time > self.timeout
+
+  def get_data(self, timeout):
+    self._drain_rx()
+    self.start(timeout)
+    while True:
+      self.rx()
+      if self.update():
         break
 
-    return results
+    return self.results
+
+
+class IsoTpQueryScheduler():
+  """Runs queries concurrently on the bus, sharing one can socket. A query starts once none
+  of its addresses are used by a running query or one queued before it, so the requests to
+  an ECU still go out in the order they were added."""
+  def __init__(self, logcan):
+    self.logcan = logcan
+    self.queued = []
+    self.running = []
+    self.failed = []
+    # (bus, rx addr) -> running query listening on it
+    self.listeners = {}
+
+  def add(self, query, timeout):
+    self.queued.append((query, timeout))
+
+  def _start_queries(self):
+    busy = set()
+    for query in self.running:
+      busy |= query.bus_addrs
+
+    queued = []
+    for query, timeout in self.queued:
+      if busy.isdisjoint(query.bus_addrs):
+        try:
+          query.start(timeout)
+          self.running.append(query)
+          self.listeners.update({(query.bus, addr): query for addr in query.rx_addrs})
+        except Exception:
+          cloudlog.warning(f"iso-tp query exception: {traceback.format_exc()}")
+          self.failed.append(query)
+      else:
+        queued.append((query, timeout))
+      busy |= query.bus_addrs
+    self.queued = queued
+
+  def _stop(self, query):
+    self.running.remove(query)
+    for addr in query.rx_addrs:
+      del self.listeners[(query.bus, addr)]
+
+  def run(self):
+    """Yields (query, results) as queries finish, more queries can be added meanwhile.
+    Stopping the iteration abandons the queries that are left."""
+    messaging.drain_sock(self.logcan)
+
+    while self.queued or self.running or self.failed:
+      self._start_queries()
+      while self.failed:
+        yield self.failed.pop(0), {}
+
+      for packet in messaging.drain_sock(self.logcan, wait_for_one=True):
+        for msg in packet.can:
+          query = self.listeners.get((msg.src, msg.address))
+          if query is not None:
+            query.buffer_msg(msg)
+
+      for query in list(self.running):
+        try:
+          done = query.update()
+        except Exception:
+          cloudlog.warning(f"iso-tp query exception: {traceback.format_exc()}")
+          done = True
+
+        if done:
+          self._stop(query)
+          yield query, query.results
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import random
+import unittest
+
+from cereal import log
+from selfdrive.car.fingerprints import _FINGERPRINTS, _DEBUG_ADDRESS, all_legacy_fingerprint_cars, \
+                                       eliminate_incompatible_cars, get_fingerprint_index, is_valid_for_fingerprint
+
+CanData = log.CanData
+
+
+def eliminate_reference(msg, candidate_cars):
+  return [c for c in candidate_cars if any(is_valid_for_fingerprint(msg, {**f, **_DEBUG_ADDRESS}) for f in _FINGERPRINTS[c])]
+
+
+def fingerprint_traffic(car_name, frames=200):
+  # the fingerprint of a car replayed as the CAN traffic it sends every frame
+  fingerprint = random.Random(car_name).choice(_FINGERPRINTS[car_name])
+  msgs = [CanData.new_message(address=adr, dat=b"\x00" * length, src=0) for adr, length in fingerprint.items()]
+  return [msgs] * frames
+
+
+class TestFingerprintIndex(unittest.TestCase):
+  def test_matches_reference(self):
+    rnd = random.Random(0)
+    all_cars = all_legacy_fingerprint_cars()
+    for car_name in all_cars:
+      traffic = fingerprint_traffic(car_name, frames=1)[0]
+      # a few messages that don't belong to the car
+      traffic += [CanData.new_message(address=rnd.randint(0, 0x900), dat=b"\x00" * rnd.randint(0, 8)) for _ in range(3)]
+
+      candidates = all_cars
+      for msg in traffic:
+        expected = eliminate_reference(msg, candidates)
+        candidates = eliminate_incompatible_cars(msg, candidates)
+        self.assertEqual(candidates, expected)
+
+  def test_replay(self):
+    # whole frames of a car's traffic narrow the index down the same as the reference scan
+    index = get_fingerprint_index()
+    all_cars = all_legacy_fingerprint_cars()
+    for car_name in random.Random(1).sample(all_cars, 5):
+      candidates, expected = index.all, all_cars
+      for msgs in fingerprint_traffic(car_name, frames=3):
+        for msg in msgs:
+          candidates = index.eliminate(msg, candidates)
+          expected = eliminate_reference(msg, expected)
+      self.assertEqual(index.to_list(candidates), [c for c in index.cars if c in expected])
+      self.assertIn(car_name, expected)
+
+
+if __name__ == "__main__":
+  unittest.main()
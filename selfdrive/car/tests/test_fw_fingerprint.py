@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import random
+import unittest
+from unittest import mock
+
+from cereal import car
+from selfdrive.car import fw_versions
+from selfdrive.car.fingerprints import FW_VERSIONS, get_attr_from_cars
+from selfdrive.car.fw_versions import ESSENTIAL_ECUS, NON_ESSENTIAL_ECUS, get_fw_index, get_vin_and_fw_versions, \
+                                      match_fw_to_car, match_fw_to_car_exact
+
+CarFw = car.CarParams.CarFw
+Ecu = car.CarParams.Ecu
+
+
+class FakeQuery():
+  def __init__(self, sendcan, logcan, bus, addrs, *args, **kwargs):
+    self.real_addrs = addrs
+
+
+class FakeScheduler():
+  """Answers queries from a car's FW versions. The car's ECUs answer first, then the
+  queries to absent ECUs time out, and the queries to slow_addr finish last."""
+  def __init__(self, versions, slow_addr=None):
+    self.versions = versions
+    self.slow_addr = slow_addr
+    self.queries = []
+    self.done = []
+
+  def add(self, query, timeout):
+    self.queries.append(query)
+
+  def run(self):
+    def order(q):
+      return 2 if self.slow_addr in q.real_addrs else (0 if any(a in self.versions for a in q.real_addrs) else 1)
+
+    for query in sorted(self.queries, key=order):
+      self.done.append(query)
+      yield query, {a: self.versions[a] for a in query.real_addrs if a in self.versions}
+
+
+class TestFwFingerprint(unittest.TestCase):
+  def test_fw_fingerprint(self):
+    for car_model, ecus in FW_VERSIONS.items():
+      fw = []
+      for (ecu, addr, sub_addr), versions in ecus.items():
+        fw.append(CarFw.new_message(ecu=ecu, fwVersion=random.choice(versions), address=addr, subAddress=0 if sub_addr is None else sub_addr))
+
+      exact_match, matches = match_fw_to_car(fw)
+      self.assertTrue(exact_match)
+      self.assertIn(car_model, matches)
+
+  def test_missing_essential_ecu(self):
+    for car_model, ecus in FW_VERSIONS.items():
+      fw_versions_dict = {(addr, sub_addr): versions[0] for (_, addr, sub_addr), versions in ecus.items()}
+      for ecu, addr, sub_addr in ecus:
+        missing = {a: v for a, v in fw_versions_dict.items() if a != (addr, sub_addr)}
+        essential = ecu in ESSENTIAL_ECUS and car_model not in NON_ESSENTIAL_ECUS.get(ecu, [])
+        self.assertEqual(car_model in match_fw_to_car_exact(missing), not essential)
+
+  def test_match_final(self):
+    index = get_fw_index()
+    all_addrs = list(index.ecu_candidates)
+    random.seed(0)
+    for car_model, ecus in FW_VERSIONS.items():
+      fw_versions_dict = {(addr, sub_addr): random.choice(versions) for (_, addr, sub_addr), versions in ecus.items()}
+      exact = match_fw_to_car_exact(fw_versions_dict)
+      match = index.match_final(fw_versions_dict, set(all_addrs))
+      self.assertEqual(index.to_set(match), exact if len(exact) == 1 else set())
+
+      # a match on final versions can't change, whatever the other addresses answer
+      final = {a for a in all_addrs if random.random() < 0.8}
+      partial = {a: v for a, v in fw_versions_dict.items() if a in final}
+      match = index.match_final(partial, final)
+      if match:
+        for _ in range(10):
+          full = dict(partial)
+          for a in all_addrs:
+            if a not in final and random.random() < 0.5:
+              full[a] = random.choice([f for (addr, sub_addr, f) in index.exact if (addr, sub_addr) == a] or [b''])
+          self.assertEqual(index.to_set(index.match_exact(full)), index.to_set(match))
+
+  def get_fw(self, versions, slow_addr=None):
+    scheduler = FakeScheduler(versions, slow_addr)
+    with mock.patch.object(fw_versions, "IsoTpParallelQuery", FakeQuery), \
+         mock.patch.object(fw_versions, "IsoTpQueryScheduler", lambda logcan: scheduler):
+      _, car_fw, timing = get_vin_and_fw_versions(None, None, 1, vin_retry=0)
+    return scheduler, car_fw, timing
+
+  def test_early_exit(self):
+    for car_model, ecus in FW_VERSIONS.items():
+      versions = {(addr, sub_addr): versions[0] for (_, addr, sub_addr), versions in ecus.items()}
+      _, car_fw, timing = self.get_fw(versions)
+      self.assertEqual(match_fw_to_car(car_fw)[1], {car_model})
+      self.assertLess(timing["queries_done"], timing["queries"])
+
+  def test_early_exit_waits_for_dsu(self):
+    # the DSU answering last must not be cut off by an early match, toyota's enableDsu depends on it
+    dsu_addr = (0x791, None)
+    for car_model, ecus in get_attr_from_cars('FW_VERSIONS', combine_brands=False)['toyota'].items():
+      versions = {(addr, sub_addr): versions[0] for (_, addr, sub_addr), versions in ecus.items()}
+      scheduler, car_fw, _ = self.get_fw(versions, dsu_addr)
+
+      self.assertTrue(all(q in scheduler.done for q in scheduler.queries if dsu_addr in q.real_addrs))
+      self.assertEqual(Ecu.dsu in [fw.ecu for fw in car_fw], dsu_addr in versions, car_model)
+      self.assertEqual(match_fw_to_car(car_fw)[1], {car_model})
+
+if __name__ == "__main__":
+  unittest.main()
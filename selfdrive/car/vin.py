@@ -11,12 +11,22 @@ VIN_RESPONSE = b'\x49\x02\x01'
 VIN_UNKNOWN = "0" * 17
 
 
+def get_vin_query(logcan, sendcan, bus, debug=False):
+  return IsoTpParallelQuery(sendcan, logcan, bus, FUNCTIONAL_ADDRS, [VIN_REQUEST], [VIN_RESPONSE], functional_addr=True, debug=debug)
+
+
+def parse_vin(results):
+  for addr, vin in results.items():
+    return addr[0], vin.decode()
+  return None
+
+
 def get_vin(logcan, sendcan, bus, timeout=0.1, retry=5, debug=False):
   for i in range(retry):
     try:
-      query = IsoTpParallelQuery(sendcan, logcan, bus, FUNCTIONAL_ADDRS, [VIN_REQUEST], [VIN_RESPONSE], functional_addr=True, debug=debug)
-      for addr, vin in query.get_data(timeout).items():
-        return addr[0], vin.decode()
+      vin = parse_vin(get_vin_query(logcan, sendcan, bus, debug=debug).get_data(timeout))
+      if vin is not None:
+        return vin
       print(f"vin query retry ({i+1}) ...")
     except Exception:
       cloudlog.warning(f"VIN query exception: {traceback.format_exc()}")
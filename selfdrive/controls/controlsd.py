@@ -56,7 +56,9 @@ class Controls:
     self.pm = pm
     if self.pm is None:
       self.pm = messaging.PubMaster(['sendcan', 'controlsState', 'carState',
-                                     'carControl', 'carEvents', 'carParams'])
+                                     'carControl', 'carEvents', 'carParams', 'profilerSummary'])
+    # an external pm doesn't publish the profiler summary
+    self.send_profile = pm is None
 
     self.camera_packets = ["roadCameraState", "driverCameraState"]
     if TICI:
@@ -186,7 +188,7 @@ class Controls:
 
     # controlsd is driven by can recv, expected at 100Hz
     self.rk = Ratekeeper(100, print_delay_threshold=None)
-    self.prof = Profiler(False)  # off by default
+    self.prof = Profiler(True, "controlsd", budget=DT_CTRL)
 
   def update_events(self, CS):
     """Compute carEvents from carState"""
@@ -342,6 +344,8 @@ class Controls:
 
     # Update carState from CAN
     can_strs = messaging.drain_sock_raw(self.can_sock, wait_for_one=True)
+    # waiting for the next CAN packet paces the loop, it's not part of the work budget
+    self.prof.checkpoint("CAN wait", ignore=True)
     CS = self.CI.update(self.CC, can_strs)
 
     self.sm.update(0)
@@ -724,7 +728,10 @@ class Controls:
     while True:
       self.step()
       self.rk.monitor_time()
-      self.prof.display()
+      if self.prof.end_iteration() and self.send_profile:
+        dat = messaging.new_message('profilerSummary')
+        dat.profilerSummary = self.prof.summary()
+        self.pm.send('profilerSummary', dat)
 
 def main(sm=None, pm=None, logcan=None):
   controls = Controls(sm, pm, logcan)
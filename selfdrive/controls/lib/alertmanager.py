@@ -1,7 +1,8 @@
 import os
 import copy
 import json
-from typing import List, Optional
+import heapq
+from typing import Dict, List, Optional, Tuple
 
 from cereal import car, log
 from common.basedir import BASEDIR
@@ -29,7 +30,14 @@ def set_offroad_alert(alert: str, show_alert: bool, extra_text: Optional[str] =
 class AlertManager:
 
   def __init__(self):
-    self.activealerts: List[Alert] = []
+    # one pooled copy per alert type, refreshed in place when added again
+    self.alert_pool: Dict[str, Alert] = {}
+    self.activealerts: Dict[str, Alert] = {}
+    # (-priority, -start_time, add order, alert_type), entries of refreshed or removed alerts are skipped lazily
+    self.alert_heap: List[Tuple[int, float, int, str]] = []
+    self.alert_order: Dict[str, int] = {}
+    self.add_count = 0
+    self.current_alert: Optional[Alert] = None
     self.clear_current_alert()
 
   def clear_current_alert(self) -> None:
@@ -44,30 +52,53 @@ class AlertManager:
 
   def add_many(self, frame: int, alerts: List[Alert], enabled: bool = True) -> None:
     for alert in alerts:
-      added_alert = copy.copy(alert)
+      added_alert = self.alert_pool.get(alert.alert_type)
+      if added_alert is None:
+        added_alert = self.alert_pool[alert.alert_type] = copy.copy(alert)
+      else:
+        added_alert.__dict__.update(alert.__dict__)
       added_alert.start_time = frame * DT_CTRL
 
       # if new alert is higher priority, log it
-      if not len(self.activealerts) or added_alert.alert_priority > self.activealerts[0].alert_priority:
+      if self.current_alert is None or added_alert.alert_priority > self.current_alert.alert_priority:
         cloudlog.event('alert_add', alert_type=added_alert.alert_type, enabled=enabled)
+        if self.current_alert is None:
+          self.current_alert = added_alert
 
-      self.activealerts.append(added_alert)
+      self.add_count += 1
+      self.activealerts[alert.alert_type] = added_alert
+      self.alert_order[alert.alert_type] = self.add_count
+      heapq.heappush(self.alert_heap, (-added_alert.alert_priority, -added_alert.start_time, self.add_count, alert.alert_type))
+
+    # drop the entries of refreshed alerts once they pile up
+    if len(self.alert_heap) > 2 * len(self.activealerts) + 16:
+      self.alert_heap = [(-a.alert_priority, -a.start_time, self.alert_order[t], t) for t, a in self.activealerts.items()]
+      heapq.heapify(self.alert_heap)
 
   def process_alerts(self, frame: int, clear_event_type=None) -> None:
     cur_time = frame * DT_CTRL
 
-    # first get rid of all the expired alerts
-    self.activealerts = [a for a in self.activealerts if a.event_type != clear_event_type and
-                         a.start_time + max(a.duration_sound, a.duration_hud_alert, a.duration_text) > cur_time]
-
-    # sort by priority first and then by start_time
-    self.activealerts.sort(key=lambda k: (k.alert_priority, k.start_time), reverse=True)
+    if clear_event_type is not None:
+      for alert_type in [t for t, a in self.activealerts.items() if a.event_type == clear_event_type]:
+        del self.activealerts[alert_type]
+
+    # highest priority first and then latest start_time, expired alerts are removed on the way
+    self.current_alert = None
+    while len(self.alert_heap):
+      _, _, order, alert_type = self.alert_heap[0]
+      a = self.activealerts.get(alert_type)
+      if a is not None and self.alert_order[alert_type] == order:
+        if a.start_time + max(a.duration_sound, a.duration_hud_alert, a.duration_text) > cur_time:
+          self.current_alert = a
+          break
+        del self.activealerts[alert_type]
+      heapq.heappop(self.alert_heap)
 
     # start with assuming no alerts
     self.clear_current_alert()
 
-    if len(self.activealerts):
-      current_alert = self.activealerts[0]
+    if self.current_alert is not None:
+      current_alert = self.current_alert
 
       self.alert_type = current_alert.alert_type
 
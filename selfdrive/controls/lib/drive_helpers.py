@@ -1,5 +1,5 @@
 from cereal import car
-from common.numpy_fast import clip, interp
+from common.numpy_fast import clip, interp, InterpTable
 from common.realtime import DT_MDL
 from selfdrive.config import Conversions as CV
 from selfdrive.modeld.constants import T_IDXS
@@ -28,6 +28,7 @@ CAR_ROTATION_RADIUS = 0.0
 # this corresponds to 80deg/s and 20deg/s steering angle in a toyota corolla
 MAX_CURVATURE_RATES = [0.03762194918267951, 0.003441203371932992]
 MAX_CURVATURE_RATE_SPEEDS = [0, 35]
+MAX_CURVATURE_RATE = InterpTable(MAX_CURVATURE_RATE_SPEEDS, MAX_CURVATURE_RATES)
 
 class MPC_COST_LAT:
   PATH = 1.0
@@ -109,7 +110,7 @@ def get_lag_adjusted_curvature(CP, v_ego, psis, curvatures, curvature_rates):
   curvature_diff_from_psi = psi / (max(v_ego, 1e-1) * delay) - current_curvature
   desired_curvature = current_curvature + 2 * curvature_diff_from_psi
 
-  max_curvature_rate = interp(v_ego, MAX_CURVATURE_RATE_SPEEDS, MAX_CURVATURE_RATES)
+  max_curvature_rate = MAX_CURVATURE_RATE(v_ego)
   safe_desired_curvature_rate = clip(desired_curvature_rate,
                                           -max_curvature_rate,
                                           max_curvature_rate)
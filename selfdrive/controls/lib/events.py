@@ -39,13 +39,20 @@ class ET:
 
 # get event name from enum
 EVENT_NAME = {v: k for k, v in EventName.schema.enumerants.items()}
+NUM_EVENTS = max(EVENT_NAME) + 1
+
+# bit of every event type in EVENT_TYPE_MASK
+EVENT_TYPE_BIT = {et: 1 << i for i, et in enumerate([ET.ENABLE, ET.PRE_ENABLE, ET.NO_ENTRY, ET.WARNING, ET.USER_DISABLE,
+                                                      ET.SOFT_DISABLE, ET.IMMEDIATE_DISABLE, ET.PERMANENT])}
 
 
 class Events:
   def __init__(self):
     self.events = []
     self.static_events = []
-    self.events_prev = dict.fromkeys(EVENTS.keys(), 0)
+    # number of consecutive steps each event has been active, indexed by event id
+    self.events_prev = [0] * NUM_EVENTS
+    self._active_prev = set()
 
   @property
   def names(self):
@@ -60,12 +67,19 @@ class Events:
     self.events.append(event_name)
 
   def clear(self):
-    self.events_prev = {k: (v + 1 if k in self.events else 0) for k, v in self.events_prev.items()}
+    # only events active in this or the previous step change their count
+    active = set(self.events)
+    for e in self._active_prev - active:
+      self.events_prev[e] = 0
+    for e in active:
+      self.events_prev[e] += 1
+    self._active_prev = active
     self.events = self.static_events.copy()
 
   def any(self, event_type):
+    bit = EVENT_TYPE_BIT[event_type]
     for e in self.events:
-      if event_type in EVENTS.get(e, {}).keys():
+      if EVENT_TYPE_MASK[e] & bit:
         return True
     return False
 
@@ -73,8 +87,14 @@ class Events:
     if callback_args is None:
       callback_args = []
 
+    wanted = 0
+    for et in event_types:
+      wanted |= EVENT_TYPE_BIT[et]
+
     ret = []
     for e in self.events:
+      if not EVENT_TYPE_MASK[e] & wanted:
+        continue
       types = EVENTS[e].keys()
       for et in event_types:
         if et in types:
@@ -184,6 +204,28 @@ class NormalPermanentAlert(Alert):
 
 
 # ********** alert callback functions **********
+MAX_CACHED_ALERTS = 64
+
+
+def cached_alert(key: Callable[[car.CarParams, messaging.SubMaster, bool], Any]):
+  """Reuses the alert a callback made for the same key(CP, sm, metric), which
+     has to cover every input the alert depends on."""
+  def decorator(fn):
+    alerts: Dict[Any, Alert] = {}
+
+    def wrapper(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
+      k = key(CP, sm, metric)
+      alert = alerts.get(k)
+      if alert is None:
+        if len(alerts) >= MAX_CACHED_ALERTS:
+          alerts.clear()
+        alert = alerts[k] = fn(CP, sm, metric)
+      return alert
+    return wrapper
+  return decorator
+
+
+@cached_alert(lambda CP, sm, metric: (CP.minSteerSpeed, metric))
 def below_steer_speed_alert(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
   speed = int(round(CP.minSteerSpeed * (CV.MS_TO_KPH if metric else CV.MS_TO_MPH)))
   unit = "km/h" if metric else "mph"
@@ -193,6 +235,7 @@ def below_steer_speed_alert(CP: car.CarParams, sm: messaging.SubMaster, metric:
     AlertStatus.userPrompt, AlertSize.mid,
     Priority.MID, VisualAlert.steerRequired, AudibleAlert.chimePrompt, 0., 0.4, .3)
 #JPR
+@cached_alert(lambda CP, sm, metric: None)
 def flTPMS(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
   return Alert(
     "LOW FRONT LEFT TIRE PRESSURE",
@@ -200,6 +243,7 @@ def flTPMS(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
     AlertStatus.userPrompt, AlertSize.mid,
     Priority.MID, VisualAlert.none, AudibleAlert.chimePrompt, 0., 0.4, .3)
 
+@cached_alert(lambda CP, sm, metric: None)
 def frTPMS(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
   return Alert(
     "LOW FRONT RIGHT TIRE PRESSURE",
@@ -207,6 +251,7 @@ def frTPMS(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
     AlertStatus.userPrompt, AlertSize.mid,
     Priority.MID, VisualAlert.none, AudibleAlert.chimePrompt, 0., 0.4, .3)
 
+@cached_alert(lambda CP, sm, metric: None)
 def rlTPMS(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
   return Alert(  
     "LOW REAR LEFT TIRE PRESSURE",
@@ -214,6 +259,7 @@ def rlTPMS(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
     AlertStatus.userPrompt, AlertSize.mid,
     Priority.MID, VisualAlert.none, AudibleAlert.chimePrompt, 0., 0.4, .3)
 
+@cached_alert(lambda CP, sm, metric: None)
 def rrTPMS(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
   return Alert(
     "LOW REAR RIGHT TIRE PRESSURE",
@@ -221,6 +267,7 @@ def rrTPMS(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
     AlertStatus.userPrompt, AlertSize.mid,
     Priority.MID, VisualAlert.none, AudibleAlert.chimePrompt, 0., 0.4, .3)
 
+@cached_alert(lambda CP, sm, metric: (sm['liveCalibration'].calPerc, metric))
 def calibration_incomplete_alert(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
   speed = int(MIN_SPEED_FILTER * (CV.MS_TO_KPH if metric else CV.MS_TO_MPH))
   unit = "km/h" if metric else "mph"
@@ -231,6 +278,7 @@ def calibration_incomplete_alert(CP: car.CarParams, sm: messaging.SubMaster, met
     Priority.LOWEST, VisualAlert.none, AudibleAlert.none, 0., 0., .2)
 
 
+@cached_alert(lambda CP, sm, metric: sm['pandaState'].pandaType)
 def no_gps_alert(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
   gps_integrated = sm['pandaState'].pandaType in [log.PandaState.PandaType.uno, log.PandaState.PandaType.dos]
   return Alert(
@@ -240,6 +288,7 @@ def no_gps_alert(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Al
     Priority.LOWER, VisualAlert.none, AudibleAlert.none, 0., 0., .2, creation_delay=300.)
 
 
+@cached_alert(lambda CP, sm, metric: CP.carName)
 def wrong_car_mode_alert(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
   text = "Cruise Mode Disabled"
   if CP.carName == "honda":
@@ -247,6 +296,7 @@ def wrong_car_mode_alert(CP: car.CarParams, sm: messaging.SubMaster, metric: boo
   return NoEntryAlert(text, duration_hud_alert=0.)
 
 
+@cached_alert(lambda CP, sm, metric: CP.carFingerprint)
 def startup_fuzzy_fingerprint_alert(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
   return Alert(
     "WARNING: No Exact Match on Car Model",
@@ -254,6 +304,7 @@ def startup_fuzzy_fingerprint_alert(CP: car.CarParams, sm: messaging.SubMaster,
     AlertStatus.userPrompt, AlertSize.mid,
     Priority.LOWER, VisualAlert.none, AudibleAlert.none, 0., 0., 15.)
 
+@cached_alert(lambda CP, sm, metric: int(sm['lateralPlan'].autoLaneChangeTimer))
 def auto_lane_change_alert(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
   alc_timer = sm['lateralPlan'].autoLaneChangeTimer
   return Alert(
@@ -263,6 +314,7 @@ def auto_lane_change_alert(CP: car.CarParams, sm: messaging.SubMaster, metric: b
     Priority.LOWER, VisualAlert.steerRequired, AudibleAlert.none, 0., .1, .1, alert_rate=0.75)
 
 
+@cached_alert(lambda CP, sm, metric: tuple(round(a * 100.) for a in list(sm['testJoystick'].axes)[:2]))
 def joystick_alert(CP: car.CarParams, sm: messaging.SubMaster, metric: bool) -> Alert:
   axes = sm['testJoystick'].axes
   gb, steer = list(axes)[:2] if len(axes) else (0., 0.)
@@ -946,3 +998,9 @@ EVENTS: Dict[int, Dict[str, Union[Alert, Callable[[Any, messaging.SubMaster, boo
   },
 
 }
+
+# event types of every event as a bitmask, indexed by event id
+EVENT_TYPE_MASK = [0] * NUM_EVENTS
+for _e, _alerts in EVENTS.items():
+  for _et in _alerts:
+    EVENT_TYPE_MASK[_e] |= EVENT_TYPE_BIT[_et]
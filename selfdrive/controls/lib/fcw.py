@@ -1,10 +1,11 @@
 import math
 from collections import defaultdict
 
-from common.numpy_fast import interp
+from common.numpy_fast import InterpTable
 
 _FCW_A_ACT_V = [-3., -2.]
 _FCW_A_ACT_BP = [0., 30.]
+_FCW_A_ACT = InterpTable(_FCW_A_ACT_BP, _FCW_A_ACT_V)
 
 
 class FCWChecker():
@@ -62,7 +63,7 @@ class FCWChecker():
       self.counters['y_lead'] = self.counters['y_lead'] + 1 if abs(y_lead) < 1.0 else 0
       self.counters['vlat_lead'] = self.counters['vlat_lead'] + 1 if abs(vlat_lead) < 0.4 else 0
 
-      a_thr = interp(v_lead, _FCW_A_ACT_BP, _FCW_A_ACT_V)
+      a_thr = _FCW_A_ACT(v_lead)
       a_delta = min(mpc_solution_a[:15]) - min(0.0, a_ego)
 
       future_fcw_allowed = all(c >= 10 for c in self.counters.values())
@@ -3,7 +3,7 @@ import math
 import numpy as np
 from common.params import Params
 from common.realtime import sec_since_boot, DT_MDL
-from common.numpy_fast import interp, clip
+from common.numpy_fast import interp, clip, InterpTable
 from selfdrive.car.hyundai.values import CAR
 from selfdrive.ntune import ntune_common_get, ntune_common_enabled
 from selfdrive.swaglog import cloudlog
@@ -24,6 +24,8 @@ LOG_MPC = os.environ.get('LOG_MPC', False)
 LANE_CHANGE_SPEED_MIN = 20 * CV.MPH_TO_MS
 LANE_CHANGE_TIME_MAX = 10.
 
+HEADING_COST = InterpTable([5.0, 10.0], [MPC_COST_LAT.HEADING, 0.0])
+
 DESIRES = {
   LaneChangeDirection.none: {
     LaneChangeState.off: log.LateralPlan.Desire.none,
@@ -189,7 +191,7 @@ class LateralPlanner():
       d_path_xyz = self.path_xyz
       path_cost = np.clip(abs(self.path_xyz[0, 1] / self.path_xyz_stds[0, 1]), 0.5, 5.0) * MPC_COST_LAT.PATH
       # Heading cost is useful at low speed, otherwise end of plan can be off-heading
-      heading_cost = interp(v_ego, [5.0, 10.0], [MPC_COST_LAT.HEADING, 0.0])
+      heading_cost = HEADING_COST(v_ego)
       self.libmpc.set_weights(path_cost, heading_cost, ntune_common_get('steerRateCost'))
 
     y_pts = np.interp(v_ego * self.t_idxs[:LAT_MPC_N + 1], np.linalg.norm(d_path_xyz, axis=1), d_path_xyz[:,1])
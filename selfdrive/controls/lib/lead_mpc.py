@@ -1,6 +1,6 @@
 import math
 import numpy as np
-from common.numpy_fast import interp, clip
+from common.numpy_fast import interp, clip, InterpTable
 from common.realtime import sec_since_boot
 from selfdrive.modeld.constants import T_IDXS
 from selfdrive.controls.lib.radar_helpers import _LEAD_ACCEL_TAU
@@ -15,6 +15,9 @@ CRUISE_GAP_V = [1.3, 1.4, 1.8, 2.2]
 AUTO_TR_BP = [20.*CV.KPH_TO_MS, 50.*CV.KPH_TO_MS, 80.*CV.KPH_TO_MS, 130.*CV.KPH_TO_MS]
 AUTO_TR_V = [1.2, 1.3, 1.4, 1.5]
 
+CRUISE_GAP_TR = InterpTable(CRUISE_GAP_BP, CRUISE_GAP_V)
+AUTO_TR = InterpTable(AUTO_TR_BP, AUTO_TR_V)
+
 
 AUTO_TR_ENABLED = True
 AUTO_TR_CRUISE_GAP = 1
@@ -72,9 +75,9 @@ class LeadMpc():
     cruise_gap = int(clip(CS.cruiseGap, 1., 4.))
 
     if AUTO_TR_ENABLED and cruise_gap == AUTO_TR_CRUISE_GAP:
-      TR = interp(v_ego, AUTO_TR_BP, AUTO_TR_V)
+      TR = AUTO_TR(v_ego)
     else:
-      TR = interp(float(cruise_gap), CRUISE_GAP_BP, CRUISE_GAP_V)
+      TR = CRUISE_GAP_TR(float(cruise_gap))
 
     if lead is not None and lead.status:
       x_lead = lead.dRel
@@ -1,5 +1,5 @@
 import numpy as np
-from common.numpy_fast import clip, interp
+from common.numpy_fast import clip, InterpTable
 
 def apply_deadzone(error, deadzone):
   if error > deadzone:
@@ -13,10 +13,10 @@ def apply_deadzone(error, deadzone):
 class PIController():
   def __init__(self, k_p, k_i, k_f=None, pos_limit=None, neg_limit=None, rate=100, sat_limit=0.8, convert=None):
     if k_f is None:
-      k_f = [0., 1.]
-    self._k_p = k_p  # proportional gain
-    self._k_i = k_i  # integral gain
-    self._k_f = k_f  # feedforward gain
+      k_f = ([0.], [1.])
+    self._k_p = InterpTable(*k_p)  # proportional gain
+    self._k_i = InterpTable(*k_i)  # integral gain
+    self._k_f = InterpTable(*k_f)  # feedforward gain
 
     self.pos_limit = pos_limit
     self.neg_limit = neg_limit
@@ -31,15 +31,15 @@ class PIController():
 
   @property
   def k_p(self):
-    return interp(self.speed, self._k_p[0], self._k_p[1])
+    return self._k_p(self.speed)
 
   @property
   def k_i(self):
-    return interp(self.speed, self._k_i[0], self._k_i[1])
+    return self._k_i(self.speed)
 
   @property
   def k_f(self):
-    return interp(self.speed, self._k_f[0], self._k_f[1])
+    return self._k_f(self.speed)
 
   def _check_saturation(self, control, check_saturation, error):
     saturated = (control < self.neg_limit) or (control > self.pos_limit)
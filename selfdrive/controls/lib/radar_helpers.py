@@ -1,5 +1,5 @@
-from common.numpy_fast import mean
-from common.kalman.simple_kalman import KF1D
+import numpy as np
+
 from selfdrive.config import RADAR_TO_CAMERA
 
 
@@ -7,151 +7,152 @@ from selfdrive.config import RADAR_TO_CAMERA
 # TODO is this a good default?
 _LEAD_ACCEL_TAU = 1.5
 
-# radar tracks
-SPEED, ACCEL = 0, 1   # Kalman filter states enum
-
 # stationary qualification parameters
 v_ego_stationary = 4.   # no stationary object flag below this speed
 
 
-class Track():
-  def __init__(self, v_lead, kalman_params):
-    self.cnt = 0
-    self.aLeadTau = _LEAD_ACCEL_TAU
-    self.K_A = kalman_params.A
-    self.K_C = kalman_params.C
-    self.K_K = kalman_params.K
-    self.kf = KF1D([[v_lead], [0.0]], self.K_A, self.K_C, self.K_K)
-
-  def update(self, d_rel, y_rel, v_rel, v_lead, measured):
-    # relative values, copy
-    self.dRel = d_rel   # LONG_DIST
-    self.yRel = y_rel   # -LAT_DIST
-    self.vRel = v_rel   # REL_SPEED
+class Tracks():
+  # all radar tracks as a struct of arrays, sorted by track id
+  def __init__(self, kalman_params):
+    self.ids = np.zeros(0, dtype=np.int64)
+    self.dRel = np.zeros(0)      # LONG_DIST
+    self.yRel = np.zeros(0)      # -LAT_DIST
+    self.vRel = np.zeros(0)      # REL_SPEED
+    self.vLead = np.zeros(0)
+    self.measured = np.zeros(0, dtype=bool)  # measured or estimate
+    self.cnt = np.zeros(0, dtype=np.int64)
+    self.vLeadK = np.zeros(0)
+    self.aLeadK = np.zeros(0)
+    self.aLeadTau = np.zeros(0)
+
+    # Kalman filter states, one speed and accel per track
+    self.kf_v = np.zeros(0)
+    self.kf_a = np.zeros(0)
+
+    # same precomputed constant gain filter as KF1D
+    (A0_0, A0_1), (A1_0, A1_1) = kalman_params.A
+    C0_0, C0_1 = kalman_params.C
+    (self.K0_0,), (self.K1_0,) = kalman_params.K
+    self.A_K_0 = A0_0 - self.K0_0 * C0_0
+    self.A_K_1 = A0_1 - self.K0_0 * C0_1
+    self.A_K_2 = A1_0 - self.K1_0 * C0_0
+    self.A_K_3 = A1_1 - self.K1_0 * C0_1
+
+  def __len__(self):
+    return len(self.ids)
+
+  def update(self, ids, d_rel, y_rel, v_rel, v_lead, measured):
+    # inputs are arrays of the current radar points, sorted by id. Points that
+    # are gone drop their track, new points start one
+    idx = np.searchsorted(self.ids, ids)
+    known = np.zeros(len(ids), dtype=bool)
+    in_range = idx < len(self.ids)
+    known[in_range] = self.ids[idx[in_range]] == ids[in_range]
+    src = idx[known]
+
+    cnt = np.zeros(len(ids), dtype=np.int64)
+    cnt[known] = self.cnt[src]
+    kf_v = v_lead.copy()
+    kf_v[known] = self.kf_v[src]
+    kf_a = np.zeros(len(ids))
+    kf_a[known] = self.kf_a[src]
+    a_lead_tau = np.full(len(ids), _LEAD_ACCEL_TAU)
+    a_lead_tau[known] = self.aLeadTau[src]
+
+    # computed velocity and accelerations, new tracks keep their initial state
+    updated = cnt > 0
+    new_v = self.A_K_0 * kf_v + self.A_K_1 * kf_a + self.K0_0 * v_lead
+    new_a = self.A_K_2 * kf_v + self.A_K_3 * kf_a + self.K1_0 * v_lead
+    self.kf_v = np.where(updated, new_v, kf_v)
+    self.kf_a = np.where(updated, new_a, kf_a)
+
+    self.ids = ids
+    self.dRel = d_rel
+    self.yRel = y_rel
+    self.vRel = v_rel
     self.vLead = v_lead
-    self.measured = measured   # measured or estimate
-
-    # computed velocity and accelerations
-    if self.cnt > 0:
-      self.kf.update(self.vLead)
-
-    self.vLeadK = float(self.kf.x[SPEED][0])
-    self.aLeadK = float(self.kf.x[ACCEL][0])
+    self.measured = measured
+    self.vLeadK = self.kf_v.copy()
+    self.aLeadK = self.kf_a.copy()
 
     # Learn if constant acceleration
-    if abs(self.aLeadK) < 0.5:
-      self.aLeadTau = _LEAD_ACCEL_TAU
-    else:
-      self.aLeadTau *= 0.9
-
-    self.cnt += 1
+    self.aLeadTau = np.where(np.abs(self.aLeadK) < 0.5, _LEAD_ACCEL_TAU, a_lead_tau * 0.9)
+    self.cnt = cnt + 1
 
-  def get_key_for_cluster(self):
+  def get_keys_for_cluster(self):
     # Weigh y higher since radar is inaccurate in this dimension
-    return [self.dRel, self.yRel*2, self.vRel]
-
-  def reset_a_lead(self, aLeadK, aLeadTau):
-    self.kf = KF1D([[self.vLead], [aLeadK]], self.K_A, self.K_C, self.K_K)
-    self.aLeadK = aLeadK
-    self.aLeadTau = aLeadTau
-
-
-class Cluster():
-  def __init__(self):
-    self.tracks = set()
-
-  def add(self, t):
-    # add the first track
-    self.tracks.add(t)
-
-  # TODO: make generic
-  @property
-  def dRel(self):
-    return mean([t.dRel for t in self.tracks])
-
-  @property
-  def yRel(self):
-    return mean([t.yRel for t in self.tracks])
-
-  @property
-  def vRel(self):
-    return mean([t.vRel for t in self.tracks])
-
-  @property
-  def aRel(self):
-    return mean([t.aRel for t in self.tracks])
-
-  @property
-  def vLead(self):
-    return mean([t.vLead for t in self.tracks])
-
-  @property
-  def dPath(self):
-    return mean([t.dPath for t in self.tracks])
-
-  @property
-  def vLat(self):
-    return mean([t.vLat for t in self.tracks])
-
-  @property
-  def vLeadK(self):
-    return mean([t.vLeadK for t in self.tracks])
-
-  @property
-  def aLeadK(self):
-    if all(t.cnt <= 1 for t in self.tracks):
-      return 0.
-    else:
-      return mean([t.aLeadK for t in self.tracks if t.cnt > 1])
-
-  @property
-  def aLeadTau(self):
-    if all(t.cnt <= 1 for t in self.tracks):
-      return _LEAD_ACCEL_TAU
-    else:
-      return mean([t.aLeadTau for t in self.tracks if t.cnt > 1])
-
-  @property
-  def measured(self):
-    return any(t.measured for t in self.tracks)
-
-  def get_RadarState(self, model_prob=0.0):
+    return np.column_stack((self.dRel, self.yRel*2, self.vRel))
+
+  def reset_a_lead(self, mask, aLeadK, aLeadTau):
+    self.kf_v[mask] = self.vLead[mask]
+    self.kf_a[mask] = aLeadK
+    self.aLeadK[mask] = aLeadK
+    self.aLeadTau[mask] = aLeadTau
+
+
+class Clusters():
+  # means of the tracks in every cluster, computed for all clusters at once
+  def __init__(self, tracks, labels):
+    labels = np.asarray(labels, dtype=np.int64)
+    n = int(labels.max()) + 1 if len(labels) else 0
+    self.labels = labels
+    counts = np.bincount(labels, minlength=n)
+
+    def mean(x):
+      return np.bincount(labels, weights=x, minlength=n) / counts
+
+    self.dRel = mean(tracks.dRel)
+    self.yRel = mean(tracks.yRel)
+    self.vRel = mean(tracks.vRel)
+    self.vLead = mean(tracks.vLead)
+    self.vLeadK = mean(tracks.vLeadK)
+    self.measured = np.bincount(labels, weights=tracks.measured.astype(np.float64), minlength=n) > 0
+
+    # only tracks older than one frame have a useful accel
+    old = (tracks.cnt > 1).astype(np.float64)
+    old_counts = np.bincount(labels, weights=old, minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      self.aLeadK = np.where(old_counts > 0, np.bincount(labels, weights=tracks.aLeadK * old, minlength=n) / old_counts, 0.)
+      self.aLeadTau = np.where(old_counts > 0, np.bincount(labels, weights=tracks.aLeadTau * old, minlength=n) / old_counts,
+                               _LEAD_ACCEL_TAU)
+
+  def __len__(self):
+    return len(self.dRel)
+
+  def get_RadarState(self, i, model_prob=0.0):
     return {
-      "dRel": float(self.dRel),
-      "yRel": float(self.yRel),
-      "vRel": float(self.vRel),
-      "vLead": float(self.vLead),
-      "vLeadK": float(self.vLeadK),
-      "aLeadK": float(self.aLeadK),
+      "dRel": float(self.dRel[i]),
+      "yRel": float(self.yRel[i]),
+      "vRel": float(self.vRel[i]),
+      "vLead": float(self.vLead[i]),
+      "vLeadK": float(self.vLeadK[i]),
+      "aLeadK": float(self.aLeadK[i]),
       "status": True,
       "fcw": self.is_potential_fcw(model_prob),
       "modelProb": model_prob,
       "radar": True,
-      "aLeadTau": float(self.aLeadTau)
+      "aLeadTau": float(self.aLeadTau[i])
     }
 
-  def get_RadarState_from_vision(self, lead_msg, v_ego):
-    return {
-      "dRel": float(lead_msg.xyva[0] - RADAR_TO_CAMERA),
-      "yRel": float(-lead_msg.xyva[1]),
-      "vRel": float(lead_msg.xyva[2]),
-      "vLead": float(v_ego + lead_msg.xyva[2]),
-      "vLeadK": float(v_ego + lead_msg.xyva[2]),
-      "aLeadK": float(0),
-      "aLeadTau": _LEAD_ACCEL_TAU,
-      "fcw": False,
-      "modelProb": float(lead_msg.prob),
-      "radar": False,
-      "status": True
-    }
-
-  def __str__(self):
-    ret = "x: %4.1f  y: %4.1f  v: %4.1f  a: %4.1f" % (self.dRel, self.yRel, self.vRel, self.aLeadK)
-    return ret
-
-  def potential_low_speed_lead(self, v_ego):
+  def potential_low_speed_leads(self, v_ego):
     # stop for stuff in front of you and low speed, even without model confirmation
-    return abs(self.yRel) < 1.5 and (v_ego < v_ego_stationary) and self.dRel < 25
+    return (np.abs(self.yRel) < 1.5) & (v_ego < v_ego_stationary) & (self.dRel < 25)
 
   def is_potential_fcw(self, model_prob):
     return model_prob > .9
+
+
+def get_RadarState_from_vision(lead_msg, v_ego):
+  return {
+    "dRel": float(lead_msg.xyva[0] - RADAR_TO_CAMERA),
+    "yRel": float(-lead_msg.xyva[1]),
+    "vRel": float(lead_msg.xyva[2]),
+    "vLead": float(v_ego + lead_msg.xyva[2]),
+    "vLeadK": float(v_ego + lead_msg.xyva[2]),
+    "aLeadK": float(0),
+    "aLeadTau": _LEAD_ACCEL_TAU,
+    "fcw": False,
+    "modelProb": float(lead_msg.prob),
+    "radar": False,
+    "status": True
+  }
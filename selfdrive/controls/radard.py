@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 import importlib
-import math
-from collections import defaultdict, deque
+from collections import deque
+
+import numpy as np
 
 import cereal.messaging as messaging
 from cereal import car
@@ -10,7 +11,7 @@ from common.params import Params
 from common.realtime import Ratekeeper, Priority, config_realtime_process
 from selfdrive.config import RADAR_TO_CAMERA
 from selfdrive.controls.lib.cluster.fastcluster_py import cluster_points_centroid
-from selfdrive.controls.lib.radar_helpers import Cluster, Track
+from selfdrive.controls.lib.radar_helpers import Clusters, Tracks, get_RadarState_from_vision
 from selfdrive.swaglog import cloudlog
 from selfdrive.hardware import TICI
 
@@ -33,27 +34,24 @@ class KalmanParams():
 
 def laplacian_cdf(x, mu, b):
   b = max(b, 1e-4)
-  return math.exp(-abs(x-mu)/b)
+  return np.exp(-np.abs(x-mu)/b)
 
 
 def match_vision_to_cluster(v_ego, lead, clusters):
   # match vision point to best statistical cluster match
   offset_vision_dist = lead.xyva[0] - RADAR_TO_CAMERA
 
-  def prob(c):
-    prob_d = laplacian_cdf(c.dRel, offset_vision_dist, lead.xyvaStd[0])
-    prob_y = laplacian_cdf(c.yRel, -lead.xyva[1], lead.xyvaStd[1])
-    prob_v = laplacian_cdf(c.vRel, lead.xyva[2], lead.xyvaStd[2])
-
-    # This is isn't exactly right, but good heuristic
-    return prob_d * prob_y * prob_v
+  prob_d = laplacian_cdf(clusters.dRel, offset_vision_dist, lead.xyvaStd[0])
+  prob_y = laplacian_cdf(clusters.yRel, -lead.xyva[1], lead.xyvaStd[1])
+  prob_v = laplacian_cdf(clusters.vRel, lead.xyva[2], lead.xyvaStd[2])
 
-  cluster = max(clusters, key=prob)
+  # This is isn't exactly right, but good heuristic
+  cluster = int(np.argmax(prob_d * prob_y * prob_v))
 
   # if no 'sane' match is found return -1
   # stationary radar points can be false positives
-  dist_sane = abs(cluster.dRel - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
-  vel_sane = (abs(cluster.vRel - lead.xyva[2]) < 10) or (v_ego + cluster.vRel > 3)
+  dist_sane = abs(clusters.dRel[cluster] - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
+  vel_sane = (abs(clusters.vRel[cluster] - lead.xyva[2]) < 10) or (v_ego + clusters.vRel[cluster] > 3)
   if dist_sane and vel_sane:
     return cluster
   else:
@@ -69,18 +67,18 @@ def get_lead(v_ego, ready, clusters, lead_msg, low_speed_override=True):
 
   lead_dict = {'status': False}
   if cluster is not None:
-    lead_dict = cluster.get_RadarState(lead_msg.prob)
+    lead_dict = clusters.get_RadarState(cluster, lead_msg.prob)
   elif (cluster is None) and ready and (lead_msg.prob > .5):
-    lead_dict = Cluster().get_RadarState_from_vision(lead_msg, v_ego)
+    lead_dict = get_RadarState_from_vision(lead_msg, v_ego)
 
   if low_speed_override:
-    low_speed_clusters = [c for c in clusters if c.potential_low_speed_lead(v_ego)]
-    if len(low_speed_clusters) > 0:
-      closest_cluster = min(low_speed_clusters, key=lambda c: c.dRel)
+    low_speed = clusters.potential_low_speed_leads(v_ego)
+    if np.any(low_speed):
+      closest_cluster = int(np.argmin(np.where(low_speed, clusters.dRel, np.inf)))
 
       # Only choose new cluster if it is actually closer than the previous one
-      if (not lead_dict['status']) or (closest_cluster.dRel < lead_dict['dRel']):
-        lead_dict = closest_cluster.get_RadarState()
+      if (not lead_dict['status']) or (clusters.dRel[closest_cluster] < lead_dict['dRel']):
+        lead_dict = clusters.get_RadarState(closest_cluster)
 
   return lead_dict
 
@@ -89,8 +87,8 @@ class RadarD():
   def __init__(self, radar_ts, delay=0):
     self.current_time = 0
 
-    self.tracks = defaultdict(dict)
     self.kalman_params = KalmanParams(radar_ts)
+    self.tracks = Tracks(self.kalman_params)
 
     # v_ego
     self.v_ego = 0.
@@ -107,54 +105,32 @@ class RadarD():
     if sm.updated['modelV2']:
       self.ready = True
 
+    # the last point of a trackId wins
     ar_pts = {}
     for pt in rr.points:
-      ar_pts[pt.trackId] = [pt.dRel, pt.yRel, pt.vRel, pt.measured]
-
-    # *** remove missing points from meta data ***
-    for ids in list(self.tracks.keys()):
-      if ids not in ar_pts:
-        self.tracks.pop(ids, None)
-
-    # *** compute the tracks ***
-    for ids in ar_pts:
-      rpt = ar_pts[ids]
+      ar_pts[pt.trackId] = (pt.dRel, pt.yRel, pt.vRel, pt.measured)
 
-      # align v_ego by a fixed time to align it with the radar measurement
-      v_lead = rpt[2] + self.v_ego_hist[0]
+    ids = np.array(sorted(ar_pts), dtype=np.int64)
+    pts = np.array([ar_pts[i] for i in ids], dtype=np.float64).reshape(-1, 4)
 
-      # create the track if it doesn't exist or it's a new track
-      if ids not in self.tracks:
-        self.tracks[ids] = Track(v_lead, self.kalman_params)
-      self.tracks[ids].update(rpt[0], rpt[1], rpt[2], v_lead, rpt[3])
-
-    idens = list(sorted(self.tracks.keys()))
-    track_pts = list([self.tracks[iden].get_key_for_cluster() for iden in idens])
+    # *** compute the tracks, missing points are dropped ***
+    # align v_ego by a fixed time to align it with the radar measurement
+    v_lead = pts[:, 2] + self.v_ego_hist[0]
+    self.tracks.update(ids, pts[:, 0], pts[:, 1], pts[:, 2], v_lead, pts[:, 3] != 0)
 
     # If we have multiple points, cluster them
-    if len(track_pts) > 1:
-      cluster_idxs = cluster_points_centroid(track_pts, 2.5)
-      clusters = [None] * (max(cluster_idxs) + 1)
-
-      for idx in range(len(track_pts)):
-        cluster_i = cluster_idxs[idx]
-        if clusters[cluster_i] is None:
-          clusters[cluster_i] = Cluster()
-        clusters[cluster_i].add(self.tracks[idens[idx]])
-    elif len(track_pts) == 1:
-      # FIXME: cluster_point_centroid hangs forever if len(track_pts) == 1
-      cluster_idxs = [0]
-      clusters = [Cluster()]
-      clusters[0].add(self.tracks[idens[0]])
+    if len(self.tracks) > 1:
+      cluster_idxs = cluster_points_centroid(self.tracks.get_keys_for_cluster(), 2.5)
     else:
-      clusters = []
+      # FIXME: cluster_point_centroid hangs forever if len(track_pts) == 1
+      cluster_idxs = [0] * len(self.tracks)
+    clusters = Clusters(self.tracks, cluster_idxs)
 
     # if a new point, reset accel to the rest of the cluster
-    for idx in range(len(track_pts)):
-      if self.tracks[idens[idx]].cnt <= 1:
-        aLeadK = clusters[cluster_idxs[idx]].aLeadK
-        aLeadTau = clusters[cluster_idxs[idx]].aLeadTau
-        self.tracks[idens[idx]].reset_a_lead(aLeadK, aLeadTau)
+    new = self.tracks.cnt <= 1
+    if np.any(new):
+      new_clusters = clusters.labels[new]
+      self.tracks.reset_a_lead(new, clusters.aLeadK[new_clusters], clusters.aLeadTau[new_clusters])
 
     # *** publish radarState ***
     dat = messaging.new_message('radarState')
@@ -219,12 +195,12 @@ def radard_thread(sm=None, pm=None, can_sock=None):
     tracks = RD.tracks
     dat = messaging.new_message('liveTracks', len(tracks))
 
-    for cnt, ids in enumerate(sorted(tracks.keys())):
+    for cnt in range(len(tracks)):
       dat.liveTracks[cnt] = {
-        "trackId": ids,
-        "dRel": float(tracks[ids].dRel),
-        "yRel": float(tracks[ids].yRel),
-        "vRel": float(tracks[ids].vRel),
+        "trackId": int(tracks.ids[cnt]),
+        "dRel": float(tracks.dRel[cnt]),
+        "yRel": float(tracks.yRel[cnt]),
+        "vRel": float(tracks.vRel[cnt]),
       }
     pm.send('liveTracks', dat)
 
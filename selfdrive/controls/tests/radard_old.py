@@ -0,0 +1,249 @@
+# per-track radard from before the tracks were kept as arrays, the reference for test_radard
+import math
+from collections import defaultdict, deque
+
+import cereal.messaging as messaging
+from common.kalman.simple_kalman import KF1D
+from common.numpy_fast import mean
+from selfdrive.config import RADAR_TO_CAMERA
+from selfdrive.controls.lib.cluster.fastcluster_py import cluster_points_centroid
+from selfdrive.controls.lib.radar_helpers import _LEAD_ACCEL_TAU, v_ego_stationary
+from selfdrive.controls.radard import KalmanParams
+
+SPEED, ACCEL = 0, 1   # Kalman filter states enum
+
+
+class Track():
+  def __init__(self, v_lead, kalman_params):
+    self.cnt = 0
+    self.aLeadTau = _LEAD_ACCEL_TAU
+    self.K_A = kalman_params.A
+    self.K_C = kalman_params.C
+    self.K_K = kalman_params.K
+    self.kf = KF1D([[v_lead], [0.0]], self.K_A, self.K_C, self.K_K)
+
+  def update(self, d_rel, y_rel, v_rel, v_lead, measured):
+    self.dRel = d_rel
+    self.yRel = y_rel
+    self.vRel = v_rel
+    self.vLead = v_lead
+    self.measured = measured
+
+    if self.cnt > 0:
+      self.kf.update(self.vLead)
+
+    self.vLeadK = float(self.kf.x[SPEED][0])
+    self.aLeadK = float(self.kf.x[ACCEL][0])
+
+    if abs(self.aLeadK) < 0.5:
+      self.aLeadTau = _LEAD_ACCEL_TAU
+    else:
+      self.aLeadTau *= 0.9
+
+    self.cnt += 1
+
+  def get_key_for_cluster(self):
+    return [self.dRel, self.yRel*2, self.vRel]
+
+  def reset_a_lead(self, aLeadK, aLeadTau):
+    self.kf = KF1D([[self.vLead], [aLeadK]], self.K_A, self.K_C, self.K_K)
+    self.aLeadK = aLeadK
+    self.aLeadTau = aLeadTau
+
+
+class Cluster():
+  def __init__(self):
+    self.tracks = set()
+
+  def add(self, t):
+    self.tracks.add(t)
+
+  @property
+  def dRel(self):
+    return mean([t.dRel for t in self.tracks])
+
+  @property
+  def yRel(self):
+    return mean([t.yRel for t in self.tracks])
+
+  @property
+  def vRel(self):
+    return mean([t.vRel for t in self.tracks])
+
+  @property
+  def vLead(self):
+    return mean([t.vLead for t in self.tracks])
+
+  @property
+  def vLeadK(self):
+    return mean([t.vLeadK for t in self.tracks])
+
+  @property
+  def aLeadK(self):
+    if all(t.cnt <= 1 for t in self.tracks):
+      return 0.
+    else:
+      return mean([t.aLeadK for t in self.tracks if t.cnt > 1])
+
+  @property
+  def aLeadTau(self):
+    if all(t.cnt <= 1 for t in self.tracks):
+      return _LEAD_ACCEL_TAU
+    else:
+      return mean([t.aLeadTau for t in self.tracks if t.cnt > 1])
+
+  def get_RadarState(self, model_prob=0.0):
+    return {
+      "dRel": float(self.dRel),
+      "yRel": float(self.yRel),
+      "vRel": float(self.vRel),
+      "vLead": float(self.vLead),
+      "vLeadK": float(self.vLeadK),
+      "aLeadK": float(self.aLeadK),
+      "status": True,
+      "fcw": model_prob > .9,
+      "modelProb": model_prob,
+      "radar": True,
+      "aLeadTau": float(self.aLeadTau)
+    }
+
+  def get_RadarState_from_vision(self, lead_msg, v_ego):
+    return {
+      "dRel": float(lead_msg.xyva[0] - RADAR_TO_CAMERA),
+      "yRel": float(-lead_msg.xyva[1]),
+      "vRel": float(lead_msg.xyva[2]),
+      "vLead": float(v_ego + lead_msg.xyva[2]),
+      "vLeadK": float(v_ego + lead_msg.xyva[2]),
+      "aLeadK": float(0),
+      "aLeadTau": _LEAD_ACCEL_TAU,
+      "fcw": False,
+      "modelProb": float(lead_msg.prob),
+      "radar": False,
+      "status": True
+    }
+
+  def potential_low_speed_lead(self, v_ego):
+    return abs(self.yRel) < 1.5 and (v_ego < v_ego_stationary) and self.dRel < 25
+
+
+def laplacian_cdf(x, mu, b):
+  b = max(b, 1e-4)
+  return math.exp(-abs(x-mu)/b)
+
+
+def match_vision_to_cluster(v_ego, lead, clusters):
+  offset_vision_dist = lead.xyva[0] - RADAR_TO_CAMERA
+
+  def prob(c):
+    prob_d = laplacian_cdf(c.dRel, offset_vision_dist, lead.xyvaStd[0])
+    prob_y = laplacian_cdf(c.yRel, -lead.xyva[1], lead.xyvaStd[1])
+    prob_v = laplacian_cdf(c.vRel, lead.xyva[2], lead.xyvaStd[2])
+    return prob_d * prob_y * prob_v
+
+  cluster = max(clusters, key=prob)
+
+  dist_sane = abs(cluster.dRel - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
+  vel_sane = (abs(cluster.vRel - lead.xyva[2]) < 10) or (v_ego + cluster.vRel > 3)
+  if dist_sane and vel_sane:
+    return cluster
+  else:
+    return None
+
+
+def get_lead(v_ego, ready, clusters, lead_msg, low_speed_override=True):
+  if len(clusters) > 0 and ready and lead_msg.prob > .5:
+    cluster = match_vision_to_cluster(v_ego, lead_msg, clusters)
+  else:
+    cluster = None
+
+  lead_dict = {'status': False}
+  if cluster is not None:
+    lead_dict = cluster.get_RadarState(lead_msg.prob)
+  elif (cluster is None) and ready and (lead_msg.prob > .5):
+    lead_dict = Cluster().get_RadarState_from_vision(lead_msg, v_ego)
+
+  if low_speed_override:
+    low_speed_clusters = [c for c in clusters if c.potential_low_speed_lead(v_ego)]
+    if len(low_speed_clusters) > 0:
+      closest_cluster = min(low_speed_clusters, key=lambda c: c.dRel)
+
+      if (not lead_dict['status']) or (closest_cluster.dRel < lead_dict['dRel']):
+        lead_dict = closest_cluster.get_RadarState()
+
+  return lead_dict
+
+
+class RadarD():
+  def __init__(self, radar_ts, delay=0):
+    self.current_time = 0
+
+    self.tracks = defaultdict(dict)
+    self.kalman_params = KalmanParams(radar_ts)
+
+    self.v_ego = 0.
+    self.v_ego_hist = deque([0], maxlen=delay+1)
+
+    self.ready = False
+
+  def update(self, sm, rr, enable_lead):
+    self.current_time = 1e-9*max(sm.logMonoTime.values())
+
+    if sm.updated['carState']:
+      self.v_ego = sm['carState'].vEgo
+      self.v_ego_hist.append(self.v_ego)
+    if sm.updated['modelV2']:
+      self.ready = True
+
+    ar_pts = {}
+    for pt in rr.points:
+      ar_pts[pt.trackId] = [pt.dRel, pt.yRel, pt.vRel, pt.measured]
+
+    for ids in list(self.tracks.keys()):
+      if ids not in ar_pts:
+        self.tracks.pop(ids, None)
+
+    for ids in ar_pts:
+      rpt = ar_pts[ids]
+      v_lead = rpt[2] + self.v_ego_hist[0]
+      if ids not in self.tracks:
+        self.tracks[ids] = Track(v_lead, self.kalman_params)
+      self.tracks[ids].update(rpt[0], rpt[1], rpt[2], v_lead, rpt[3])
+
+    idens = list(sorted(self.tracks.keys()))
+    track_pts = list([self.tracks[iden].get_key_for_cluster() for iden in idens])
+
+    if len(track_pts) > 1:
+      cluster_idxs = cluster_points_centroid(track_pts, 2.5)
+      clusters = [None] * (max(cluster_idxs) + 1)
+
+      for idx in range(len(track_pts)):
+        cluster_i = cluster_idxs[idx]
+        if clusters[cluster_i] is None:
+          clusters[cluster_i] = Cluster()
+        clusters[cluster_i].add(self.tracks[idens[idx]])
+    elif len(track_pts) == 1:
+      cluster_idxs = [0]
+      clusters = [Cluster()]
+      clusters[0].add(self.tracks[idens[0]])
+    else:
+      clusters = []
+
+    for idx in range(len(track_pts)):
+      if self.tracks[idens[idx]].cnt <= 1:
+        aLeadK = clusters[cluster_idxs[idx]].aLeadK
+        aLeadTau = clusters[cluster_idxs[idx]].aLeadTau
+        self.tracks[idens[idx]].reset_a_lead(aLeadK, aLeadTau)
+
+    dat = messaging.new_message('radarState')
+    dat.valid = sm.all_alive_and_valid() and len(rr.errors) == 0
+    radarState = dat.radarState
+    radarState.mdMonoTime = sm.logMonoTime['modelV2']
+    radarState.canMonoTimes = list(rr.canMonoTimes)
+    radarState.radarErrors = list(rr.errors)
+    radarState.carStateMonoTime = sm.logMonoTime['carState']
+
+    if enable_lead:
+      if len(sm['modelV2'].leads) > 1:
+        radarState.leadOne = get_lead(self.v_ego, self.ready, clusters, sm['modelV2'].leads[0], low_speed_override=True)
+        radarState.leadTwo = get_lead(self.v_ego, self.ready, clusters, sm['modelV2'].leads[1], low_speed_override=False)
+    return dat
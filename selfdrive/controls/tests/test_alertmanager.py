@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import copy
+import unittest
+
+from common.realtime import DT_CTRL
+from selfdrive.controls.lib.alertmanager import AlertManager
+from selfdrive.controls.lib.events import Alert, AlertSize, AlertStatus, AudibleAlert, ET, Priority, VisualAlert
+
+
+def make_alert(alert_type, priority, duration=1., event_type=ET.WARNING):
+  alert = Alert(alert_type, "", AlertStatus.normal, AlertSize.small, priority,
+                VisualAlert.none, AudibleAlert.none, duration, duration, duration)
+  alert.alert_type = alert_type
+  alert.event_type = event_type
+  return alert
+
+
+class TestAlertManager(unittest.TestCase):
+  def test_refresh_in_place(self):
+    AM = AlertManager()
+    alert = make_alert("a/warning", Priority.LOW)
+    for frame in range(100):
+      AM.add_many(frame, [alert])
+      AM.process_alerts(frame)
+    self.assertEqual(len(AM.activealerts), 1)
+    self.assertEqual(AM.activealerts["a/warning"].start_time, 99 * DT_CTRL)
+    self.assertLess(len(AM.alert_heap), 20)
+
+    # the pooled copy is reused and the source alert isn't touched
+    pooled = AM.activealerts["a/warning"]
+    AM.add_many(100, [alert])
+    self.assertIs(AM.activealerts["a/warning"], pooled)
+    self.assertEqual(alert.start_time, 0.)
+
+  def test_selection(self):
+    AM = AlertManager()
+    low, mid, high = make_alert("low/warning", Priority.LOW), make_alert("mid/warning", Priority.MID), \
+                     make_alert("high/permanent", Priority.HIGH, .5, ET.PERMANENT)
+    AM.add_many(0, [low, high, mid])
+    AM.process_alerts(0)
+    self.assertEqual(AM.alert_type, "high/permanent")
+
+    # expired alerts fall through to the next priority
+    AM.process_alerts(int(.5 / DT_CTRL))
+    self.assertEqual(AM.alert_type, "mid/warning")
+
+    # the latest of equal priority alerts wins, ties go to the first added
+    other = copy.copy(mid)
+    other.alert_type = "other/warning"
+    AM.add_many(10, [other, mid])
+    AM.process_alerts(10)
+    self.assertEqual(AM.alert_type, "other/warning")
+
+    AM.process_alerts(10, ET.WARNING)
+    self.assertEqual(AM.alert_type, "")
+    self.assertEqual(len(AM.activealerts), 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+import random
+import unittest
+
+from selfdrive.controls.lib.events import ET, EVENTS, Events
+
+
+class TestEvents(unittest.TestCase):
+  def test_counts(self):
+    rnd = random.Random(0)
+    events = Events()
+    prev = dict.fromkeys(EVENTS.keys(), 0)
+    names = list(EVENTS.keys())
+    for _ in range(1000):
+      for e in rnd.sample(names, rnd.randint(0, 5)):
+        events.add(e)
+      for et in (ET.ENABLE, ET.WARNING, ET.SOFT_DISABLE, ET.NO_ENTRY):
+        self.assertEqual(events.any(et), any(et in EVENTS[e] for e in events.names))
+
+      # reference bookkeeping over all events
+      prev = {k: (v + 1 if k in events.names else 0) for k, v in prev.items()}
+      events.clear()
+      for k, v in prev.items():
+        self.assertEqual(events.events_prev[k], v)
+
+
+if __name__ == "__main__":
+  unittest.main()
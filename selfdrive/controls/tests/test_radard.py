@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import random
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+from selfdrive.controls.radard import RadarD
+from selfdrive.controls.tests.radard_old import RadarD as RadarD_old
+
+LEAD_FIELDS = ["dRel", "yRel", "vRel", "vLead", "vLeadK", "aLeadK", "aLeadTau", "modelProb"]
+
+
+class SubMaster(dict):
+  def __init__(self, v_ego, leads):
+    super().__init__(carState=SimpleNamespace(vEgo=v_ego), modelV2=SimpleNamespace(leads=leads))
+    self.updated = {'carState': True, 'modelV2': True}
+    self.logMonoTime = {'carState': 1, 'modelV2': 2}
+
+  def all_alive_and_valid(self):
+    return True
+
+
+def model_lead(rnd):
+  return SimpleNamespace(xyva=[rnd.uniform(5, 60), rnd.uniform(-2, 2), rnd.uniform(-5, 5), 0.],
+                         xyvaStd=[1., .5, 1., 1.], prob=rnd.random())
+
+
+class TestRadard(unittest.TestCase):
+  def assertLeadsEqual(self, old, new):
+    for lead in ("leadOne", "leadTwo"):
+      a, b = getattr(old.radarState, lead), getattr(new.radarState, lead)
+      self.assertEqual((a.status, a.radar, a.fcw), (b.status, b.radar, b.fcw))
+      # cluster means are summed in a different order
+      np.testing.assert_allclose([getattr(a, f) for f in LEAD_FIELDS], [getattr(b, f) for f in LEAD_FIELDS], rtol=1e-9, atol=1e-12)
+
+  def test_old_equal_new(self):
+    for seed in range(50):
+      rnd = random.Random(seed)
+      RD_old, RD = RadarD_old(0.05, 2), RadarD(0.05, 2)
+      tracks = {}
+      for _ in range(60):
+        # tracks come and go and drift, stationary ones at low speed hit the low speed override
+        sm = SubMaster(rnd.choice([0.5, 2., 3.5, 10., 25.]), [model_lead(rnd), model_lead(rnd)])
+        for k in list(tracks):
+          if rnd.random() < .1:
+            del tracks[k]
+        for _ in range(rnd.randint(0, 4)):
+          tracks[rnd.randint(0, 40)] = [rnd.uniform(2, 80), rnd.uniform(-4, 4), rnd.uniform(-10, 5)]
+        for k, (d, y, v) in tracks.items():
+          tracks[k] = [d + rnd.gauss(0, .3), y + rnd.gauss(0, .05), v + rnd.gauss(0, .5)]
+
+        points = [SimpleNamespace(trackId=k, dRel=d, yRel=y, vRel=v, measured=rnd.random() < .8) for k, (d, y, v) in tracks.items()]
+        if points and rnd.random() < .2:
+          points.append(points[0])  # a repeated trackId, the last one wins
+        rr = SimpleNamespace(points=points, errors=[], canMonoTimes=[])
+
+        self.assertLeadsEqual(RD_old.update(sm, rr, True), RD.update(sm, rr, True))
+
+
+if __name__ == "__main__":
+  unittest.main()
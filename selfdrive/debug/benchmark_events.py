@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# Time of one controlsd step of Events bookkeeping, next to a single pass over all
+# events, which is what the bookkeeping used to cost.
+import timeit
+
+SETUP = """
+from selfdrive.controls.lib.events import ET, Events, EventName
+events = Events()
+events.add(EventName.pcmEnable, static=True)
+events.add(EventName.doorOpen)
+events.add(EventName.seatbeltNotLatched)
+"""
+STEP = """
+events.any(ET.ENABLE)
+events.any(ET.SOFT_DISABLE)
+events.create_alerts([ET.PERMANENT])
+events.clear()
+events.add(EventName.doorOpen)
+events.add(EventName.seatbeltNotLatched)
+"""
+
+ALL_EVENTS_SETUP = "from selfdrive.controls.lib.events import EVENTS; prev = dict.fromkeys(EVENTS.keys(), 0)"
+ALL_EVENTS = "prev = {k: v + 1 for k, v in prev.items()}"
+
+if __name__ == "__main__":
+  number = 10000
+  step_time = min(timeit.repeat(STEP, setup=SETUP, number=number, repeat=5)) / number
+  all_events_time = min(timeit.repeat(ALL_EVENTS, setup=ALL_EVENTS_SETUP, number=number, repeat=5)) / number
+  print(f"events step: {step_time * 1e6:.2f} us")
+  print(f"pass over all events: {all_events_time * 1e6:.2f} us")
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# Replays the fingerprints of a few cars as CAN traffic through the fingerprint
+# index and through the old scan of every fingerprint of every candidate.
+import random
+import timeit
+
+from cereal import log
+from selfdrive.car.fingerprints import _FINGERPRINTS, _DEBUG_ADDRESS, all_legacy_fingerprint_cars, \
+                                       get_fingerprint_index, is_valid_for_fingerprint
+
+CanData = log.CanData
+
+
+def eliminate_reference(msg, candidate_cars):
+  return [c for c in candidate_cars if any(is_valid_for_fingerprint(msg, {**f, **_DEBUG_ADDRESS}) for f in _FINGERPRINTS[c])]
+
+
+def fingerprint_traffic(car_name, frames=200):
+  fingerprint = random.Random(car_name).choice(_FINGERPRINTS[car_name])
+  msgs = [CanData.new_message(address=adr, dat=b"\x00" * length, src=0) for adr, length in fingerprint.items()]
+  return [msgs] * frames
+
+
+if __name__ == "__main__":
+  index = get_fingerprint_index()
+  all_cars = all_legacy_fingerprint_cars()
+  traffic = [fingerprint_traffic(c) for c in random.Random(1).sample(all_cars, 5)]
+
+  def replay_index():
+    for frames in traffic:
+      candidates = index.all
+      for msgs in frames:
+        for msg in msgs:
+          candidates = index.eliminate(msg, candidates)
+
+  def replay_reference():
+    for frames in traffic:
+      candidates = all_cars
+      for msgs in frames:
+        for msg in msgs:
+          candidates = eliminate_reference(msg, candidates)
+
+  index_time = min(timeit.repeat(replay_index, number=1, repeat=5))
+  reference_time = min(timeit.repeat(replay_reference, number=1, repeat=5))
+  print(f"fingerprint replay of {len(traffic)} cars, {len(traffic[0])} frames each")
+  print(f"index: {index_time * 1e3:.1f} ms, reference: {reference_time * 1e3:.1f} ms")
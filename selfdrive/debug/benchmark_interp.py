@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Compares the old linear scan interp, numpy_fast.interp, InterpTable and np.interp
+# on the breakpoint tables the controls use every frame.
+import random
+import timeit
+
+import numpy as np
+
+from common.numpy_fast import interp, InterpTable
+from selfdrive.config import Conversions as CV
+from selfdrive.controls.lib.drive_helpers import CONTROL_N, MAX_CURVATURE_RATE_SPEEDS, MAX_CURVATURE_RATES
+from selfdrive.controls.lib.fcw import _FCW_A_ACT_BP, _FCW_A_ACT_V
+from selfdrive.controls.lib.lead_mpc import AUTO_TR_BP, AUTO_TR_V
+from selfdrive.controls.lib.longitudinal_planner import A_CRUISE_MAX_BP, A_CRUISE_MAX_VALS
+from selfdrive.modeld.constants import T_IDXS
+
+N = 100000
+
+TABLES = {
+  "A_CRUISE_MAX": (A_CRUISE_MAX_BP, A_CRUISE_MAX_VALS),
+  "AUTO_TR": (AUTO_TR_BP, AUTO_TR_V),
+  "MAX_CURVATURE_RATE": (MAX_CURVATURE_RATE_SPEEDS, MAX_CURVATURE_RATES),
+  "FCW_A_ACT": (_FCW_A_ACT_BP, _FCW_A_ACT_V),
+  # hyundai gasMax
+  "gasMax": ([0., 10.*CV.KPH_TO_MS, 20.*CV.KPH_TO_MS, 50.*CV.KPH_TO_MS, 70.*CV.KPH_TO_MS, 130.*CV.KPH_TO_MS],
+             [0.6, 0.65, 0.55, 0.45, 0.35, 0.25]),
+  "T_IDXS": (T_IDXS[:CONTROL_N], list(range(CONTROL_N))),
+}
+
+
+def interp_old(x, xp, fp):
+  N = len(xp)
+
+  def get_interp(xv):
+    hi = 0
+    while hi < N and xv > xp[hi]:
+      hi += 1
+    low = hi - 1
+    return fp[-1] if hi == N and xv > xp[low] else (
+      fp[0] if hi == 0 else
+      (xv - xp[low]) * (fp[hi] - fp[low]) / (xp[hi] - xp[low]) + fp[low])
+
+  return [get_interp(v) for v in x] if hasattr(x, '__iter__') else get_interp(x)
+
+
+def bench(fn, n=N):
+  return min(timeit.repeat(fn, number=n, repeat=5)) / n * 1e9
+
+
+if __name__ == "__main__":
+  print(f"{'table':20s} {'size':>4s} {'old':>8s} {'interp':>8s} {'table':>8s} {'np':>8s}   ns per scalar lookup")
+  for name, (xp, fp) in TABLES.items():
+    table = InterpTable(xp, fp)
+    xs = [random.uniform(xp[0], xp[-1]) for _ in range(N)]
+    x = xs[N // 2]
+    assert interp_old(xs, xp, fp) == interp(xs, xp, fp) == list(table(xs))
+
+    print(f"{name:20s} {len(xp):4d} "
+          f"{bench(lambda: interp_old(x, xp, fp)):8.0f} "
+          f"{bench(lambda: interp(x, xp, fp)):8.0f} "
+          f"{bench(lambda: table(x)):8.0f} "
+          f"{bench(lambda: np.interp(x, xp, fp)):8.0f}")
+
+  print()
+  print(f"{'batch':20s} {'size':>4s} {'old':>8s} {'interp':>8s} {'table':>8s} {'np':>8s}   us per {CONTROL_N} points")
+  for name, (xp, fp) in TABLES.items():
+    table = InterpTable(xp, fp)
+    xs = [random.uniform(xp[0], xp[-1]) for _ in range(CONTROL_N)]
+    xs_arr = np.array(xs)
+    print(f"{name:20s} {len(xp):4d} "
+          f"{bench(lambda: interp_old(xs, xp, fp), N // 10) / 1e3:8.2f} "
+          f"{bench(lambda: interp(xs, xp, fp), N // 10) / 1e3:8.2f} "
+          f"{bench(lambda: table.batch(xs_arr), N // 10) / 1e3:8.2f} "
+          f"{bench(lambda: np.interp(xs_arr, xp, fp), N // 10) / 1e3:8.2f}")
@@ -2,7 +2,7 @@
 
 import sys
 from tools.lib.route import Route
-from tools.lib.logreader import MultiLogIterator
+from tools.lib.logreader import RouteLogReader
 
 
 def get_fingerprint(lr):
@@ -41,5 +41,5 @@ if __name__ == "__main__":
     sys.exit(1)
 
   route = Route(sys.argv[1])
-  lr = MultiLogIterator(route.log_paths()[:5], wraparound=False)
+  lr = RouteLogReader(route.log_paths()[:5], services={'carParams', 'can'})
   get_fingerprint(lr)
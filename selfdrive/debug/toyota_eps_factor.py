@@ -6,7 +6,7 @@ from sklearn import linear_model  # pylint: disable=import-error
 from selfdrive.car.toyota.values import STEER_THRESHOLD
 
 from tools.lib.route import Route
-from tools.lib.logreader import MultiLogIterator
+from tools.lib.logreader import RouteLogReader
 
 MIN_SAMPLES = 30 * 100
 
@@ -59,6 +59,6 @@ def get_eps_factor(lr, plot=False):
 
 if __name__ == "__main__":
   r = Route(sys.argv[1])
-  lr = MultiLogIterator(r.log_paths(), wraparound=False)
+  lr = RouteLogReader(r.log_paths(), services={'can'})
   n = get_eps_factor(lr, plot="--plot" in sys.argv)
   print("EPS torque factor: ", n)
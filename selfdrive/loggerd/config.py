@@ -9,6 +9,11 @@ elif PC:
 else:
   ROOT = '/data/media/0/realdata/'
 
+# uploader's queue journal, next to ROOT so it's never taken for a segment
+UPLOAD_QUEUE_JOURNAL = os.path.join(os.path.dirname(os.path.normpath(ROOT)), "upload_queue.journal")
+# offsets of partly done resumable uploads
+UPLOAD_PROGRESS = os.path.join(os.path.dirname(os.path.normpath(ROOT)), "upload_progress.json")
+ATHENA_UPLOAD_PROGRESS = os.path.join(os.path.dirname(os.path.normpath(ROOT)), "athena_upload_progress.json")
 
 CAMERA_FPS = 20
 SEGMENT_LENGTH = 60
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+
+from selfdrive.loggerd import upload_engine
+from selfdrive.loggerd.upload_engine import NetworkType, UploadEngine
+
+CHUNK = 256 * 1024
+
+
+class UploadServer(ThreadingHTTPServer):
+  # stand-in for the upload endpoint, resumable when the request has a Content-Range
+  def __init__(self):
+    super().__init__(("127.0.0.1", 0), UploadHandler)
+    self.files = {}
+    self.received = 0
+    self.drop_chunks = set()  # chunk offsets the connection is dropped on, once
+    self.connections = set()
+    self.ranges = []
+    self.hold_final = 0  # times a complete upload is answered with 308 instead of finishing
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, *args):
+    pass
+
+  def do_PUT(self):
+    srv = self.server
+    srv.connections.add(self.client_address)
+    length = int(self.headers['Content-Length'])
+    content_range = self.headers.get('Content-Range')
+
+    if content_range is None:
+      srv.files[self.path] = self.rfile.read(length)
+      srv.received += length
+      return self.reply(201)
+
+    dat = srv.files.setdefault(self.path, b'')
+    spec, total = content_range[len('bytes '):].split('/')
+    srv.ranges.append(spec)
+    if spec != '*':
+      start, end = map(int, spec.split('-'))
+      assert start <= end < int(total), content_range
+      if start in srv.drop_chunks:
+        srv.drop_chunks.discard(start)
+        self.rfile.read(length // 2)
+        srv.received += length // 2
+        self.close_connection = True
+        return
+      chunk = self.rfile.read(length)
+      srv.received += length
+      if start == len(dat):
+        dat = srv.files[self.path] = dat + chunk
+
+    if len(dat) == int(total):
+      if srv.hold_final:
+        srv.hold_final -= 1
+        return self.reply(308, {'Range': f'bytes=0-{len(dat) - 1}'})
+      return self.reply(201)
+    self.reply(308, {'Range': f'bytes=0-{len(dat) - 1}'} if len(dat) else {})
+
+  def reply(self, code, headers=None):
+    self.send_response(code)
+    for k, v in (headers or {}).items():
+      self.send_header(k, v)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+
+class TestUploadEngine(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.progress = os.path.join(self.tmp, "progress.json")
+    self.server = UploadServer()
+    self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.tmp)
+
+  def make_file(self, name, size):
+    fn = os.path.join(self.tmp, name)
+    with open(fn, "wb") as f:
+      f.write(os.urandom(size))
+    return fn
+
+  def read(self, fn):
+    with open(fn, "rb") as f:
+      return f.read()
+
+  def test_upload(self):
+    fn = self.make_file("rlog.bz2", 3 * CHUNK + 10)
+    resp = UploadEngine().upload(fn, self.url + "/plain", {})
+    self.assertEqual(resp.status_code, 201)
+    self.assertEqual(self.server.files["/plain"], self.read(fn))
+
+  @mock.patch.object(upload_engine, "MAX_CHUNK_SIZE", CHUNK)
+  def test_resume(self):
+    fn = self.make_file("fcamera.hevc", 5 * CHUNK + 10)
+    url = self.url + "/resumable"
+    self.server.drop_chunks = {2 * CHUNK}
+
+    with self.assertRaises(requests.exceptions.ConnectionError):
+      UploadEngine(progress_path=self.progress).upload(fn, url, {}, resumable=True)
+
+    # a new engine continues after the last confirmed chunk
+    engine = UploadEngine(progress_path=self.progress)
+    self.assertEqual(engine.progress.get(fn)['offset'], 2 * CHUNK)
+    resp = engine.upload(fn, url, {}, resumable=True)
+    self.assertEqual(resp.status_code, 201)
+    self.assertEqual(self.server.files["/resumable"], self.read(fn))
+    self.assertLess(self.server.received, 6 * CHUNK)
+    self.assertIsNone(engine.progress.get(fn))
+
+  @mock.patch.object(upload_engine, "MAX_CHUNK_SIZE", CHUNK)
+  def test_complete_without_finish(self):
+    # the last chunk is answered with a 308 covering the whole file
+    fn = self.make_file("fcamera.hevc", 2 * CHUNK)
+    engine = UploadEngine(progress_path=self.progress)
+    self.server.hold_final = 1
+    resp = engine.upload(fn, self.url + "/held", {}, resumable=True)
+    self.assertEqual(resp.status_code, 201)
+    self.assertEqual(self.server.ranges, [f'0-{CHUNK - 1}', f'{CHUNK}-{2 * CHUNK - 1}', '*'])
+    self.assertIsNone(engine.progress.get(fn))
+
+    # the status query on resume says the server has it all
+    self.server.ranges = []
+    self.server.received = 0
+    self.server.hold_final = 1
+    engine.progress.set(fn, self.url + "/held", {}, CHUNK)
+    resp = engine.upload(fn, self.url + "/held", {}, resumable=True)
+    self.assertEqual(resp.status_code, 201)
+    self.assertEqual(self.server.ranges, ['*', '*'])
+    self.assertEqual(self.server.received, 0)
+    self.assertIsNone(engine.progress.get(fn))
+
+  def test_changed_file_restarts(self):
+    fn = self.make_file("qlog.bz2", CHUNK)
+    engine = UploadEngine(progress_path=self.progress)
+    engine.progress.set(fn, self.url + "/changed", {}, CHUNK // 2)
+    self.make_file("qlog.bz2", 2 * CHUNK)
+    self.assertIsNone(engine.progress.get(fn))
+
+  def test_bandwidth(self):
+    fn = self.make_file("qcamera.ts", 2 * upload_engine.BANDWIDTH[NetworkType.cell3G])
+    engine = UploadEngine()
+    engine.set_network_type(NetworkType.cell3G)
+    t = time.monotonic()
+    engine.upload(fn, self.url + "/slow", {})
+    # a second of burst, then the budget
+    self.assertGreater(time.monotonic() - t, 0.9)
+
+    engine.set_network_type(NetworkType.wifi)
+    t = time.monotonic()
+    engine.upload(fn, self.url + "/fast", {})
+    self.assertLess(time.monotonic() - t, 0.5)
+
+  def test_workers(self):
+    engine = UploadEngine(workers=2)
+    fns = [self.make_file(f"f{i}", CHUNK) for i in range(6)]
+    futures = [engine.submit(fn, f"{self.url}/{i}", {}) for i, fn in enumerate(fns)]
+    self.assertTrue(all(f.result(timeout=10).status_code == 201 for f in futures))
+    for i, fn in enumerate(fns):
+      self.assertEqual(self.server.files[f"/{i}"], self.read(fn))
+    # one kept alive connection per worker
+    self.assertEqual(len(self.server.connections), 2)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+
+from selfdrive.loggerd import xattr_cache
+from selfdrive.loggerd.upload_queue import UPLOAD_ATTR_NAME, UploadQueue
+from selfdrive.loggerd.xattr_cache import setxattr
+
+PRIORITY = {"qlog.bz2": (0, 0), "rlog.bz2": (1, 0), "fcamera.hevc": (1, 1)}
+
+
+def priority(logname, name):
+  if name.endswith(".lock"):
+    return None
+  return PRIORITY.get(name, (2, 0))
+
+
+class TestUploadQueue(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.journal = self.root + ".journal"
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+    if os.path.exists(self.journal):
+      os.unlink(self.journal)
+
+  def make_segment(self, part, names, locked=False):
+    d = os.path.join(self.root, f"2021-01-01--12-00-00--{part}")
+    os.mkdir(d)
+    if locked:
+      open(os.path.join(d, "rlog.bz2.lock"), "w").close()
+    for name in names:
+      with open(os.path.join(d, name), "w") as f:
+        f.write("data")
+    return d
+
+  def pop_all(self, queue, max_tier=2):
+    keys = []
+    while True:
+      queue.update()
+      d = queue.peek(max_tier)
+      if d is None:
+        return keys
+      setxattr(d[1], UPLOAD_ATTR_NAME, b'1')
+      queue.mark_done(d[0])
+      keys.append(d[0])
+
+  def test_order(self):
+    for part in [10, 2, 1]:
+      self.make_segment(part, ["other", "fcamera.hevc", "rlog.bz2", "qlog.bz2"])
+    queue = UploadQueue(self.root, priority)
+
+    seg = "2021-01-01--12-00-00--%d/%s"
+    self.assertEqual(self.pop_all(queue, max_tier=0), [seg % (p, "qlog.bz2") for p in [1, 2, 10]])
+    self.assertEqual(self.pop_all(queue), [seg % (p, n) for p in [1, 2, 10] for n in ["rlog.bz2", "fcamera.hevc"]] +
+                                          [seg % (p, "other") for p in [1, 2, 10]])
+
+  def test_locked_segment(self):
+    queue = UploadQueue(self.root, priority)
+    d = self.make_segment(0, ["qlog.bz2"], locked=True)
+    queue.update()
+    self.assertIsNone(queue.peek(2))
+
+    os.unlink(os.path.join(d, "rlog.bz2.lock"))
+    queue.update()
+    self.assertEqual(queue.peek(2)[0], "2021-01-01--12-00-00--0/qlog.bz2")
+
+  def test_skip(self):
+    self.make_segment(0, ["qlog.bz2", "rlog.bz2", "fcamera.hevc"])
+    queue = UploadQueue(self.root, priority)
+    seg = "2021-01-01--12-00-00--0/%s"
+
+    in_flight = {seg % "qlog.bz2", seg % "rlog.bz2"}
+    self.assertEqual(queue.peek(2, skip=in_flight)[0], seg % "fcamera.hevc")
+    self.assertIsNone(queue.peek(0, skip=in_flight))
+    # skipped files stay queued
+    self.assertEqual(queue.peek(2)[0], seg % "qlog.bz2")
+    self.assertEqual(queue.count(1), 2)
+
+  def test_deleted_segment(self):
+    d = self.make_segment(0, ["qlog.bz2", "rlog.bz2"])
+    queue = UploadQueue(self.root, priority)
+    self.assertEqual(queue.count(0) + queue.count(1), 2)
+
+    # removed by the deleter, another process, the queue notices and drops the cached attributes
+    self.assertTrue(any(p.startswith(d + "/") for p in xattr_cache._cache.attributes))
+    shutil.rmtree(d)
+    queue.update()
+    self.assertIsNone(queue.peek(2))
+    self.assertEqual(queue.count(0) + queue.count(1), 0)
+    self.assertFalse(any(p.startswith(d + "/") for p in xattr_cache._cache.attributes))
+
+  def test_journal(self):
+    for part in range(3):
+      self.make_segment(part, ["qlog.bz2", "rlog.bz2"])
+    queue = UploadQueue(self.root, priority, self.journal)
+    uploaded = self.pop_all(queue, max_tier=0)
+
+    # segments from the journal aren't listed again
+    shutil.rmtree(os.path.join(self.root, "2021-01-01--12-00-00--0"))
+    self.make_segment(3, ["qlog.bz2"])
+    listed = []
+    listdir = os.listdir
+    try:
+      os.listdir = lambda path: listed.append(path) or listdir(path)
+      queue = UploadQueue(self.root, priority, self.journal)
+    finally:
+      os.listdir = listdir
+    self.assertEqual(listed, [self.root, os.path.join(self.root, "2021-01-01--12-00-00--3")])
+
+    self.assertEqual(len(uploaded), 3)
+    self.assertEqual(self.pop_all(queue), ["2021-01-01--12-00-00--3/qlog.bz2"] +
+                                          [f"2021-01-01--12-00-00--{p}/rlog.bz2" for p in [1, 2]])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+
+from common.xattr import setxattr
+from selfdrive.loggerd.xattr_cache import XattrCache
+
+ATTR = 'user.upload'
+
+
+class TestXattrCache(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.files = []
+    for i in range(10):
+      fn = os.path.join(self.root, "seg", f"f{i}") if i < 5 else os.path.join(self.root, f"f{i}")
+      os.makedirs(os.path.dirname(fn), exist_ok=True)
+      open(fn, "w").close()
+      self.files.append(fn)
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def test_bounded(self):
+    cache = XattrCache(max_paths=4)
+    for _ in range(2):
+      for fn in self.files:
+        self.assertIsNone(cache.get(fn, ATTR))
+    info = cache.info()
+    self.assertEqual(info["paths"], 4)
+    self.assertEqual(info["misses"], 20)
+    self.assertEqual(info["evictions"], 16)
+
+    # recently used paths stay
+    cache.get(self.files[-1], ATTR)
+    self.assertEqual(cache.info()["hits"], 1)
+
+  def test_set(self):
+    cache = XattrCache()
+    fn = self.files[0]
+    self.assertIsNone(cache.get(fn, ATTR))
+    cache.set(fn, ATTR, b'1')
+    self.assertEqual(cache.get(fn, ATTR), b'1')
+    self.assertEqual(cache.info()["hits"], 1)
+
+    os.unlink(fn)
+    with self.assertRaises(OSError):
+      cache.set(fn, ATTR, b'1')
+    with self.assertRaises(OSError):
+      cache.get(fn, ATTR)
+
+  def test_invalidate(self):
+    cache = XattrCache()
+    for fn in self.files:
+      cache.get(fn, ATTR)
+
+    # changed by someone else
+    setxattr(self.files[-1], ATTR, b"1")
+    self.assertIsNone(cache.get(self.files[-1], ATTR))
+    cache.invalidate(self.files[-1])
+    self.assertEqual(cache.get(self.files[-1], ATTR), b'1')
+
+    shutil.rmtree(os.path.join(self.root, "seg"))
+    cache.invalidate_dir(os.path.join(self.root, "seg"))
+    info = cache.info()
+    self.assertEqual(info["paths"], 5)
+    self.assertEqual(info["invalidations"], 6)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,255 @@
+import os
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+
+from cereal import log
+from common.file_helpers import atomic_write_in_dir
+from selfdrive.swaglog import cloudlog
+
+NetworkType = log.DeviceState.NetworkType
+
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "2"))
+UPLOAD_TIMEOUT = 30  # seconds without progress on the connection
+
+# bandwidth budget in bytes/s by network type, None is unlimited
+BANDWIDTH = {
+  NetworkType.wifi: None,
+  NetworkType.ethernet: None,
+  NetworkType.cell5G: 4 * 1024 * 1024,
+  NetworkType.cell4G: 1024 * 1024,
+  NetworkType.cell3G: 128 * 1024,
+  NetworkType.cell2G: 16 * 1024,
+}
+
+# resumable uploads go in chunks of about this much transfer time, a dropped
+# connection only loses the chunk it was on
+CHUNK_SECONDS = 10
+CHUNK_ALIGN = 256 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+READ_BLOCK_SIZE = 64 * 1024
+
+
+def get_chunk_size(rate):
+  if rate is None:
+    return MAX_CHUNK_SIZE
+  chunk = (rate * CHUNK_SECONDS) // CHUNK_ALIGN * CHUNK_ALIGN
+  return min(max(chunk, CHUNK_ALIGN), MAX_CHUNK_SIZE)
+
+
+def parse_range(resp):
+  """Offset to continue from after a 308, from its 'Range: bytes=0-N' header"""
+  r = resp.headers.get('Range')
+  if not r or not r.startswith('bytes=') or '-' not in r:
+    return 0
+  return int(r.rsplit('-', 1)[1]) + 1
+
+
+class RateLimiter():
+  """Token bucket shared by all transfers, allows up to a second of burst"""
+  def __init__(self, rate=None):
+    self.lock = threading.Lock()
+    self.rate = rate
+    self.tokens = 0.
+    self.last = time.monotonic()
+
+  def set_rate(self, rate):
+    with self.lock:
+      if rate != self.rate:
+        self.rate = rate
+        self.tokens = 0.
+        self.last = time.monotonic()
+
+  def consume(self, n):
+    while True:
+      with self.lock:
+        if self.rate is None:
+          return
+        t = time.monotonic()
+        self.tokens = min(self.tokens + (t - self.last) * self.rate, max(self.rate, n))
+        self.last = t
+        if self.tokens >= n:
+          self.tokens -= n
+          return
+        wait = (n - self.tokens) / self.rate
+      time.sleep(min(wait, 1.))
+
+
+class ChunkReader():
+  """File-like view of length bytes of f from offset, paced by the rate limiter"""
+  def __init__(self, f, offset, length, limiter):
+    self.f = f
+    self.f.seek(offset)
+    self.length = length
+    self.remaining = length
+    self.limiter = limiter
+
+  def __len__(self):
+    return self.length
+
+  def read(self, n=-1):
+    if n < 0 or n > self.remaining:
+      n = self.remaining
+    n = min(n, READ_BLOCK_SIZE)
+    if n == 0:
+      return b''
+    self.limiter.consume(n)
+    dat = self.f.read(n)
+    self.remaining -= len(dat)
+    return dat
+
+
+class UploadProgress():
+  """Confirmed offsets of resumable uploads by path, in a json file so a restart
+     picks up where the last confirmed chunk ended"""
+  def __init__(self, path=None):
+    self.path = path
+    self.lock = threading.Lock()
+    self.entries = {}
+    if path is not None:
+      try:
+        with open(path) as f:
+          self.entries = json.load(f)
+      except (OSError, ValueError):
+        pass
+
+  def get(self, fn):
+    with self.lock:
+      entry = self.entries.get(fn)
+    if entry is None:
+      return None
+    # the file changed or is gone, the server has a different one
+    try:
+      st = os.stat(fn)
+    except OSError:
+      self.remove(fn)
+      return None
+    if (st.st_size, int(st.st_mtime)) != (entry['size'], entry['mtime']):
+      self.remove(fn)
+      return None
+    return entry
+
+  def set(self, fn, url, headers, offset):
+    st = os.stat(fn)
+    with self.lock:
+      self.entries[fn] = {'url': url, 'headers': headers, 'size': st.st_size, 'mtime': int(st.st_mtime), 'offset': offset}
+      self._save()
+
+  def remove(self, fn):
+    with self.lock:
+      if self.entries.pop(fn, None) is not None:
+        self._save()
+
+  def _save(self):
+    if self.path is None:
+      return
+    try:
+      with atomic_write_in_dir(self.path, overwrite=True) as f:
+        json.dump(self.entries, f)
+    except OSError:
+      cloudlog.exception("upload progress write failed")
+
+
+class UploadEngine():
+  """File uploads to presigned urls, shared by the uploader and athenad.
+
+     upload() is blocking and can be called from any thread, submit() runs it
+     on a small pool of workers. Every thread keeps its own session so the
+     connection is reused between uploads and chunks. All transfers share a
+     bandwidth budget set from the network type.
+
+     Resumable uploads are sent in chunks with Content-Range, the server
+     answers 308 with the Range it has until the last one. The confirmed
+     offset is persisted, a retry first asks the server for it. Servers
+     that don't speak this protocol get the whole file in one PUT."""
+  def __init__(self, workers=UPLOAD_WORKERS, progress_path=None):
+    self.workers = workers
+    self.limiter = RateLimiter()
+    self.progress = UploadProgress(progress_path)
+    self.local = threading.local()
+    self.jobs = queue.Queue()
+    self.threads = []
+
+  def set_network_type(self, network_type):
+    self.limiter.set_rate(BANDWIDTH.get(network_type, BANDWIDTH[NetworkType.cell4G]))
+
+  @property
+  def session(self):
+    if not hasattr(self.local, 'session'):
+      self.local.session = requests.Session()
+    return self.local.session
+
+  def submit(self, fn, url, headers, resumable=False):
+    """Queues the upload for a worker, returns a Future of the last response"""
+    if not self.threads:
+      for i in range(self.workers):
+        t = threading.Thread(target=self._worker, name=f'upload_worker_{i}', daemon=True)
+        t.start()
+        self.threads.append(t)
+    future = Future()
+    self.jobs.put((future, (fn, url, headers, resumable)))
+    return future
+
+  def _worker(self):
+    while True:
+      future, args = self.jobs.get()
+      if not future.set_running_or_notify_cancel():
+        continue
+      try:
+        future.set_result(self.upload(*args))
+      except Exception as e:
+        future.set_exception(e)
+
+  def upload(self, fn, url, headers, resumable=False):
+    with open(fn, "rb") as f:
+      size = os.fstat(f.fileno()).st_size
+      if resumable and size > 0:
+        return self._upload_resumable(fn, f, size, url, headers)
+      return self.session.put(url, data=ChunkReader(f, 0, size, self.limiter),
+                              headers={**headers, 'Content-Length': str(size)},
+                              timeout=UPLOAD_TIMEOUT)
+
+  def _query_status(self, url, headers, size):
+    return self.session.put(url, headers={**headers, 'Content-Range': f'bytes */{size}', 'Content-Length': '0'},
+                            timeout=UPLOAD_TIMEOUT)
+
+  def _upload_resumable(self, fn, f, size, url, headers):
+    offset = 0
+    entry = self.progress.get(fn)
+    if entry is not None and entry['url'] == url:
+      # the server has the final word on what it got
+      resp = self._query_status(url, headers, size)
+      if resp.status_code != 308:
+        self.progress.remove(fn)
+        return resp
+      offset = parse_range(resp)
+      cloudlog.event("upload_resume", fn=fn, offset=offset, size=size)
+
+    while offset < size:
+      length = min(get_chunk_size(self.limiter.rate), size - offset)
+      resp = self.session.put(url, data=ChunkReader(f, offset, length, self.limiter),
+                              headers={**headers,
+                                       'Content-Range': f'bytes {offset}-{offset + length - 1}/{size}',
+                                       'Content-Length': str(length)},
+                              timeout=UPLOAD_TIMEOUT)
+      if resp.status_code != 308:
+        if resp.status_code in (200, 201):
+          self.progress.remove(fn)
+        return resp
+
+      new_offset = parse_range(resp)
+      if new_offset <= offset:
+        return resp  # no progress, let the caller retry later
+      offset = new_offset
+      if offset < size:
+        self.progress.set(fn, url, headers, offset)
+
+    # the server has every byte but didn't finish the upload, there's nothing left to resume
+    resp = self._query_status(url, headers, size)
+    self.progress.remove(fn)
+    return resp
@@ -0,0 +1,371 @@
+import os
+import json
+import ctypes
+import heapq
+import struct
+
+from common.file_helpers import atomic_write_in_dir
+from selfdrive.loggerd.xattr_cache import getxattr, invalidate, invalidate_dir
+from selfdrive.swaglog import cloudlog
+
+UPLOAD_ATTR_NAME = 'user.upload'
+
+# inotify(7)
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CLOSE_WRITE = 0x00000008
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+ROOT_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+DIR_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_CLOSE_WRITE
+
+# journal lines past this many per segment trigger a rewrite
+JOURNAL_COMPACT_RATIO = 2
+
+
+def get_directory_sort(d):
+  return list(map(lambda s: s.rjust(10, '0'), d.rsplit('--', 1)))
+
+
+def is_segment(logname):
+  # segments are written once and unlocked when done, other dirs (crash, boot) get files any time
+  return '--' in logname
+
+
+class UploadQueue():
+  """Files under root waiting for upload, in a heap ordered by (tier, directory, name).
+
+     Completed segments never change, so they are scanned once when their lock goes away
+     and their pending files journaled. Only the root and directories still being written
+     are watched with inotify, without it they are listed on every update. Files uploaded
+     by someone else are dropped when they reach the top of the heap."""
+  def __init__(self, root, priority, journal_path=None):
+    # priority(logname, name) -> (tier, sort) or None when the file is never uploaded
+    self.root = root
+    self.priority = priority
+    self.journal_path = journal_path
+    self.journal = None
+    self.journal_lines = 0
+
+    # key -> heap entry of every pending file
+    self.pending = {}
+    self.heap = []
+    self.tier_count = {}
+    self.tier_size = {}
+
+    # logname -> keys of its pending files
+    self.dirs = {}
+    # segments scanned after they were done, from now on only deletion changes them
+    self.complete = set()
+    # directories that are watched or listed, and the locked ones among them
+    self.active = set()
+    self.locked = set()
+
+    self.fd = None
+    self.wds = {}
+    self.dir_wds = {}
+    self._inotify_init()
+
+    self.resync(self._load_journal())
+    self._compact_journal()
+
+  # *** inotify ***
+
+  def _inotify_init(self):
+    try:
+      self.libc = ctypes.CDLL(None, use_errno=True)
+      fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+      return
+    if fd >= 0:
+      self.fd = fd
+
+  def _watch(self, logname, mask):
+    if self.fd is None:
+      return
+    path = os.path.join(self.root, logname) if logname else self.root
+    wd = self.libc.inotify_add_watch(self.fd, path.encode(), mask)
+    if wd >= 0:
+      self.wds[wd] = logname
+      self.dir_wds[logname] = wd
+
+  def _unwatch(self, logname):
+    wd = self.dir_wds.pop(logname, None)
+    if wd is not None:
+      self.wds.pop(wd, None)
+      self.libc.inotify_rm_watch(self.fd, wd)
+
+  def _read_events(self):
+    events = []
+    while True:
+      try:
+        buf = os.read(self.fd, 65536)
+      except BlockingIOError:
+        return events
+
+      i = 0
+      while i + INOTIFY_EVENT.size <= len(buf):
+        wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(buf, i)
+        i += INOTIFY_EVENT.size
+        events.append((wd, mask, buf[i:i+name_len].rstrip(b'\0').decode()))
+        i += name_len
+
+  # *** state ***
+
+  def _push(self, logname, name, size=None):
+    key = os.path.join(logname, name)
+    if key in self.pending:
+      return
+    prio = self.priority(logname, name)
+    if prio is None:
+      return
+
+    if size is None:
+      fn = os.path.join(self.root, key)
+      # skip files already uploaded
+      try:
+        if getxattr(fn, UPLOAD_ATTR_NAME):
+          return
+        size = os.path.getsize(fn)
+      except OSError:
+        return  # deleter could have deleted
+
+    tier, sort = prio
+    entry = (tier, get_directory_sort(logname), sort, name, key, size)
+    self.pending[key] = entry
+    self.dirs.setdefault(logname, set()).add(key)
+    self.tier_count[tier] = self.tier_count.get(tier, 0) + 1
+    self.tier_size[tier] = self.tier_size.get(tier, 0) + size
+    heapq.heappush(self.heap, entry)
+
+  def _remove(self, key):
+    entry = self.pending.pop(key, None)
+    if entry is None:
+      return None
+    tier = entry[0]
+    self.tier_count[tier] -= 1
+    self.tier_size[tier] -= entry[-1]
+    logname = os.path.dirname(key)
+    keys = self.dirs.get(logname)
+    if keys is not None:
+      keys.discard(key)
+
+    # stale heap entries are skipped lazily, compact when they outnumber the live ones
+    if len(self.heap) > 2 * len(self.pending) + 16:
+      self.heap = list(self.pending.values())
+      heapq.heapify(self.heap)
+    return entry
+
+  def _scan(self, logname):
+    """Lists a watched directory, returns False while it's locked"""
+    try:
+      names = os.listdir(os.path.join(self.root, logname))
+    except OSError:
+      return None
+
+    if any(name.endswith(".lock") for name in names):
+      self.locked.add(logname)
+      return False
+    self.locked.discard(logname)
+
+    for name in names:
+      self._push(logname, name)
+
+    # done segment, stop watching it
+    if is_segment(logname) and len(names):
+      self.active.discard(logname)
+      self._unwatch(logname)
+      self.complete.add(logname)
+      files = {self.pending[k][3]: self.pending[k][-1] for k in self.dirs.get(logname, ())}
+      self._journal({"seg": logname, "files": files})
+    return True
+
+  def _add_dir(self, logname):
+    if logname in self.complete or logname in self.active:
+      return
+    self.active.add(logname)
+    self._watch(logname, DIR_MASK)
+    if self._scan(logname) is None:
+      self._remove_dir(logname)
+
+  def _remove_dir(self, logname):
+    for key in list(self.dirs.pop(logname, ())):
+      self._remove(key)
+    invalidate_dir(os.path.join(self.root, logname))
+    self.active.discard(logname)
+    self.locked.discard(logname)
+    self._unwatch(logname)
+    if logname in self.complete:
+      self.complete.discard(logname)
+      self._journal({"rm": logname})
+
+  def resync(self, complete=None):
+    """Reconciles with a listing of the root, and rescans the directories being written"""
+    if self.fd is not None and '' not in self.dir_wds:
+      self._watch('', ROOT_MASK)
+
+    try:
+      lognames = set(os.listdir(self.root))
+    except OSError:
+      lognames = set()
+
+    # segments known from the journal don't need a scan
+    for logname, files in (complete or {}).items():
+      if logname in lognames:
+        self.complete.add(logname)
+        for name, size in files.items():
+          self._push(logname, name, size)
+
+    for logname in list(self.complete) + list(self.active):
+      if logname not in lognames:
+        self._remove_dir(logname)
+    for logname in sorted(lognames - self.complete, key=get_directory_sort):
+      if logname in self.active:
+        self._scan(logname)
+      else:
+        self._add_dir(logname)
+
+  def update(self):
+    """Applies the changes since the last update"""
+    if self.fd is None or '' not in self.dir_wds:
+      self.resync()
+      return
+
+    for wd, mask, name in self._read_events():
+      if mask & IN_Q_OVERFLOW:
+        self.resync()
+        continue
+
+      logname = self.wds.get(wd)
+      if logname is None:
+        continue
+      if mask & IN_IGNORED:
+        self.wds.pop(wd, None)
+        if self.dir_wds.get(logname) == wd:
+          del self.dir_wds[logname]
+        continue
+
+      if logname == '':
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+          self._add_dir(name)
+        elif mask & IN_ISDIR and mask & (IN_DELETE | IN_MOVED_FROM):
+          self._remove_dir(name)
+      elif name.endswith(".lock"):
+        if mask & (IN_CREATE | IN_MOVED_TO):
+          self.locked.add(logname)
+        elif logname in self.active:
+          self._scan(logname)
+      elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+        if logname not in self.locked:
+          self._push(logname, name)
+      elif mask & (IN_DELETE | IN_MOVED_FROM):
+        self._remove(os.path.join(logname, name))
+        invalidate(os.path.join(self.root, logname, name))
+
+    # directories that couldn't be watched
+    for logname in [d for d in self.active if d not in self.dir_wds]:
+      self._scan(logname)
+
+  def peek(self, max_tier, skip=()):
+    """Returns (key, fn) of the next file to upload with a tier up to max_tier, or None.
+       Keys in skip, files already being uploaded, are passed over."""
+    ret = None
+    skipped = []
+    uploaded = []
+    while len(self.heap):
+      entry = self.heap[0]
+      key = entry[4]
+      if self.pending.get(key) is not entry:
+        heapq.heappop(self.heap)
+        continue
+      if entry[0] > max_tier:
+        break
+      if key in skip:
+        skipped.append(heapq.heappop(self.heap))
+        continue
+
+      fn = os.path.join(self.root, key)
+      try:
+        is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME)
+      except OSError:
+        cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
+        is_uploaded = True  # deleter could have deleted
+      if not is_uploaded:
+        ret = key, fn
+        break
+      uploaded.append(heapq.heappop(self.heap)[4])
+
+    for entry in skipped:
+      heapq.heappush(self.heap, entry)
+    for key in uploaded:
+      self.mark_done(key)
+    return ret
+
+  def mark_done(self, key):
+    entry = self._remove(key)
+    if entry is not None and os.path.dirname(key) in self.complete:
+      self._journal({"done": key})
+
+  def count(self, tier):
+    return self.tier_count.get(tier, 0)
+
+  def size(self, tier):
+    return self.tier_size.get(tier, 0)
+
+  # *** journal ***
+
+  def _load_journal(self):
+    complete = {}
+    if self.journal_path is None:
+      return complete
+
+    try:
+      with open(self.journal_path) as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            continue  # cut off by a crash
+          if "seg" in entry:
+            complete[entry["seg"]] = entry["files"]
+          elif "done" in entry:
+            logname, name = os.path.split(entry["done"])
+            complete.get(logname, {}).pop(name, None)
+          elif "rm" in entry:
+            complete.pop(entry["rm"], None)
+    except OSError:
+      pass
+    return complete
+
+  def _journal(self, entry):
+    if self.journal is None:
+      return
+    self.journal.write(json.dumps(entry) + "\n")
+    self.journal.flush()
+    self.journal_lines += 1
+    if self.journal_lines > JOURNAL_COMPACT_RATIO * len(self.complete) + 64:
+      self._compact_journal()
+
+  def _compact_journal(self):
+    if self.journal_path is None:
+      return
+    if self.journal is not None:
+      self.journal.close()
+
+    try:
+      with atomic_write_in_dir(self.journal_path, overwrite=True) as f:
+        for logname in sorted(self.complete, key=get_directory_sort):
+          files = {self.pending[k][3]: self.pending[k][-1] for k in self.dirs.get(logname, ())}
+          f.write(json.dumps({"seg": logname, "files": files}) + "\n")
+      self.journal = open(self.journal_path, "a")
+      self.journal_lines = len(self.complete)
+    except OSError:
+      cloudlog.exception("upload queue journal write failed")
+      self.journal = None
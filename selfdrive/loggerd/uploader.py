@@ -2,10 +2,10 @@
 import json
 import os
 import random
-import requests
 import threading
 import time
 import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, wait
 from pathlib import Path
 
 from cereal import log
@@ -13,21 +13,26 @@ import cereal.messaging as messaging
 from common.api import Api
 from common.params import Params
 from selfdrive.hardware import TICI
-from selfdrive.loggerd.xattr_cache import getxattr, setxattr
-from selfdrive.loggerd.config import ROOT
+from selfdrive.loggerd.xattr_cache import cache_info, setxattr
+from selfdrive.loggerd.config import ROOT, UPLOAD_PROGRESS, UPLOAD_QUEUE_JOURNAL
+from selfdrive.loggerd.upload_engine import UPLOAD_WORKERS, UploadEngine
+from selfdrive.loggerd.upload_queue import UPLOAD_ATTR_NAME, UploadQueue, get_directory_sort
 from selfdrive.swaglog import cloudlog
 
 NetworkType = log.DeviceState.NetworkType
-UPLOAD_ATTR_NAME = 'user.upload'
 UPLOAD_ATTR_VALUE = b'1'
 
 allow_sleep = bool(os.getenv("UPLOADER_SLEEP", "1"))
 force_wifi = os.getenv("FORCEWIFI") is not None
 fake_upload = os.getenv("FAKEUPLOAD") is not None
 
+XATTR_CACHE_LOG_INTERVAL = 600.
+
+# upload queue tiers, every file of a tier goes before the next one
+TIER_IMMEDIATE = 0
+TIER_HIGH = 1
+TIER_RAW = 2
 
-def get_directory_sort(d):
-  return list(map(lambda s: s.rjust(10, '0'), d.rsplit('--', 1)))
 
 def listdir_by_creation(d):
   try:
@@ -50,30 +55,42 @@ def clear_locks(root):
 
 
 class Uploader():
-  def __init__(self, dongle_id, root):
+  def __init__(self, dongle_id, root, journal_path=None, progress_path=None, workers=UPLOAD_WORKERS):
     self.dongle_id = dongle_id
     self.api = Api(dongle_id)
     self.root = root
 
-    self.upload_thread = None
-
-    self.last_resp = None
-    self.last_exc = None
-
-    self.raw_size = 0
-    self.raw_count = 0
-    self.immediate_size = 0
-    self.immediate_count = 0
+    self.engine = UploadEngine(workers, progress_path)
+    # key -> (fn, size, start time, future) of the uploads running
+    self.in_flight = {}
 
     # stats for last successfully uploaded file
     self.last_time = 0
     self.last_speed = 0
     self.last_filename = ""
 
-    self.immediate_folders = ["crash/", "boot/"]
+    self.immediate_folders = ["crash", "boot"]
     self.immediate_priority = {"qlog.bz2": 0, "qcamera.ts": 1}
     self.high_priority = {"rlog.bz2": 0, "fcamera.hevc": 1, "dcamera.hevc": 2, "ecamera.hevc": 3}
 
+    self.queue = UploadQueue(root, self.get_upload_priority, journal_path)
+
+  @property
+  def immediate_count(self):
+    return self.queue.count(TIER_IMMEDIATE)
+
+  @property
+  def immediate_size(self):
+    return self.queue.size(TIER_IMMEDIATE)
+
+  @property
+  def raw_count(self):
+    return self.queue.count(TIER_HIGH) + self.queue.count(TIER_RAW)
+
+  @property
+  def raw_size(self):
+    return self.queue.size(TIER_HIGH) + self.queue.size(TIER_RAW)
+
   def get_upload_sort(self, name):
     if name in self.immediate_priority:
       return self.immediate_priority[name]
@@ -81,113 +98,62 @@ class Uploader():
       return self.high_priority[name] + 100
     return 1000
 
-  def list_upload_files(self):
-    if not os.path.isdir(self.root):
-      return
-
-    self.raw_size = 0
-    self.raw_count = 0
-    self.immediate_size = 0
-    self.immediate_count = 0
-
-    for logname in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logname)
-      try:
-        names = os.listdir(path)
-      except OSError:
-        continue
-
-      if any(name.endswith(".lock") for name in names):
-        continue
-
-      for name in sorted(names, key=self.get_upload_sort):
-        key = os.path.join(logname, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
-        try:
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME)
-        except OSError:
-          cloudlog.event("uploader_getxattr_failed", exc=self.last_exc, key=key, fn=fn)
-          is_uploaded = True  # deleter could have deleted
-        if is_uploaded:
-          continue
-
-        try:
-          if name in self.immediate_priority:
-            self.immediate_count += 1
-            self.immediate_size += os.path.getsize(fn)
-          else:
-            self.raw_count += 1
-            self.raw_size += os.path.getsize(fn)
-        except OSError:
-          pass
+  def get_upload_priority(self, logname, name):
+    if name.endswith('.lock') or name.endswith(".tmp"):
+      return None
 
-        yield (name, key, fn)
+    # qlog files first, then the full log files, rear and front camera files, then other files
+    if name in self.immediate_priority or logname in self.immediate_folders:
+      tier = TIER_IMMEDIATE
+    elif name in self.high_priority:
+      tier = TIER_HIGH
+    else:
+      tier = TIER_RAW
+    return tier, self.get_upload_sort(name)
 
   def next_file_to_upload(self, with_raw):
-    upload_files = list(self.list_upload_files())
-
-    # try to upload qlog files first
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority or any(f in fn for f in self.immediate_folders):
-        return (key, fn)
-
-    if with_raw:
-      # then upload the full log files, rear and front camera files
-      for name, key, fn in upload_files:
-        if name in self.high_priority:
-          return (key, fn)
-
-      # then upload other files
-      for name, key, fn in upload_files:
-        if not name.endswith('.lock') and not name.endswith(".tmp"):
-          return (key, fn)
-
-    return None
+    self.queue.update()
+    return self.queue.peek(TIER_RAW if with_raw else TIER_IMMEDIATE, skip=self.in_flight)
 
   def do_upload(self, key, fn):
-    try:
-      url_resp = self.api.get("v1.3/"+self.dongle_id+"/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
-      if url_resp.status_code == 412:
-        self.last_resp = url_resp
-        return
-
-      url_resp_json = json.loads(url_resp.text)
-      url = url_resp_json['url']
-      headers = url_resp_json['headers']
-      cloudlog.debug("upload_url v1.3 %s %s", url, str(headers))
-
-      if fake_upload:
-        cloudlog.debug("*** WARNING, THIS IS A FAKE UPLOAD TO %s ***" % url)
-
-        class FakeResponse():
-          def __init__(self):
-            self.status_code = 200
-
-        self.last_resp = FakeResponse()
-      else:
-        with open(fn, "rb") as f:
-          self.last_resp = requests.put(url, data=f, headers=headers, timeout=10)
-    except Exception as e:
-      self.last_exc = (e, traceback.format_exc())
-      raise
-
-  def normal_upload(self, key, fn):
-    self.last_resp = None
-    self.last_exc = None
-
-    try:
-      self.do_upload(key, fn)
-    except Exception:
-      pass
-
-    return self.last_resp
-
-  def upload(self, key, fn):
+    """Starts the upload of fn, returns a Future of the response"""
+    progress = self.engine.progress.get(fn)
+    if progress is not None:
+      # partly uploaded, continue on the same url
+      return self.engine.submit(fn, progress['url'], progress['headers'], resumable=True), True
+
+    url_resp = self.api.get("v1.3/"+self.dongle_id+"/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
+    if url_resp.status_code == 412:
+      return self.done_future(url_resp), False
+
+    url_resp_json = json.loads(url_resp.text)
+    url = url_resp_json['url']
+    headers = url_resp_json['headers']
+    cloudlog.debug("upload_url v1.3 %s %s", url, str(headers))
+
+    if fake_upload:
+      cloudlog.debug("*** WARNING, THIS IS A FAKE UPLOAD TO %s ***" % url)
+
+      class FakeResponse():
+        def __init__(self):
+          self.status_code = 200
+
+      return self.done_future(FakeResponse()), False
+    return self.engine.submit(fn, url, headers, resumable=url_resp_json.get('resumable', False)), False
+
+  @staticmethod
+  def done_future(resp):
+    future = Future()
+    future.set_result(resp)
+    return future
+
+  def start_upload(self, key, fn):
+    """Starts uploading a file, returns False when it failed right away"""
     try:
       sz = os.path.getsize(fn)
     except OSError:
       cloudlog.exception("upload: getsize failed")
+      self.queue.mark_done(key)
       return False
 
     cloudlog.event("upload", key=key, fn=fn, sz=sz)
@@ -199,28 +165,65 @@ class Uploader():
         # tag files of 0 size as uploaded
         setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
       except OSError:
-        cloudlog.event("uploader_setxattr_failed", exc=self.last_exc, key=key, fn=fn, sz=sz)
-      success = True
-    else:
-      start_time = time.monotonic()
-      cloudlog.debug("uploading %r", fn)
-      stat = self.normal_upload(key, fn)
-      if stat is not None and stat.status_code in (200, 201, 403, 412):
+        cloudlog.event("uploader_setxattr_failed", key=key, fn=fn, sz=sz)
+      self.queue.mark_done(key)
+      return True
+
+    cloudlog.debug("uploading %r", fn)
+    start_time = time.monotonic()
+    try:
+      future, resumed = self.do_upload(key, fn)
+    except Exception as e:
+      cloudlog.event("upload_failed", stat=None, exc=(e, traceback.format_exc()), key=key, fn=fn, sz=sz, debug=True)
+      return False
+    self.in_flight[key] = (fn, sz, start_time, future, resumed)
+    return True
+
+  def wait_uploads(self, timeout):
+    wait([u[3] for u in self.in_flight.values()], timeout=timeout, return_when=FIRST_COMPLETED)
+
+  def finish_uploads(self):
+    """Handles the uploads that finished, returns (key, success) of each of them"""
+    ret = []
+    for key, (fn, sz, start_time, future, resumed) in list(self.in_flight.items()):
+      if not future.done():
+        continue
+      del self.in_flight[key]
+
+      stat, exc = None, None
+      try:
+        stat = future.result()
+      except Exception as e:
+        exc = (e, "".join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+      # an expired url of a resumed upload is refused, it's retried with a new one
+      success_codes = (200, 201) if resumed else (200, 201, 403, 412)
+      if stat is not None and stat.status_code in success_codes:
         cloudlog.event("upload_success" if stat.status_code != 412 else "upload_ignored", key=key, fn=fn, sz=sz, debug=True)
         try:
           # tag file as uploaded
           setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
         except OSError:
-          cloudlog.event("uploader_setxattr_failed", exc=self.last_exc, key=key, fn=fn, sz=sz)
+          cloudlog.event("uploader_setxattr_failed", exc=exc, key=key, fn=fn, sz=sz)
+        self.queue.mark_done(key)
 
         self.last_filename = fn
         self.last_time = time.monotonic() - start_time
         self.last_speed = (sz / 1e6) / self.last_time
-        success = True
+        ret.append((key, True))
       else:
-        cloudlog.event("upload_failed", stat=stat, exc=self.last_exc, key=key, fn=fn, sz=sz, debug=True)
-        success = False
+        cloudlog.event("upload_failed", stat=stat, exc=exc, key=key, fn=fn, sz=sz, debug=True)
+        ret.append((key, False))
+    return ret
 
+  def upload(self, key, fn):
+    """Uploads a file and waits for it"""
+    if not self.start_upload(key, fn):
+      return False
+    success = True
+    while key in self.in_flight:
+      self.wait_uploads(1)
+      success = dict(self.finish_uploads()).get(key, success)
     return success
 
   def get_msg(self):
@@ -248,16 +251,43 @@ def uploader_fn(exit_event):
 
   sm = messaging.SubMaster(['deviceState'])
   pm = messaging.PubMaster(['uploaderState'])
-  uploader = Uploader(dongle_id, ROOT)
+  uploader = Uploader(dongle_id, ROOT, UPLOAD_QUEUE_JOURNAL, UPLOAD_PROGRESS)
+
+  def idle(timeout):
+    # wakes up early when an upload finishes
+    if len(uploader.in_flight):
+      uploader.wait_uploads(timeout)
+    elif allow_sleep:
+      time.sleep(timeout)
 
   backoff = 0.1
+  last_cache_log = time.monotonic()
   while not exit_event.is_set():
     sm.update(0)
 
+    if time.monotonic() - last_cache_log > XATTR_CACHE_LOG_INTERVAL:
+      cloudlog.event("uploader_xattr_cache", **cache_info())
+      last_cache_log = time.monotonic()
+
+    for _, success in uploader.finish_uploads():
+      if success:
+        backoff = 0.1
+      elif allow_sleep:
+        cloudlog.info("upload backoff %r", backoff)
+        time.sleep(backoff + random.uniform(0, backoff))
+        backoff = min(backoff*2, 120)
+
+      pm.send("uploaderState", uploader.get_msg())
+      cloudlog.info("upload done, success=%r", success)
+
     network_type = sm['deviceState'].networkType if not force_wifi else NetworkType.wifi
+    uploader.engine.set_network_type(network_type)
     if network_type == NetworkType.none:
-      if allow_sleep:
-        time.sleep(60 if params.get_bool("IsOffroad") else 5)
+      idle(60 if params.get_bool("IsOffroad") else 5)
+      continue
+
+    if len(uploader.in_flight) >= uploader.engine.workers:
+      idle(1)
       continue
 
     on_wifi = network_type == NetworkType.wifi
@@ -266,23 +296,17 @@ def uploader_fn(exit_event):
 
     d = uploader.next_file_to_upload(with_raw=allow_raw_upload and on_wifi and params.get_bool("IsOffroad"))
     if d is None:  # Nothing to upload
-      if allow_sleep:
-        time.sleep(60 if params.get_bool("IsOffroad") else 5)
+      idle(60 if params.get_bool("IsOffroad") else 5)
       continue
 
     key, fn = d
 
     cloudlog.debug("upload %r over %s", d, network_type)
-    success = uploader.upload(key, fn)
-    if success:
-      backoff = 0.1
-    elif allow_sleep:
+    if not uploader.start_upload(key, fn) and allow_sleep:
       cloudlog.info("upload backoff %r", backoff)
       time.sleep(backoff + random.uniform(0, backoff))
       backoff = min(backoff*2, 120)
 
-    pm.send("uploaderState", uploader.get_msg())
-    cloudlog.info("upload done, success=%r", success)
 def main():
   uploader_fn(threading.Event())
 
@@ -1,13 +1,105 @@
+import threading
+from collections import OrderedDict
+
 from common.xattr import getxattr as getattr1
 from common.xattr import setxattr as setattr1
 
-cached_attributes = {}
+# paths kept, least recently used ones are evicted past this
+MAX_CACHED_PATHS = 8192
+
+
+class XattrCache():
+  """LRU cache of extended attributes by path. Files removed or changed by other
+     processes have to be invalidated by whoever notices."""
+  def __init__(self, max_paths=MAX_CACHED_PATHS):
+    self.max_paths = max_paths
+    self.attributes = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  def _put(self, path, attr_name, value):
+    attrs = self.attributes.get(path)
+    if attrs is None:
+      attrs = self.attributes[path] = {}
+      if len(self.attributes) > self.max_paths:
+        self.attributes.popitem(last=False)
+        self.evictions += 1
+    else:
+      self.attributes.move_to_end(path)
+    attrs[attr_name] = value
+
+  def get(self, path, attr_name):
+    with self.lock:
+      attrs = self.attributes.get(path)
+      if attrs is not None and attr_name in attrs:
+        self.hits += 1
+        self.attributes.move_to_end(path)
+        return attrs[attr_name]
+      self.misses += 1
+
+    value = getattr1(path, attr_name)
+    with self.lock:
+      self._put(path, attr_name, value)
+    return value
+
+  def set(self, path, attr_name, attr_value):
+    try:
+      ret = setattr1(path, attr_name, attr_value)
+    except OSError:
+      self.invalidate(path)
+      raise
+    with self.lock:
+      self._put(path, attr_name, attr_value)
+    return ret
+
+  def invalidate(self, path):
+    with self.lock:
+      if self.attributes.pop(path, None) is not None:
+        self.invalidations += 1
+
+  def invalidate_dir(self, path):
+    prefix = path.rstrip('/') + '/'
+    with self.lock:
+      for p in [p for p in self.attributes if p.startswith(prefix)]:
+        del self.attributes[p]
+        self.invalidations += 1
+
+  def info(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        "paths": len(self.attributes),
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hits / lookups if lookups else 0.,
+        "evictions": self.evictions,
+        "invalidations": self.invalidations,
+      }
+
+
+_cache = XattrCache()
+
+
 def getxattr(path, attr_name):
-  if (path, attr_name) not in cached_attributes:
-    response = getattr1(path, attr_name)
-    cached_attributes[(path, attr_name)] = response
-  return cached_attributes[(path, attr_name)]
+  return _cache.get(path, attr_name)
+
 
 def setxattr(path, attr_name, attr_value):
-  cached_attributes.pop((path, attr_name), None)
-  return setattr1(path, attr_name, attr_value)
+  return _cache.set(path, attr_name, attr_value)
+
+
+def invalidate(path):
+  """Drops the cached attributes of a removed or externally changed file"""
+  _cache.invalidate(path)
+
+
+def invalidate_dir(path):
+  """Drops the cached attributes of everything under a removed directory"""
+  _cache.invalidate_dir(path)
+
+
+def cache_info():
+  return _cache.info()
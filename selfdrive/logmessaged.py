@@ -6,6 +6,8 @@ import cereal.messaging as messaging
 from common.logging_extra import SwagLogFileFormatter
 from selfdrive.swaglog import get_file_handler
 
+MAX_BATCH_RECORDS = 1024
+
 
 def main() -> NoReturn:
   log_handler = get_file_handler()
@@ -20,16 +22,22 @@ def main() -> NoReturn:
   pub_sock = messaging.pub_sock('logMessage')
 
   while True:
-    dat = b''.join(sock.recv_multipart())
-    level = dat[0]
-    record = dat[1:].decode("utf-8")
-    if level >= log_level:
-      log_handler.emit(record)
+    # python processes send batches as multipart messages, one record per part
+    parts = sock.recv_multipart()
+    try:
+      while len(parts) < MAX_BATCH_RECORDS:
+        parts += sock.recv_multipart(zmq.NOBLOCK)
+    except zmq.error.Again:
+      pass
+
+    records = [(dat[0], dat[1:].decode("utf-8")) for dat in parts]
+    log_handler.emit_batch([record for level, record in records if level >= log_level])
 
     # then we publish them
-    msg = messaging.new_message()
-    msg.logMessage = record
-    pub_sock.send(msg.to_bytes())
+    for _, record in records:
+      msg = messaging.new_message()
+      msg.logMessage = record
+      pub_sock.send(msg.to_bytes())
 
 
 if __name__ == "__main__":
@@ -1,12 +1,142 @@
 import os
-import fcntl
-import signal
 import json
+import time
+import ctypes
+import select
+import struct
+import threading
 import numpy as np
 
 CONF_PATH = '/data/ntune/'
 CONF_LQR_FILE = '/data/ntune/lat_lqr.json'
 
+# key: (min, max, default) of every tuning value, per group
+TUNE_SCHEMA = {
+  "common": {
+    "useLiveSteerRatio": (0., 1., 1.),
+    "steerRatio": (10.0, 20.0, 16.5),
+    "steerActuatorDelay": (0., 0.8, 0.1),
+    "steerRateCost": (0.1, 1.5, 0.4),
+    "cameraOffset": (-1.0, 1.0, 0.06),
+  },
+  "lqr": {
+    "scale": (500.0, 5000.0, 1800.0),
+    "ki": (0.0, 0.2, 0.01),
+    "dcGain": (0.002, 0.004, 0.0028),
+    "steerLimitTimer": (0.5, 3.0, 2.5),
+  },
+  "scc": {
+    "sccGasFactor": (0.5, 1.5, 1.0),
+    "sccBrakeFactor": (0.5, 1.5, 1.0),
+    "sccCurvatureFactor": (0.5, 1.5, 1.0),
+  },
+}
+
+# inotify(7)
+IN_CLOEXEC = 0o2000000
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# used where inotify isn't available
+POLL_INTERVAL = 1.0
+
+
+class TuneWatcher():
+  """Calls the callbacks of a file in a directory from a background thread
+     whenever the file is written. Uses inotify, or polls mtimes without it."""
+  def __init__(self, path):
+    self.path = path
+    self.callbacks = {}
+    self.mtimes = {}
+    self.lock = threading.Lock()
+    self.fd = self._inotify_init()
+
+    self.thread = threading.Thread(target=self._run, name="ntune_watcher", daemon=True)
+    self.thread.start()
+
+  def _inotify_init(self):
+    try:
+      libc = ctypes.CDLL(None, use_errno=True)
+      fd = libc.inotify_init1(IN_CLOEXEC)
+    except (OSError, AttributeError):
+      return None
+    if fd < 0:
+      return None
+    if libc.inotify_add_watch(fd, self.path.encode(), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+      os.close(fd)
+      return None
+    return fd
+
+  def _mtime(self, name):
+    try:
+      return os.path.getmtime(os.path.join(self.path, name))
+    except OSError:
+      return None
+
+  def add(self, fn, callback):
+    name = os.path.basename(fn)
+    with self.lock:
+      self.callbacks.setdefault(name, []).append(callback)
+      self.mtimes[name] = self._mtime(name)
+
+  def _wait_inotify(self):
+    select.select([self.fd], [], [])
+    buf = os.read(self.fd, 4096)
+
+    names = set()
+    i = 0
+    while i + INOTIFY_EVENT.size <= len(buf):
+      _, _, _, name_len = INOTIFY_EVENT.unpack_from(buf, i)
+      i += INOTIFY_EVENT.size
+      names.add(buf[i:i+name_len].rstrip(b'\0').decode())
+      i += name_len
+    return names
+
+  def _wait_poll(self):
+    time.sleep(POLL_INTERVAL)
+
+    names = set()
+    with self.lock:
+      for name in self.callbacks:
+        mtime = self._mtime(name)
+        if mtime != self.mtimes[name]:
+          self.mtimes[name] = mtime
+          names.add(name)
+    return names
+
+  def _run(self):
+    while True:
+      names = self._wait_inotify() if self.fd is not None else self._wait_poll()
+      with self.lock:
+        callbacks = [cb for name in names for cb in self.callbacks.get(name, [])]
+
+      for cb in callbacks:
+        try:
+          cb()
+        except Exception as ex:
+          print("exception", ex)
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def tune_watcher():
+  global _watcher
+  with _watcher_lock:
+    if _watcher is None:
+      _watcher = TuneWatcher(CONF_PATH)
+    return _watcher
+
+
+class TuneValues():
+  """Snapshot of a tuning config, every key is an attribute. Never modified,
+     a reload publishes a new one."""
+  def __init__(self, config, schema):
+    for key, v in config.items():
+      setattr(self, key, float(v) if key in schema else v)
+
 
 class nTune():
   def __init__(self, CP=None, controller=None, group=None):
@@ -16,9 +146,16 @@ class nTune():
     self.lqr = None
     self.group = group
 
+    # config and values are replaced as a whole on every change, version counts the changes
+    self.config = {}
+    self.values = None
+    self.version = 0
+    self.listeners = []
+
     if "LatControlLQR" in str(type(controller)):
       self.lqr = controller
       self.file = CONF_LQR_FILE
+      self.schema = TUNE_SCHEMA["lqr"]
       self.lqr.A = np.array([0., 1., -0.22619643, 1.21822268]).reshape((2, 2))
       self.lqr.B = np.array([-1.92006585e-04, 3.95603032e-05]).reshape((2, 1))
       self.lqr.C = np.array([1., 0.]).reshape((1, 2))
@@ -26,143 +163,94 @@ class nTune():
       self.lqr.L = np.array([0.33, 0.318]).reshape((2, 1))
     else:
       self.file = CONF_PATH + group + ".json"
+      self.schema = TUNE_SCHEMA["common" if group == "common" else "scc"]
 
     if not os.path.exists(CONF_PATH):
       os.makedirs(CONF_PATH)
 
     self.read()
+    tune_watcher().add(self.file, self.handler)
 
-    try:
-      signal.signal(signal.SIGIO, self.handler)
-      fd = os.open(CONF_PATH, os.O_RDONLY)
-      fcntl.fcntl(fd, fcntl.F_SETSIG, 0)
-      fcntl.fcntl(fd, fcntl.F_NOTIFY, fcntl.DN_MODIFY | fcntl.DN_CREATE | fcntl.DN_MULTISHOT)
-    except Exception as ex:
-      print("exception", ex)
-      pass
+  def handler(self):  # called by the watcher thread
+    if self.load():
+      self.invalidated = True
 
-  def handler(self, signum, frame):
-    try:
-      if os.path.isfile(self.file):
-        with open(self.file, 'r') as f:
-          self.config = json.load(f)
-          if self.checkValid():
-            self.write_config(self.config)
-
-    except Exception as ex:
-      print("exception", ex)
-      pass
-
-    self.invalidated = True
+  def add_listener(self, callback):
+    """callback(tune) is called from the watcher thread after every change."""
+    self.listeners.append(callback)
 
   def check(self):  # called by LatControlLQR.update
     if self.invalidated:
       self.invalidated = False
       self.update()
 
-  def read(self):
-
+  def load(self):
+    """Reads and validates the file, returns whether the config changed."""
     try:
-      if os.path.isfile(self.file):
-        with open(self.file, 'r') as f:
-          self.config = json.load(f)
-          if self.checkValid():
-            self.write_config(self.config)
-
-          self.update()
-      else:
-        self.write_default()
-
-        with open(self.file, 'r') as f:
-          self.config = json.load(f)
-          if self.checkValid():
-            self.write_config(self.config)
-          self.update()
-
-    except:
+      with open(self.file, 'r') as f:
+        config = json.load(f)
+      if self.checkValid(config):
+        self.write_config(config)
+    except Exception:
       return False
 
-    return True
+    return self.publish(config)
 
-  def checkValue(self, key, min_, max_, default_):
-    updated = False
+  def publish(self, config):
+    if self.values is not None and config == self.config:
+      return False
 
-    if key not in self.config:
-      self.config.update({key: default_})
-      updated = True
-    elif min_ > self.config[key]:
-      self.config.update({key: min_})
-      updated = True
-    elif max_ < self.config[key]:
-      self.config.update({key: max_})
-      updated = True
+    self.values = TuneValues(config, self.schema)
+    self.config = config
+    self.version += 1
 
-    return updated
+    for listener in self.listeners:
+      listener(self)
+    return True
 
-  def checkValid(self):
+  def read(self):
 
-    if self.lqr is not None:
-      return self.checkValidLQR()
-    elif self.group == "common":
-      return self.checkValidCommon()
-    else:
-      return self.checkValidISCC()
+    if not os.path.isfile(self.file):
+      self.write_default()
 
-  def update(self):
+    ret = self.load()
+    if self.values is None:
+      # unreadable file, run with the defaults until it's fixed
+      config = self.read_cp()
+      self.checkValid(config)
+      self.publish(config)
 
-    if self.lqr is not None:
-      self.updateLQR()
+    self.update()
+    return ret
 
-  def checkValidCommon(self):
+  def checkValue(self, config, key, min_, max_, default_):
     updated = False
 
-    if self.checkValue("useLiveSteerRatio", 0., 1., 1.):
-      updated = True
-
-    if self.checkValue("steerRatio", 10.0, 20.0, 16.5):
-      updated = True
-
-    if self.checkValue("steerActuatorDelay", 0., 0.8, 0.1):
+    if key not in config:
+      config.update({key: default_})
       updated = True
-
-    if self.checkValue("steerRateCost", 0.1, 1.5, 0.4):
+    elif min_ > config[key]:
+      config.update({key: min_})
       updated = True
-
-    if self.checkValue("cameraOffset", -1.0, 1.0, 0.06):
+    elif max_ < config[key]:
+      config.update({key: max_})
       updated = True
 
     return updated
 
-  def checkValidLQR(self):
+  def checkValid(self, config):
     updated = False
 
-    if self.checkValue("scale", 500.0, 5000.0, 1800.0):
-      updated = True
-
-    if self.checkValue("ki", 0.0, 0.2, 0.01):
-      updated = True
-
-    if self.checkValue("dcGain", 0.002, 0.004, 0.0028):
-      updated = True
-
-    if self.checkValue("steerLimitTimer", 0.5, 3.0, 2.5):
-      updated = True
+    for key, (min_, max_, default_) in self.schema.items():
+      if self.checkValue(config, key, min_, max_, default_):
+        updated = True
 
     return updated
 
-  def checkValidISCC(self):
-    updated = False
-
-    if self.checkValue("sccGasFactor", 0.5, 1.5, 1.0):
-      updated = True
-
-    if self.checkValue("sccBrakeFactor", 0.5, 1.5, 1.0):
-      updated = True
-
-    if self.checkValue("sccCurvatureFactor", 0.5, 1.5, 1.0):
-      updated = True
+  def update(self):
 
-    return updated
+    if self.lqr is not None:
+      self.updateLQR()
 
   def updateLQR(self):
 
@@ -178,32 +266,34 @@ class nTune():
 
   def read_cp(self):
 
-    self.config = {}
+    config = {}
 
     try:
       if self.CP is not None:
 
         if self.CP.lateralTuning.which() == 'lqr' and self.lqr is not None:
-          self.config["scale"] = round(self.CP.lateralTuning.lqr.scale, 2)
-          self.config["ki"] = round(self.CP.lateralTuning.lqr.ki, 3)
-          self.config["dcGain"] = round(self.CP.lateralTuning.lqr.dcGain, 6)
-          self.config["steerLimitTimer"] = round(self.CP.steerLimitTimer, 2)
-          self.config["steerMax"] = round(self.CP.steerMaxV[0], 2)
+          config["scale"] = round(self.CP.lateralTuning.lqr.scale, 2)
+          config["ki"] = round(self.CP.lateralTuning.lqr.ki, 3)
+          config["dcGain"] = round(self.CP.lateralTuning.lqr.dcGain, 6)
+          config["steerLimitTimer"] = round(self.CP.steerLimitTimer, 2)
+          config["steerMax"] = round(self.CP.steerMaxV[0], 2)
         else:
-          self.config["useLiveSteerRatio"] = 1.
-          self.config["steerRatio"] = round(self.CP.steerRatio, 2)
-          self.config["steerActuatorDelay"] = round(self.CP.steerActuatorDelay, 2)
-          self.config["steerRateCost"] = round(self.CP.steerRateCost, 2)
+          config["useLiveSteerRatio"] = 1.
+          config["steerRatio"] = round(self.CP.steerRatio, 2)
+          config["steerActuatorDelay"] = round(self.CP.steerActuatorDelay, 2)
+          config["steerRateCost"] = round(self.CP.steerRateCost, 2)
 
     except:
       pass
 
+    return config
+
   def write_default(self):
 
     try:
-      self.read_cp()
-      self.checkValid()
-      self.write_config(self.config)
+      config = self.read_cp()
+      self.checkValid(config)
+      self.write_config(config)
     except:
       pass
 
@@ -226,22 +316,12 @@ class nTune():
 
 ntunes = {}
 def ntune_get(group, key):
-  global ntunes
-  if group not in ntunes:
-    ntunes[group] = nTune(group=group)
-
-  ntune = ntunes[group]
-
-  if ntune.config == None or key not in ntune.config:
-    ntune.read()
-
-  v = ntune.config[key]
-
-  if v is None:
-    ntune.read()
-    v = ntune.config[key]
+  # only touches the file the first time a group is used, reloads happen in the watcher thread
+  ntune = ntunes.get(group)
+  if ntune is None:
+    ntune = ntunes[group] = nTune(group=group)
 
-  return v
+  return getattr(ntune.values, key)
 
 def ntune_common_get(key):
   return ntune_get("common", key)
@@ -250,4 +330,4 @@ def ntune_common_enabled(key):
   return ntune_common_get(key) > 0.5
 
 def ntune_scc_get(key):
-  return ntune_get("scc", key)
\ No newline at end of file
+  return ntune_get("scc", key)
@@ -1,6 +1,10 @@
+import copy
 import logging
+import multiprocessing.util
 import os
+import threading
 import time
+from collections import deque
 from pathlib import Path
 from logging.handlers import BaseRotatingHandler
 
@@ -14,6 +18,12 @@ if PC:
 else:
   SWAGLOG_DIR = "/data/log/"
 
+# records a process keeps waiting for logmessaged, more are dropped
+MAX_BUFFERED_RECORDS = 4096
+MAX_BATCH_RECORDS = 256
+FLUSH_INTERVAL = 0.01  # seconds
+MAX_RETRY_INTERVAL = 1.  # seconds, logmessaged doesn't run unless LoggerEnabled is set
+
 def get_file_handler():
   Path(SWAGLOG_DIR).mkdir(parents=True, exist_ok=True)
   base_filename = os.path.join(SWAGLOG_DIR, "swaglog")
@@ -55,6 +65,18 @@ class SwaglogRotatingFileHandler(BaseRotatingHandler):
     time_exceeded = self.interval > 0 and self.last_rollover + self.interval <= time.monotonic()
     return size_exceeded or time_exceeded
 
+  def emit_batch(self, records):
+    """Writes records with a single write and flush"""
+    if not len(records):
+      return
+    try:
+      if self.shouldRollover(None):
+        self.doRollover()
+      self.stream.write("".join(self.format(record) + self.terminator for record in records))
+      self.stream.flush()
+    except Exception:
+      self.handleError(None)
+
   def doRollover(self):
     if self.stream:
       self.stream.close()
@@ -67,30 +89,120 @@ class SwaglogRotatingFileHandler(BaseRotatingHandler):
           os.remove(to_delete)
 
 class UnixDomainSocketHandler(logging.Handler):
-  def __init__(self, formatter):
+  """Sends records to logmessaged in batches. Callers only append the record
+     to a ring buffer, a background thread formats what piled up and sends it
+     as one multipart message. Records that don't fit in the buffer are
+     dropped and counted, the count goes out in a record of its own."""
+  def __init__(self, formatter, addr="ipc:///tmp/logmessage", max_records=MAX_BUFFERED_RECORDS):
     logging.Handler.__init__(self)
     self.setFormatter(formatter)
+    self.addr = addr
+    self.max_records = max_records
     self.pid = None
 
   def connect(self):
     self.zctx = zmq.Context()
     self.sock = self.zctx.socket(zmq.PUSH)
     self.sock.setsockopt(zmq.LINGER, 10)
-    self.sock.connect("ipc:///tmp/logmessage")
+    # no queueing in zmq while logmessaged is away, records wait in the buffer and drops are counted
+    self.sock.setsockopt(zmq.IMMEDIATE, 1)
+    self.sock.connect(self.addr)
+
+    # deque append and popleft are atomic, emit only takes a lock when it drops
+    self.buffer = deque()
+    self.buffer_lock = threading.Lock()
+    self.dropped = 0
+    # formatted batch that couldn't be sent yet
+    self.unsent = []
+    self.send_lock = threading.Lock()
+    self.wake = threading.Event()
     self.pid = os.getpid()
+    threading.Thread(target=self.flush_thread, name="swaglog_flush", daemon=True).start()
+    # runs at exit, also in multiprocessing children which leave through os._exit
+    multiprocessing.util.Finalize(self, self.flush_at_exit, exitpriority=0)
 
   def emit(self, record):
     if os.getpid() != self.pid:
       self.connect()
 
-    msg = self.format(record).rstrip('\n')
-    # print("SEND".format(repr(msg)))
-    try:
-      s = chr(record.levelno)+msg
-      self.sock.send(s.encode('utf8'), zmq.NOBLOCK)
-    except zmq.error.Again:
-      # drop :/
-      pass
+    if len(self.buffer) >= self.max_records:
+      with self.buffer_lock:
+        self.dropped += 1
+      return
+    self.buffer.append(self.prepare(record))
+    if not self.wake.is_set():
+      self.wake.set()
+
+  def prepare(self, record):
+    # the record is formatted later on the flush thread, take what could change by then
+    record = copy.copy(record)
+    if not isinstance(record.msg, dict):
+      try:
+        record.msg = record.getMessage()
+        record.args = None
+      except (ValueError, TypeError):
+        pass
+    record.swaglog_ctx = self.formatter.swaglogger.get_ctx()
+    if record.exc_info:
+      record.exc_text = self.formatter.formatException(record.exc_info)
+      record.exc_info = None
+    return record
+
+  def encode(self, record):
+    return (chr(record.levelno) + self.format(record).rstrip('\n')).encode('utf8')
+
+  def flush_thread(self):
+    retry_interval = FLUSH_INTERVAL
+    while True:
+      self.wake.wait()
+      # let a batch gather
+      time.sleep(FLUSH_INTERVAL)
+      self.wake.clear()
+      if self.flush():
+        retry_interval = FLUSH_INTERVAL
+      else:
+        # nothing is receiving, back off. Records that don't fit in the buffer meanwhile are counted as dropped
+        time.sleep(retry_interval)
+        retry_interval = min(2 * retry_interval, MAX_RETRY_INTERVAL)
+        self.wake.set()
+
+  def flush(self):
+    """Sends the buffered records, returns False when logmessaged isn't keeping up"""
+    if self.pid != os.getpid():
+      return True
+
+    with self.send_lock:
+      while len(self.unsent) or len(self.buffer):
+        if not len(self.unsent):
+          with self.buffer_lock:
+            dropped, self.dropped = self.dropped, 0
+          if dropped:
+            self.unsent.append(self.encode(self.dropped_record(dropped)))
+          for _ in range(min(len(self.buffer), MAX_BATCH_RECORDS)):
+            record = self.buffer.popleft()
+            try:
+              self.unsent.append(self.encode(record))
+            except Exception:
+              self.handleError(record)
+
+        try:
+          if len(self.unsent):
+            self.sock.send_multipart(self.unsent, zmq.NOBLOCK)
+          self.unsent = []
+        except zmq.error.Again:
+          return False
+    return True
+
+  def flush_at_exit(self):
+    # the connection could still be coming up in short lived processes
+    for _ in range(10):
+      if self.flush():
+        return
+      time.sleep(FLUSH_INTERVAL)
+
+  def dropped_record(self, count):
+    return logging.LogRecord(self.formatter.swaglogger.name, logging.WARNING, __file__, 0,
+                             {"event": "swaglog_dropped", "count": count}, None, None, "flush")
 
 
 def add_file_handler(log):
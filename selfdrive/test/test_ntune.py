@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import selfdrive.ntune as ntune
+
+
+class TestNTune(unittest.TestCase):
+  def setUp(self):
+    self.conf_path = tempfile.mkdtemp() + "/"
+    self.orig_conf_path = ntune.CONF_PATH
+    ntune.CONF_PATH = self.conf_path
+    ntune._watcher = None
+    ntune.ntunes.clear()
+
+  def tearDown(self):
+    ntune.CONF_PATH = self.orig_conf_path
+    ntune._watcher = None
+    ntune.ntunes.clear()
+    shutil.rmtree(self.conf_path)
+
+  def test_defaults(self):
+    self.assertEqual(ntune.ntune_scc_get("sccGasFactor"), 1.0)
+    with open(os.path.join(self.conf_path, "scc.json")) as f:
+      self.assertEqual(json.load(f)["sccGasFactor"], 1.0)
+
+  def test_reload(self):
+    tune = ntune.nTune(group="common")
+    version = tune.version
+    changes = []
+    tune.add_listener(changes.append)
+
+    config = dict(tune.config, steerRatio=14.0, cameraOffset=5.0)
+    with open(tune.file, "w") as f:
+      json.dump(config, f)
+
+    for _ in range(50):
+      if tune.version != version:
+        break
+      time.sleep(0.1)
+
+    self.assertEqual(tune.version, version + 1)
+    self.assertEqual(changes, [tune])
+    self.assertEqual(tune.values.steerRatio, 14.0)
+    # out of range values are clipped
+    self.assertEqual(tune.values.cameraOffset, 1.0)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import zmq
+
+from common.logging_extra import SwagFormatter, SwagLogger
+from selfdrive.swaglog import SwaglogRotatingFileHandler, UnixDomainSocketHandler
+
+
+class TestSwaglog(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.addr = f"ipc://{self.tmp}/logmessage"
+    self.ctx = zmq.Context()
+    self.sock = None
+
+  def tearDown(self):
+    if self.sock is not None:
+      self.sock.close(linger=0)
+    self.ctx.term()
+    shutil.rmtree(self.tmp)
+
+  def make_logger(self, **kwargs):
+    log = SwagLogger()
+    log.setLevel(logging.DEBUG)
+    handler = UnixDomainSocketHandler(SwagFormatter(log), addr=self.addr, **kwargs)
+    log.addHandler(handler)
+    return log, handler
+
+  def bind(self):
+    self.sock = self.ctx.socket(zmq.PULL)
+    self.sock.bind(self.addr)
+    self.sock.setsockopt(zmq.RCVTIMEO, 2000)
+
+  def recv_records(self, n):
+    records = []
+    while len(records) < n:
+      records += [(dat[0], json.loads(dat[1:])) for dat in self.sock.recv_multipart()]
+    return records
+
+  def test_batch(self):
+    self.bind()
+    log, handler = self.make_logger()
+    for i in range(300):
+      log.warning("record %d", i)
+
+    records = self.recv_records(300)
+    self.assertEqual([r["msg"] for _, r in records], [f"record {i}" for i in range(300)])
+    self.assertTrue(all(level == logging.WARNING for level, _ in records))
+
+  def test_dropped(self):
+    log, handler = self.make_logger(max_records=10)
+    # nothing is receiving, the first records wait in the buffer
+    for i in range(25):
+      log.error("record %d", i)
+    self.assertFalse(handler.flush())
+
+    self.bind()
+    for _ in range(100):
+      if handler.flush():
+        break
+      time.sleep(0.05)
+    records = self.recv_records(11)
+    self.assertEqual(records[0][1]["msg"], {"event": "swaglog_dropped", "count": 15})
+    self.assertEqual([r["msg"] for _, r in records[1:]], [f"record {i}" for i in range(10)])
+    self.assertEqual(handler.dropped, 0)
+
+  def test_no_receiver_backoff(self):
+    log, handler = self.make_logger()
+    flushes = []
+    flush = handler.flush
+    handler.flush = lambda: flushes.append(time.monotonic()) or flush()
+    log.warning("record")
+    time.sleep(2)
+    # retries get further apart instead of polling every FLUSH_INTERVAL
+    self.assertLess(len(flushes), 12)
+    self.assertGreater(flushes[-1] - flushes[-2], 0.5)
+
+  def test_file_batch(self):
+    handler = SwaglogRotatingFileHandler(os.path.join(self.tmp, "swaglog"))
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.emit_batch([logging.makeLogRecord({"msg": f"record {i}"}) for i in range(3)])
+    handler.close()
+    with open(handler.log_files[0]) as f:
+      self.assertEqual(f.read(), "record 0\nrecord 1\nrecord 2\n")
+
+
+if __name__ == "__main__":
+  unittest.main()
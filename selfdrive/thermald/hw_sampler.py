@@ -0,0 +1,101 @@
+import threading
+import time
+
+from common.profiler import Histogram
+from selfdrive.swaglog import cloudlog
+
+
+class Probe():
+  def __init__(self, name, fn, interval, default, once):
+    self.name = name
+    self.fn = fn
+    self.interval = interval
+    self.value = default
+    self.once = once
+
+    self.next_time = 0.
+    self.updates = 0
+    self.errors = 0
+    self.hist = Histogram()
+
+
+class HardwareSampler():
+  """Runs slow hardware queries on a background thread, so the thermal loop only
+     reads the last known values. Every probe has its own refresh interval, its
+     value keeps the default until the first query succeeds. Probes marked once
+     stop after their first value that isn't None."""
+  def __init__(self):
+    self.probes = {}
+    self.lock = threading.Lock()
+    self.wake = threading.Event()
+    self.exit_event = threading.Event()
+    self.thread = None
+
+  def add(self, name, fn, interval, default=None, once=False):
+    with self.lock:
+      self.probes[name] = Probe(name, fn, interval, default, once)
+    self.wake.set()
+
+  def get(self, name):
+    return self.probes[name].value
+
+  def updates(self, name):
+    """Number of values read so far, changes when a new one comes in"""
+    return self.probes[name].updates
+
+  def start(self):
+    self.thread = threading.Thread(target=self.sampler_thread, name="hw_sampler", daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.exit_event.set()
+    self.wake.set()
+    if self.thread is not None:
+      self.thread.join()
+
+  def sampler_thread(self):
+    while not self.exit_event.is_set():
+      with self.lock:
+        probes = list(self.probes.values())
+      t = time.monotonic()
+      due = [p for p in probes if p.next_time is not None and p.next_time <= t]
+      for probe in sorted(due, key=lambda p: p.next_time):
+        if self.exit_event.is_set():
+          return
+        self.sample(probe)
+
+      next_times = [p.next_time for p in probes if p.next_time is not None]
+      self.wake.wait(max(min(next_times) - time.monotonic(), 0.) if next_times else None)
+      self.wake.clear()
+
+  def sample(self, probe):
+    t = time.monotonic_ns()
+    failed = False
+    try:
+      value = probe.fn()
+    except Exception:
+      failed = True
+      cloudlog.exception(f"hardware sampler {probe.name} failed")
+    else:
+      probe.value = value
+      probe.updates += 1
+      if probe.once and value is not None:
+        probe.next_time = None
+    dt = time.monotonic_ns() - t
+    # stats() reads and resets these from the thermal loop
+    with self.lock:
+      probe.hist.add(dt)
+      if failed:
+        probe.errors += 1
+    if probe.next_time is not None:
+      probe.next_time = time.monotonic() + probe.interval
+
+  def stats(self):
+    """Query time stats per probe since the last call"""
+    ret = {}
+    with self.lock:
+      for name, probe in self.probes.items():
+        ret[name] = {**probe.hist.stats(), "errors": probe.errors}
+        probe.hist.reset()
+        probe.errors = 0
+    return ret
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import threading
+import time
+import unittest
+
+from selfdrive.thermald.hw_sampler import HardwareSampler
+
+
+class TestHardwareSampler(unittest.TestCase):
+  def setUp(self):
+    self.sampler = HardwareSampler()
+
+  def tearDown(self):
+    self.sampler.stop()
+
+  def wait_updates(self, name, n, timeout=2.):
+    end = time.monotonic() + timeout
+    while self.sampler.updates(name) < n and time.monotonic() < end:
+      time.sleep(0.01)
+    return self.sampler.updates(name)
+
+  def test_blocking_probe(self):
+    release = threading.Event()
+
+    def slow():
+      release.wait()
+      return "slow"
+
+    self.sampler.add("slow", slow, 10., default="unknown")
+    self.sampler.add("fast", lambda: "fast", 0.05)
+    self.sampler.start()
+
+    # the default is served while the query blocks
+    t = time.monotonic()
+    self.assertEqual(self.sampler.get("slow"), "unknown")
+    self.assertLess(time.monotonic() - t, 0.01)
+
+    release.set()
+    self.assertEqual(self.wait_updates("slow", 1), 1)
+    self.assertEqual(self.sampler.get("slow"), "slow")
+    self.assertGreater(self.wait_updates("fast", 5), 4)
+
+  def test_errors_and_once(self):
+    values = iter([None, "v1", "v2"])
+    self.sampler.add("once", lambda: next(values), 0.01, once=True)
+    self.sampler.add("broken", lambda: 1 / 0, 0.01, default=0)
+    self.sampler.start()
+
+    self.assertEqual(self.wait_updates("once", 2), 2)
+    time.sleep(0.1)
+    self.assertEqual(self.sampler.updates("once"), 2)
+    self.assertEqual(self.sampler.get("once"), "v1")
+
+    stats = self.sampler.stats()
+    self.assertEqual(stats["once"]["count"], 2)
+    self.assertGreater(stats["broken"]["errors"], 0)
+    self.assertEqual(stats["broken"]["errors"], stats["broken"]["count"])
+    self.assertEqual(self.sampler.get("broken"), 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -20,6 +20,7 @@ from selfdrive.hardware import EON, TICI, HARDWARE
 from selfdrive.loggerd.config import get_available_percent
 from selfdrive.pandad import get_expected_signature
 from selfdrive.swaglog import cloudlog
+from selfdrive.thermald.hw_sampler import HardwareSampler
 from selfdrive.thermald.power_monitoring import PowerMonitoring
 from selfdrive.version import tested_branch, terms_version, training_version
 
@@ -130,6 +131,41 @@ def set_offroad_alert_if_changed(offroad_alert: str, show_alert: bool, extra_tex
   set_offroad_alert(offroad_alert, show_alert, extra_text)
 
 
+class NetworkInfo():
+  # modem state, read on the sampler thread since the lte restart blocks too
+  def __init__(self):
+    self.registered_count = 0
+
+  def get(self):
+    network_info = HARDWARE.get_network_info()  # pylint: disable=assignment-from-none
+    if TICI and network_info is not None and network_info.get('state', None) == "REGISTERED":
+      self.registered_count += 1
+    else:
+      self.registered_count = 0
+
+    if self.registered_count > 10:
+      cloudlog.warning(f"Modem stuck in registered state {network_info}. nmcli conn up lte")
+      os.system("nmcli conn up lte")
+      self.registered_count = 0
+    return network_info
+
+
+def get_network_status():
+  network_type = HARDWARE.get_network_type()
+  return network_type, HARDWARE.get_network_strength(network_type)
+
+
+def setup_hw_sampler():
+  sampler = HardwareSampler()
+  # these shell out on EON and wait on D-Bus on TICI, refreshed every 10s
+  sampler.add("network", get_network_status, 10., default=(NetworkType.none, NetworkStrength.unknown))
+  sampler.add("network_info", NetworkInfo().get, 10.)
+  sampler.add("ip_address", HARDWARE.get_ip_address, 10., default='N/A')
+  sampler.add("modem_version", HARDWARE.get_modem_version, 10., once=True)
+  sampler.start()
+  return sampler
+
+
 def thermald_thread():
 
   pm = messaging.PubMaster(['deviceState'])
@@ -153,12 +189,7 @@ def thermald_thread():
   thermal_status = ThermalStatus.green
   usb_power = True
 
-  network_type = NetworkType.none
-  network_strength = NetworkStrength.unknown
-  wifiIpAddress = 'N/A'
-  network_info = None
   modem_version = None
-  registered_count = 0
 
   current_filter = FirstOrderFilter(0., CURRENT_TAU, DT_TRML)
   cpu_temp_filter = FirstOrderFilter(0., CPU_TEMP_TAU, DT_TRML)
@@ -174,6 +205,7 @@ def thermald_thread():
 
   HARDWARE.initialize_hardware()
   thermal_config = HARDWARE.get_thermal_config()
+  hw_sampler = setup_hw_sampler()
 
   if params.get_bool("IsOnroad"):
     cloudlog.event("onroad flag not cleared")
@@ -233,32 +265,14 @@ def thermald_thread():
           params.clear_all(ParamKeyType.CLEAR_ON_PANDA_DISCONNECT)
       pandaState_prev = pandaState
 
-    # get_network_type is an expensive call. update every 10s
-    if (count % int(10. / DT_TRML)) == 0:
-      try:
-        network_type = HARDWARE.get_network_type()
-        network_strength = HARDWARE.get_network_strength(network_type)
-        network_info = HARDWARE.get_network_info()  # pylint: disable=assignment-from-none
-        wifiIpAddress = HARDWARE.get_ip_address()
-
-        # Log modem version once
-        if modem_version is None:
-          modem_version = HARDWARE.get_modem_version()  # pylint: disable=assignment-from-none
-          if modem_version is not None:
-            cloudlog.warning(f"Modem version: {modem_version}")
-
-        if TICI and (network_info.get('state', None) == "REGISTERED"):
-          registered_count += 1
-        else:
-          registered_count = 0
-
-        if registered_count > 10:
-          cloudlog.warning(f"Modem stuck in registered state {network_info}. nmcli conn up lte")
-          os.system("nmcli conn up lte")
-          registered_count = 0
+    network_type, network_strength = hw_sampler.get("network")
+    network_info = hw_sampler.get("network_info")
 
-      except Exception:
-        cloudlog.exception("Error getting network status")
+    # Log modem version once
+    if modem_version is None:
+      modem_version = hw_sampler.get("modem_version")
+      if modem_version is not None:
+        cloudlog.warning(f"Modem version: {modem_version}")
 
     msg.deviceState.freeSpacePercent = get_available_percent(default=100.0)
     msg.deviceState.memoryUsagePercent = int(round(psutil.virtual_memory().percent))
@@ -269,7 +283,7 @@ def thermald_thread():
     if network_info is not None:
       msg.deviceState.networkInfo = network_info
 
-    msg.deviceState.wifiIpAddress = wifiIpAddress
+    msg.deviceState.wifiIpAddress = hw_sampler.get("ip_address")
     msg.deviceState.batteryPercent = HARDWARE.get_battery_capacity()
     msg.deviceState.batteryStatus = HARDWARE.get_battery_status()
     msg.deviceState.batteryCurrent = HARDWARE.get_battery_current()
@@ -458,6 +472,7 @@ def thermald_thread():
                      pandaState=(strip_deprecated_keys(pandaState.to_dict()) if pandaState else None),
                      location=(strip_deprecated_keys(location.gpsLocationExternal.to_dict()) if location else None),
                      deviceState=strip_deprecated_keys(msg.to_dict()))
+      cloudlog.event("hardware sampler", probes=hw_sampler.stats())
 
     count += 1
 
@@ -1,8 +1,15 @@
 import os
+import fcntl
 import urllib.parse
+from contextlib import contextmanager
 from tools.lib.file_helpers import mkdirs_exists_ok
 
 DEFAULT_CACHE_DIR = os.path.expanduser("~/.commacache")
+# byte budget of every cache directory, 0 disables eviction
+CACHE_MAX_BYTES = int(os.environ.get("COMMA_CACHE_MAX_BYTES", str(10 * 1024**3)))
+# evict down to this fraction of the budget, so not every write has to scan
+EVICT_TO = 0.9
+
 
 def cache_path_for_file_path(fn, cache_prefix=None):
   dir_ = os.path.join(DEFAULT_CACHE_DIR, "local")
@@ -13,3 +20,120 @@ def cache_path_for_file_path(fn, cache_prefix=None):
   else:
     cache_fn = f'{fn_parsed.hostname}_{fn_parsed.path.replace("/", "_")}'
   return os.path.join(dir_, cache_fn)
+
+
+def cached_size(path):
+  """Size of a cache file about to be overwritten, 0 if there is none."""
+  try:
+    return os.path.getsize(path)
+  except FileNotFoundError:
+    return 0
+
+
+class DiskCache(object):
+  """Keeps a cache directory under a byte budget by evicting the least recently
+     used files. Usage is tracked in a file guarded by a flock, so any number of
+     processes can share the directory. Hit/miss counters are per process."""
+  def __init__(self, cache_dir, max_bytes=None):
+    self.cache_dir = cache_dir
+    self.max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  @contextmanager
+  def _locked(self):
+    mkdirs_exists_ok(self.cache_dir)
+    with open(os.path.join(self.cache_dir, ".lock"), "a") as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+  def _entries(self):
+    for root, _, files in os.walk(self.cache_dir):
+      for fn in files:
+        # skip bookkeeping and in-progress atomic writes
+        if fn.startswith(".") or fn.startswith("tmp"):
+          continue
+        path = os.path.join(root, fn)
+        try:
+          st = os.stat(path)
+        except FileNotFoundError:
+          continue
+        yield max(st.st_atime, st.st_mtime), st.st_size, path
+
+  def _read_usage(self):
+    try:
+      with open(os.path.join(self.cache_dir, ".usage")) as f:
+        return int(f.read())
+    except (FileNotFoundError, ValueError):
+      return sum(size for _, size, _ in self._entries())
+
+  def _write_usage(self, usage):
+    with open(os.path.join(self.cache_dir, ".usage"), "w") as f:
+      f.write(str(usage))
+
+  def _evict(self):
+    entries = sorted(self._entries())
+    usage = sum(size for _, size, _ in entries)
+    target = self.max_bytes * EVICT_TO
+    for _, size, path in entries:
+      if usage <= target:
+        break
+      try:
+        os.remove(path)
+        self.evictions += 1
+      except FileNotFoundError:
+        pass
+      usage -= size
+    return usage
+
+  def contains(self, path):
+    """Returns whether path is cached, marking it as recently used."""
+    try:
+      os.utime(path)
+    except FileNotFoundError:
+      self.misses += 1
+      return False
+    self.hits += 1
+    return True
+
+  def add(self, path, replaced_size=0):
+    """Accounts for a file just written to the cache, evicting if over budget.
+       replaced_size is the size of the file it overwrote, see cached_size."""
+    if self.max_bytes <= 0:
+      return
+    size = os.path.getsize(path) - replaced_size
+    with self._locked():
+      usage = max(self._read_usage() + size, 0)
+      if usage > self.max_bytes:
+        usage = self._evict()
+      self._write_usage(usage)
+
+  def usage(self):
+    with self._locked():
+      return self._read_usage()
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_rate': self.hits / lookups if lookups else 0.,
+      'evictions': self.evictions,
+      'usage': self.usage(),
+      'max_bytes': self.max_bytes,
+    }
+
+
+_disk_caches = {}
+
+
+def disk_cache(cache_dir=None):
+  """Returns the shared DiskCache of cache_dir, DEFAULT_CACHE_DIR by default."""
+  cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+  if cache_dir not in _disk_caches:
+    _disk_caches[cache_dir] = DiskCache(cache_dir)
+  return _disk_caches[cache_dir]
@@ -1,20 +1,22 @@
 # pylint: skip-file
+import atexit
 import json
 import os
 import pickle
 import queue
+import select
 import struct
 import subprocess
 import tempfile
 import threading
+from collections import OrderedDict
 from functools import wraps
 
 import numpy as np
 from aenum import Enum
-from lru import LRU
 
 import _io
-from tools.lib.cache import cache_path_for_file_path
+from tools.lib.cache import cache_path_for_file_path, cached_size, disk_cache
 from tools.lib.exceptions import DataUnreadableError
 from tools.lib.file_helpers import atomic_write_in_dir
 
@@ -26,6 +28,18 @@ except ImportError:
 HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
+HEVC_NAL_SPS = 33
+# end of sequence NAL unit, the next frame starts a new sequence like at the start of a stream
+HEVC_EOS_NAL = b"\x00\x00\x01\x48\x01"
+HEVC_MAX_DPB_SIZE = 16
+
+# decode GOPs with long-lived ffmpeg processes instead of one process per GOP
+DECODER_POOL = os.getenv("FFMPEG_DECODER_POOL", "1") == "1"
+DECODER_POOL_SIZE = int(os.getenv("FFMPEG_DECODER_POOL_SIZE", str(os.cpu_count() or 1)))
+# a persistent decoder that doesn't produce a frame for this long is considered dead
+DECODER_STALL_TIMEOUT = float(os.getenv("FFMPEG_DECODER_STALL_TIMEOUT", "10"))
+# byte budget of the decoded frame cache of each GOPFrameReader
+FRAME_CACHE_BYTES = int(os.getenv("FRAME_CACHE_BYTES", str(256 * 1024 * 1024)))
 
 
 class GOPReader:
@@ -33,6 +47,10 @@ class GOPReader:
     # returns (start_frame_num, num_frames, frames_to_skip, gop_data)
     raise NotImplementedError
 
+  def get_keyframe_size(self, frame_b):
+    # returns the size of the prefix and first frame of the gop_data of the GOP starting at frame_b
+    raise NotImplementedError
+
 
 class DoNothingContextManager:
   def __enter__(self):
@@ -114,15 +132,22 @@ def cache_fn(func):
       cache_prefix = kwargs.pop('cache_prefix', None)
       cache_path = cache_path_for_file_path(fn, cache_prefix)
 
-    if cache_path and os.path.exists(cache_path):
-      with open(cache_path, "rb") as cache_file:
-        cache_value = pickle.load(cache_file)
-    else:
+    cache_value = None
+    if cache_path and disk_cache().contains(cache_path):
+      try:
+        with open(cache_path, "rb") as cache_file:
+          cache_value = pickle.load(cache_file)
+      except FileNotFoundError:
+        pass
+
+    if cache_value is None:
       cache_value = func(fn, *args, **kwargs)
 
       if cache_path:
+        replaced_size = cached_size(cache_path)
         with atomic_write_in_dir(cache_path, mode="wb", overwrite=True) as cache_file:
           pickle.dump(cache_value, cache_file, -1)
+        disk_cache().add(cache_path, replaced_size)
 
     return cache_value
 
@@ -189,25 +214,33 @@ def read_file_check_size(f, sz, cookie):
   return buff
 
 
-def rgb24toyuv420(rgb):
-  yuv_from_rgb = np.array([[ 0.299     ,  0.587     ,  0.114      ],
-                           [-0.14714119, -0.28886916,  0.43601035 ],
-                           [ 0.61497538, -0.51496512, -0.10001026 ]])
-  img = np.dot(rgb.reshape(-1, 3), yuv_from_rgb.T).reshape(rgb.shape)
+YUV_FROM_RGB = np.array([[ 0.299     ,  0.587     ,  0.114      ],
+                         [-0.14714119, -0.28886916,  0.43601035 ],
+                         [ 0.61497538, -0.51496512, -0.10001026 ]])
+# 16 bit fixed point, every row still sums up to exactly 1 or 0
+YUV_FROM_RGB_FIXED = np.round(YUV_FROM_RGB * (1 << 16)).astype(np.int32)
+
 
-  y_len = img.shape[0] * img.shape[1]
+def rgb24toyuv420(rgb, out=None):
+  """Converts an rgb24 frame to yuv420p using integer math only, writing into out if given."""
+  h, w = rgb.shape[:2]
+  y_len = h * w
   uv_len = y_len // 4
+  if out is None:
+    out = np.empty(y_len + 2 * uv_len, dtype=np.uint8)
 
-  ys = img[:, :, 0]
-  us = (img[::2, ::2, 1] + img[1::2, ::2, 1] + img[::2, 1::2, 1] + img[1::2, 1::2, 1]) / 4 + 128
-  vs = (img[::2, ::2, 2] + img[1::2, ::2, 2] + img[::2, 1::2, 2] + img[1::2, 1::2, 2]) / 4 + 128
+  r, g, b = (rgb[:, :, i].astype(np.int32) for i in range(3))
+  cy, cu, cv = YUV_FROM_RGB_FIXED
+  out[:y_len].reshape(h, w)[:] = (cy[0] * r + cy[1] * g + cy[2] * b) >> 16
 
-  yuv420 = np.empty(y_len + 2 * uv_len, dtype=img.dtype)
-  yuv420[:y_len] = ys.reshape(-1)
-  yuv420[y_len:y_len + uv_len] = us.reshape(-1)
-  yuv420[y_len + uv_len:y_len + 2 * uv_len] = vs.reshape(-1)
+  # chroma of the sum of each 2x2 block, the shift by 2 more bits averages
+  r4, g4, b4 = (c[::2, ::2] + c[1::2, ::2] + c[::2, 1::2] + c[1::2, 1::2] for c in (r, g, b))
+  us = ((cu[0] * r4 + cu[1] * g4 + cu[2] * b4) >> 18) + 128
+  vs = ((cv[0] * r4 + cv[1] * g4 + cv[2] * b4) >> 18) + 128
+  out[y_len:y_len + uv_len].reshape(h // 2, w // 2)[:] = us.clip(0, 255)
+  out[y_len + uv_len:y_len + 2 * uv_len].reshape(h // 2, w // 2)[:] = vs.clip(0, 255)
 
-  return yuv420.clip(0, 255).astype('uint8')
+  return out
 
 
 def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
@@ -251,6 +284,282 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
   return ret
 
 
+class BitReader:
+  def __init__(self, dat):
+    self.v = int.from_bytes(dat, "big")
+    self.n = len(dat) * 8
+    self.pos = 0
+
+  def u(self, n):
+    self.pos += n
+    if self.pos > self.n:
+      raise ValueError("read past the end")
+    return (self.v >> (self.n - self.pos)) & ((1 << n) - 1)
+
+  def ue(self):
+    zeros = 0
+    while not self.u(1):
+      zeros += 1
+    return (1 << zeros) - 1 + self.u(zeros)
+
+
+def hevc_max_num_reorder_pics(dat):
+  # sps_max_num_reorder_pics of the highest sub-layer of the first SPS in dat, None if there is none
+  for nal in dat.split(b"\x00\x00\x01")[1:]:
+    if len(nal) < 2 or (nal[0] >> 1) & 0x3f != HEVC_NAL_SPS:
+      continue
+
+    r = BitReader(nal[2:].replace(b"\x00\x00\x03", b"\x00\x00"))
+    try:
+      r.u(4)  # sps_video_parameter_set_id
+      max_sub_layers_minus1 = r.u(3)
+      r.u(1)  # sps_temporal_id_nesting_flag
+
+      # profile_tier_level
+      r.u(96)
+      sub_layer_present = [(r.u(1), r.u(1)) for _ in range(max_sub_layers_minus1)]
+      if max_sub_layers_minus1 > 0:
+        r.u(2 * (8 - max_sub_layers_minus1))
+      for profile_present, level_present in sub_layer_present:
+        r.u(88 * profile_present + 8 * level_present)
+
+      r.ue()  # sps_seq_parameter_set_id
+      if r.ue() == 3:  # chroma_format_idc
+        r.u(1)  # separate_colour_plane_flag
+      r.ue()  # pic_width_in_luma_samples
+      r.ue()  # pic_height_in_luma_samples
+      if r.u(1):  # conformance_window_flag
+        for _ in range(4):
+          r.ue()
+      r.ue()  # bit_depth_luma_minus8
+      r.ue()  # bit_depth_chroma_minus8
+      r.ue()  # log2_max_pic_order_cnt_lsb_minus4
+
+      sub_layer_ordering_info_present = r.u(1)
+      for _ in range(0 if sub_layer_ordering_info_present else max_sub_layers_minus1, max_sub_layers_minus1 + 1):
+        r.ue()  # sps_max_dec_pic_buffering_minus1
+        num_reorder_pics = r.ue()
+        r.ue()  # sps_max_latency_increase_plus1
+      return num_reorder_pics
+    except ValueError:
+      return None
+  return None
+
+
+def hevc_output_delay(dat):
+  # access units ffmpeg holds back before their frames come out: the parser keeps
+  # one until the next one starts, the decoder up to num_reorder_pics of the SPS
+  num_reorder_pics = hevc_max_num_reorder_pics(dat)
+  return 1 + (HEVC_MAX_DPB_SIZE if num_reorder_pics is None else num_reorder_pics)
+
+
+def frame_size(w, h, pix_fmt):
+  if pix_fmt == "yuv420p":
+    return w*h*3//2
+  elif pix_fmt in ("rgb24", "yuv444p"):
+    return w*h*3
+  else:
+    raise NotImplementedError
+
+
+def frame_shape(w, h, pix_fmt):
+  if pix_fmt == "rgb24":
+    return (h, w, 3)
+  elif pix_fmt == "yuv420p":
+    return (h*w*3//2,)
+  elif pix_fmt == "yuv444p":
+    return (3, h, w)
+  else:
+    raise NotImplementedError
+
+
+class PersistentDecoder:
+  """An ffmpeg process that decodes GOPs back to back.
+
+  Every access unit written in produces exactly one frame out, but ffmpeg holds
+  back the last few until more data arrives. How many follows from the SPS, so
+  after each GOP its keyframe is written again that many times as filler, which
+  pushes all of the GOP's frames out. The filler frames are dropped at the start
+  of the next decode. GOPs and fillers are separated by end of sequence NALs, so
+  repeated frames don't collide."""
+  def __init__(self, vid_fmt, w, h, pix_fmt):
+    self.w, self.h, self.pix_fmt = w, h, pix_fmt
+    self.out_size = frame_size(w, h, pix_fmt)
+    self.pending_fillers = 0
+    self._scratch = np.empty(self.out_size, dtype=np.uint8)
+
+    cuda = os.getenv("FFMPEG_CUDA", "0") == "1"
+    # single threaded decoding keeps the frame delay at a minimum, the pool provides the parallelism
+    self.proc = subprocess.Popen(
+      ["ffmpeg",
+       "-threads", "1",
+       "-hwaccel", "none" if not cuda else "cuda",
+       "-c:v", "hevc",
+       "-analyzeduration", "0",
+       "-probesize", "32",
+       "-vsync", "0",
+       "-f", vid_fmt,
+       "-flags2", "showall",
+       "-i", "pipe:0",
+       "-f", "rawvideo",
+       "-pix_fmt", pix_fmt,
+       "-flush_packets", "1",
+       "pipe:1"],
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=open("/dev/null", "wb"), bufsize=0)
+
+    # stdin is fed from a thread, a GOP is larger than the pipe buffer and ffmpeg
+    # stops reading while its output isn't consumed
+    self.in_q = queue.Queue()
+    self.t = threading.Thread(target=self._write_thread)
+    self.t.daemon = True
+    self.t.start()
+
+  def _write_thread(self):
+    while True:
+      dat = self.in_q.get()
+      if dat is None:
+        break
+      try:
+        self.proc.stdin.write(dat)
+      except (BrokenPipeError, ValueError):
+        break
+
+  def _read_frame(self, out):
+    view = memoryview(out).cast("B")
+    pos = 0
+    while pos < self.out_size:
+      readable, _, _ = select.select([self.proc.stdout], [], [], DECODER_STALL_TIMEOUT)
+      if not readable:
+        raise DataUnreadableError("ffmpeg stalled")
+      n = self.proc.stdout.readinto(view[pos:])
+      if not n:
+        raise DataUnreadableError("ffmpeg failed")
+      pos += n
+
+  def decode_into(self, rawdat, keyframe, num_frames, out, first=0):
+    """Decodes a GOP of num_frames frames. Frames first to first+len(out) are written
+    into out, an array of (frames, frame_size) bytes, the others are dropped."""
+    fillers = hevc_output_delay(keyframe)
+    discard = self.pending_fillers
+    self.pending_fillers = fillers
+    self.in_q.put(HEVC_EOS_NAL)
+    self.in_q.put(rawdat)
+    self.in_q.put((HEVC_EOS_NAL + keyframe) * fillers)
+
+    for i in range(-discard, num_frames):
+      self._read_frame(out[i - first] if first <= i < first + out.shape[0] else self._scratch)
+
+  def close(self):
+    self.in_q.put(None)
+    self.proc.stdin.close()
+    self.proc.kill()
+    self.proc.wait()
+
+
+class DecoderPool:
+  """Keeps up to size PersistentDecoders per output format, shared by all
+  frame readers of the process. Decodes block while all decoders are busy."""
+  def __init__(self, size):
+    self.size = size
+    self.lock = threading.Lock()
+    self.idle = {}
+    self.sems = {}
+    self.decoders = []
+
+  def decode(self, vid_fmt, w, h, pix_fmt, rawdat, keyframe, num_frames):
+    out = np.empty((num_frames, frame_size(w, h, pix_fmt)), dtype=np.uint8)
+    self.decode_into(vid_fmt, w, h, pix_fmt, rawdat, keyframe, num_frames, out)
+    return out.reshape((num_frames,) + frame_shape(w, h, pix_fmt))
+
+  def decode_into(self, vid_fmt, w, h, pix_fmt, rawdat, keyframe, num_frames, out, first=0):
+    key = (vid_fmt, w, h, pix_fmt)
+    with self.lock:
+      if key not in self.sems:
+        self.sems[key] = threading.Semaphore(self.size)
+        self.idle[key] = []
+      sem, idle = self.sems[key], self.idle[key]
+
+    with sem:
+      with self.lock:
+        dec = idle.pop() if idle else None
+      if dec is None:
+        dec = PersistentDecoder(vid_fmt, w, h, pix_fmt)
+        with self.lock:
+          self.decoders.append(dec)
+
+      try:
+        dec.decode_into(rawdat, keyframe, num_frames, out, first)
+      except Exception:
+        # the stream state is unknown now, start over with a fresh process
+        with self.lock:
+          self.decoders.remove(dec)
+        dec.close()
+        raise
+
+      with self.lock:
+        idle.append(dec)
+
+  def close(self):
+    with self.lock:
+      for dec in self.decoders:
+        dec.close()
+      self.decoders = []
+      self.idle = {}
+
+
+_decoder_pool = None
+
+
+def decoder_pool():
+  global _decoder_pool
+  if _decoder_pool is None:
+    _decoder_pool = DecoderPool(DECODER_POOL_SIZE)
+    atexit.register(_decoder_pool.close)
+  return _decoder_pool
+
+
+class FrameCache:
+  """LRU of decoded frames bounded by their total size in bytes. Every operation
+  takes a lock, so frames can be looked up while the readahead thread inserts."""
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.nbytes = 0
+    self._frames = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __contains__(self, key):
+    with self._lock:
+      return key in self._frames
+
+  def get(self, key):
+    with self._lock:
+      frame = self._frames.get(key)
+      if frame is not None:
+        self._frames.move_to_end(key)
+      return frame
+
+  def __getitem__(self, key):
+    frame = self.get(key)
+    if frame is None:
+      raise KeyError(key)
+    return frame
+
+  def __setitem__(self, key, frame):
+    with self._lock:
+      if key in self._frames:
+        self.nbytes -= self._frames.pop(key).nbytes
+      self._frames[key] = frame
+      self.nbytes += frame.nbytes
+      # always keep the newest frame, even if it's over budget by itself
+      while self.nbytes > self.max_bytes and len(self._frames) > 1:
+        _, old = self._frames.popitem(last=False)
+        self.nbytes -= old.nbytes
+
+  def __len__(self):
+    with self._lock:
+      return len(self._frames)
+
+
 class BaseFrameReader:
   # properties: frame_type, frame_count, w, h
 
@@ -266,15 +575,30 @@ class BaseFrameReader:
   def get(self, num, count=1, pix_fmt="yuv420p"):
     raise NotImplementedError
 
+  def get_into(self, num, out, pix_fmt="yuv420p"):
+    """Decodes frames num to num+len(out) into out, a preallocated uint8 array
+       of shape (count,) + frame_shape(w, h, pix_fmt), e.g. a np.memmap."""
+    for i, frame in enumerate(self.get(num, out.shape[0], pix_fmt)):
+      out[i] = frame
+    return out
+
+  def _check_out(self, num, out, pix_fmt):
+    if num + out.shape[0] > self.frame_count:
+      raise ValueError("{} > {}".format(num + out.shape[0], self.frame_count))
+    if out.dtype != np.uint8 or out.shape[1:] != frame_shape(self.w, self.h, pix_fmt):
+      raise ValueError("out needs to be uint8 of shape (count,) + %r" % (frame_shape(self.w, self.h, pix_fmt),))
+    if not out.flags.c_contiguous:
+      raise ValueError("out needs to be contiguous")
 
-def FrameReader(fn, cache_prefix=None, readahead=False, readbehind=False, index_data=None):
+
+def FrameReader(fn, cache_prefix=None, readahead=False, readbehind=False, index_data=None, cache_bytes=None):
   frame_type = fingerprint_video(fn)
   if frame_type == FrameType.raw:
     return RawFrameReader(fn)
   elif frame_type in (FrameType.h265_stream,):
     if not index_data:
       index_data = get_video_index(fn, frame_type, cache_prefix)
-    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind)
+    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind, cache_bytes=cache_bytes)
   else:
     raise NotImplementedError(frame_type)
 
@@ -324,6 +648,19 @@ class RawFrameReader(BaseFrameReader):
 
     return app
 
+  def get_into(self, num, out, pix_fmt="yuv420p"):
+    if pix_fmt not in ("yuv420p", "rgb24"):
+      raise ValueError("Unsupported pixel format %r" % pix_fmt)
+    self._check_out(num, out, pix_fmt)
+
+    for i in range(out.shape[0]):
+      rgb_dat = self.load_and_debayer(self.rawfile.read(num + i))
+      if pix_fmt == "rgb24":
+        out[i] = rgb_dat
+      else:
+        rgb24toyuv420(rgb_dat, out[i])
+    return out
+
 
 class VideoStreamDecompressor:
   def __init__(self, vid_fmt, w, h, pix_fmt):
@@ -477,16 +814,20 @@ class StreamGOPReader(GOPReader):
 
     return frame_b, num_frames, skip_frames, rawdat
 
+  def get_keyframe_size(self, frame_b):
+    assert frame_b >= self.first_iframe
+    return len(self.prefix) + int(self.index[frame_b + 1, 1] - self.index[frame_b, 1])
+
 
 class GOPFrameReader(BaseFrameReader):
   #FrameReader with caching and readahead for formats that are group-of-picture based
 
-  def __init__(self, readahead=False, readbehind=False):
+  def __init__(self, readahead=False, readbehind=False, cache_bytes=None):
     self.open_ = True
 
     self.readahead = readahead
     self.readbehind = readbehind
-    self.frame_cache = LRU(64)
+    self.frame_cache = FrameCache(FRAME_CACHE_BYTES if cache_bytes is None else cache_bytes)
 
     if self.readahead:
       self.cache_lock = threading.RLock()
@@ -534,23 +875,31 @@ class GOPFrameReader(BaseFrameReader):
   def _get_one(self, num, pix_fmt):
     assert num < self.frame_count
 
-    if (num, pix_fmt) in self.frame_cache:
-      return self.frame_cache[(num, pix_fmt)]
+    # a single lookup, the frame may be evicted between a check and a read
+    cached = self.frame_cache.get((num, pix_fmt))
+    if cached is not None:
+      return cached
 
     with self.cache_lock:
-      if (num, pix_fmt) in self.frame_cache:
-        return self.frame_cache[(num, pix_fmt)]
+      cached = self.frame_cache.get((num, pix_fmt))
+      if cached is not None:
+        return cached
 
       frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
 
-      ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
+      if DECODER_POOL:
+        keyframe = rawdat[:self.get_keyframe_size(frame_b)]
+        ret = decoder_pool().decode(self.vid_fmt, self.w, self.h, pix_fmt, rawdat, keyframe, skip_frames + num_frames)
+      else:
+        ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
       ret = ret[skip_frames:]
       assert ret.shape[0] == num_frames
 
       for i in range(ret.shape[0]):
         self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
 
-      return self.frame_cache[(num, pix_fmt)]
+      # a small cache may not even hold the whole GOP
+      return ret[num - frame_b]
 
   def get(self, num, count=1, pix_fmt="yuv420p"):
     assert self.frame_count is not None
@@ -571,11 +920,42 @@ class GOPFrameReader(BaseFrameReader):
 
     return ret
 
+  def get_into(self, num, out, pix_fmt="yuv420p"):
+    # batch path: frames are decoded straight into out and bypass the frame cache
+    if pix_fmt not in ("yuv420p", "rgb24", "yuv444p"):
+      raise ValueError("Unsupported pixel format %r" % pix_fmt)
+    self._check_out(num, out, pix_fmt)
+
+    count = out.shape[0]
+    flat = out.reshape(count, -1)
+    i = num
+    while i < num + count:
+      # the cache locks itself, cache_lock is held for whole GOP decodes by the readahead thread
+      cached = self.frame_cache.get((i, pix_fmt))
+      if cached is not None:
+        flat[i - num] = cached.reshape(-1)
+        i += 1
+        continue
+
+      frame_b, num_frames, skip_frames, rawdat = self.get_gop(i)
+      n = min(num + count, frame_b + num_frames) - i
+      first = skip_frames + i - frame_b
+      if DECODER_POOL:
+        keyframe = rawdat[:self.get_keyframe_size(frame_b)]
+        decoder_pool().decode_into(self.vid_fmt, self.w, self.h, pix_fmt, rawdat, keyframe,
+                                   skip_frames + num_frames, flat[i - num:i - num + n], first)
+      else:
+        ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
+        flat[i - num:i - num + n] = ret[first:first + n].reshape(n, -1)
+      i += n
+
+    return out
+
 
 class StreamFrameReader(StreamGOPReader, GOPFrameReader):
-  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False):
+  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False, cache_bytes=None):
     StreamGOPReader.__init__(self, fn, frame_type, index_data)
-    GOPFrameReader.__init__(self, readahead, readbehind)
+    GOPFrameReader.__init__(self, readahead, readbehind, cache_bytes)
 
 
 def GOPFrameIterator(gop_reader, pix_fmt):
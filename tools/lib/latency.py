@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+
+# stages of every latency chain, in order
+CHAINS = {
+  # a can packet waking up controlsd, up to the sendcan and controlsState of that step
+  "can": ("can", "controlsStart", "sendcan", "controlsState"),
+  # a camera frame through the model and lateral planner, up to the first sendcan using the plan
+  "lateral": ("roadCameraState", "modelV2", "lateralPlan", "controlsStart", "sendcan"),
+  # a model output through the longitudinal planner, up to the first sendcan using the plan
+  "longitudinal": ("modelV2", "longitudinalPlan", "controlsStart", "sendcan"),
+  # age of the model and carState a radarState was made from
+  "radarModel": ("modelV2", "radarState"),
+  "radarCarState": ("carState", "radarState"),
+}
+SERVICES = ("can", "sendcan", "controlsState", "carState", "roadCameraState", "modelV2",
+            "lateralPlan", "longitudinalPlan", "radarState")
+
+# breadcrumbs kept around waiting for the rest of their chain
+MAX_PENDING = 100
+PERCENTILES = (50, 90, 99)
+
+
+def _prune(pending):
+  while len(pending) > MAX_PENDING:
+    pending.popitem(last=False)
+
+
+class LatencyTracer():
+  """Reconstructs latency chains from events fed in logMonoTime order, by
+     following the mono time breadcrumbs the processes put in their messages.
+
+     Timestamps are logMonoTime of the stage's message, except controlsStart
+     which is the start of the controlsd step (controlsState.startMonoTime)."""
+  def __init__(self, max_samples=None):
+    self.samples = {name: deque(maxlen=max_samples) for name in CHAINS}
+
+    self.can_times = deque(maxlen=1000)
+    self.last_sendcan = 0
+    self.model_times = deque(maxlen=100)
+    # roadCameraState logMonoTime by frameId
+    self.frames = OrderedDict()
+    # chains waiting for the next stage, keyed by the logMonoTime of their last stage
+    self.models = OrderedDict()
+    self.lateral_plans = OrderedDict()
+    self.longitudinal_plans = OrderedDict()
+
+  def update(self, msg):
+    which = msg.which()
+    t = msg.logMonoTime
+
+    if which == "can":
+      self.can_times.append(t)
+    elif which == "sendcan":
+      self.last_sendcan = t
+    elif which == "roadCameraState":
+      self.frames[msg.roadCameraState.frameId] = t
+      _prune(self.frames)
+    elif which == "modelV2":
+      frame_t = self.frames.get(msg.modelV2.frameId)
+      self.models[t] = frame_t
+      self.model_times.append(t)
+      _prune(self.models)
+    elif which == "lateralPlan":
+      # the planner runs on the latest model
+      if len(self.model_times):
+        model_t = self.model_times[-1]
+        frame_t = self.models.pop(model_t, None)
+        if frame_t is not None:
+          self.lateral_plans[t] = (frame_t, model_t, t)
+      _prune(self.lateral_plans)
+    elif which == "longitudinalPlan":
+      model_t = msg.longitudinalPlan.modelMonoTime
+      if model_t:
+        self.longitudinal_plans[t] = (model_t, t)
+      _prune(self.longitudinal_plans)
+    elif which == "radarState":
+      rs = msg.radarState
+      if rs.mdMonoTime:
+        self.samples["radarModel"].append((rs.mdMonoTime, t))
+      if rs.carStateMonoTime:
+        self.samples["radarCarState"].append((rs.carStateMonoTime, t))
+    elif which == "controlsState":
+      self._update_controls(msg.controlsState, t)
+
+  def _update_controls(self, cs, t):
+    start = cs.startMonoTime
+    if not start:
+      return
+    # sendcan goes out before controlsState in the same step
+    sendcan = self.last_sendcan if self.last_sendcan >= start else None
+
+    idx = bisect.bisect_right(self.can_times, start)
+    if idx > 0 and sendcan is not None:
+      self.samples["can"].append((self.can_times[idx - 1], start, sendcan, t))
+
+    if sendcan is None:
+      return
+    lateral = self.lateral_plans.pop(cs.lateralPlanMonoTime, None)
+    if lateral is not None:
+      self.samples["lateral"].append(lateral + (start, sendcan))
+    longitudinal = self.longitudinal_plans.pop(cs.longitudinalPlanMonoTime, None)
+    if longitudinal is not None:
+      self.samples["longitudinal"].append(longitudinal + (start, sendcan))
+
+  def report(self, percentiles=PERCENTILES):
+    """Returns {chain: {link: {'count', 'mean', 'max', 'p50', ...}}} in ms,
+       per link between consecutive stages and for the whole chain."""
+    ret = {}
+    for name, stages in CHAINS.items():
+      if not len(self.samples[name]):
+        continue
+      ts = np.array(self.samples[name], dtype=np.int64)
+      links = {f"{a}->{b}": ts[:, i+1] - ts[:, i] for i, (a, b) in enumerate(zip(stages, stages[1:]))}
+      links["total"] = ts[:, -1] - ts[:, 0]
+
+      ret[name] = {}
+      for link, dt in links.items():
+        dt_ms = dt * 1e-6
+        stats = {"count": len(dt_ms), "mean": float(np.mean(dt_ms)), "max": float(np.max(dt_ms))}
+        for p, v in zip(percentiles, np.percentile(dt_ms, percentiles)):
+          stats[f"p{p}"] = float(v)
+        ret[name][link] = stats
+    return ret
+
+
+def format_report(report):
+  lines = []
+  for name, links in report.items():
+    lines.append(f"{name} ({links['total']['count']} chains)")
+    for link, stats in links.items():
+      pcts = "  ".join(f"{k}: {v:7.2f}" for k, v in stats.items() if k.startswith("p"))
+      lines.append(f"  {link:34} mean: {stats['mean']:7.2f}  {pcts}  max: {stats['max']:7.2f}")
+  return "\n".join(lines)
+
+
+def trace_logs(log_paths, workers=None):
+  from tools.lib.logreader import RouteLogReader
+
+  # logs are only roughly sorted, order events within a short window
+  tracer = LatencyTracer()
+  window = []
+  for msg in RouteLogReader(log_paths, services=set(SERVICES), workers=workers):
+    window.append(msg)
+    if len(window) >= 1000:
+      window.sort(key=lambda m: m.logMonoTime)
+      for m in window[:500]:
+        tracer.update(m)
+      window = window[500:]
+  for m in sorted(window, key=lambda m: m.logMonoTime):
+    tracer.update(m)
+  return tracer
+
+
+def trace_live(interval=5., addr="127.0.0.1"):
+  import cereal.messaging as messaging
+
+  socks = [messaging.sub_sock(s, addr=addr, conflate=False) for s in SERVICES]
+  tracer = LatencyTracer(max_samples=10000)
+  last_report = time.monotonic()
+  while True:
+    msgs = [m for sock in socks for m in messaging.drain_sock(sock)]
+    for m in sorted(msgs, key=lambda m: m.logMonoTime):
+      tracer.update(m)
+
+    if time.monotonic() - last_report > interval:
+      last_report = time.monotonic()
+      print(format_report(tracer.report()) + "\n")
+    time.sleep(0.05)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Report latencies along the openpilot message pipeline")
+  parser.add_argument("route", nargs="?", help="route name, traces live messages if not given")
+  parser.add_argument("--qlog", action="store_true", help="use qlogs instead of rlogs")
+  parser.add_argument("--addr", default="127.0.0.1", help="address of the device when tracing live")
+  args = parser.parse_args()
+
+  if args.route is None:
+    trace_live(addr=args.addr)
+  else:
+    from tools.lib.route import Route
+    r = Route(args.route)
+    print(format_report(trace_logs(r.qlog_paths() if args.qlog else r.log_paths()).report()))
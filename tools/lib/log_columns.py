@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import os
+import argparse
+from operator import attrgetter
+
+import numpy as np
+
+from tools.lib.file_helpers import atomic_write_in_dir, mkdirs_exists_ok
+from tools.lib.logreader import RouteLogReader
+
+MONO_TIME_SUFFIX = ".logMonoTime"
+
+
+def extract_columns(log_paths, fields, workers=None):
+  """Reads scalar fields like 'carState.vEgo' out of the events of a route.
+
+     Returns {field: (mono_times, values)} with contiguous arrays, where
+     mono_times holds the logMonoTime of every event the value came from."""
+  getters = {}
+  for field in fields:
+    service, _, path = field.partition(".")
+    if not path:
+      raise ValueError(f"field {field} needs to be of the form service.path")
+    getters.setdefault(service, []).append((field, attrgetter(path)))
+
+  mono_times = {field: [] for field in fields}
+  values = {field: [] for field in fields}
+  for msg in RouteLogReader(log_paths, services=set(getters), workers=workers):
+    event = getattr(msg, msg.which())
+    for field, getter in getters[msg.which()]:
+      mono_times[field].append(msg.logMonoTime)
+      values[field].append(getter(event))
+
+  return {field: (np.array(mono_times[field], dtype=np.uint64), np.array(values[field])) for field in fields}
+
+
+def _column_paths(path, field):
+  return os.path.join(path, field + ".npy"), os.path.join(path, field + MONO_TIME_SUFFIX + ".npy")
+
+
+def save_columns(path, columns):
+  """Writes one .npy file per field and per field's logMonoTime into the directory path."""
+  mkdirs_exists_ok(path)
+  for field, (mono_times, values) in columns.items():
+    values_path, mono_times_path = _column_paths(path, field)
+    for fn, arr in ((values_path, values), (mono_times_path, mono_times)):
+      with atomic_write_in_dir(fn, mode="wb", overwrite=True) as f:
+        np.save(f, arr)
+
+
+def load_columns(path, fields, mmap_mode='r'):
+  """Loads saved columns, memory mapped by default so only what is accessed gets read."""
+  columns = {}
+  for field in fields:
+    values_path, mono_times_path = _column_paths(path, field)
+    columns[field] = (np.load(mono_times_path, mmap_mode=mmap_mode), np.load(values_path, mmap_mode=mmap_mode))
+  return columns
+
+
+def get_columns(log_paths, fields, cache_path=None, workers=None):
+  """Like extract_columns, but reuses and extends the columns saved in cache_path."""
+  if cache_path is None:
+    return extract_columns(log_paths, fields, workers)
+
+  missing = [f for f in fields if not all(os.path.exists(p) for p in _column_paths(cache_path, f))]
+  if missing:
+    save_columns(cache_path, extract_columns(log_paths, missing, workers))
+  return load_columns(cache_path, fields)
+
+
+if __name__ == "__main__":
+  from tools.lib.route import Route
+
+  parser = argparse.ArgumentParser(description="Export log fields of a route as numpy columns")
+  parser.add_argument("route", help="route name")
+  parser.add_argument("out_path", help="output directory")
+  parser.add_argument("fields", nargs="+", help="fields to export, e.g. carState.vEgo")
+  parser.add_argument("--qlog", action="store_true", help="use qlogs instead of rlogs")
+  parser.add_argument("--workers", type=int, default=None)
+  args = parser.parse_args()
+
+  r = Route(args.route)
+  columns = get_columns(r.qlog_paths() if args.qlog else r.log_paths(), args.fields, args.out_path, args.workers)
+  for field, (_, values) in columns.items():
+    print(f"{field}: {len(values)} values")
@@ -2,48 +2,354 @@
 import os
 import sys
 import bz2
+import itertools
+import multiprocessing
+import struct
 import urllib.parse
 import capnp
+import numpy as np
+from collections import deque
 
 try:
   from xx.chffr.lib.filereader import FileReader
 except ImportError:
   from tools.lib.filereader import FileReader
 from cereal import log as capnp_log
+from tools.lib.cache import cache_path_for_file_path, cached_size, disk_cache
+from tools.lib.file_helpers import atomic_write_in_dir
+
+# size of compressed reads when streaming a log
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Event union discriminant -> service name, read straight from the schema
+_EVENT_STRUCT = capnp_log.Event.schema.node.struct
+EVENT_WHICH = {f.discriminantValue: f.name for f in _EVENT_STRUCT.fields if f.discriminantValue != 0xffff}
+EVENT_DISCRIMINANTS = {name: d for d, name in EVENT_WHICH.items()}
+_DISCRIMINANT_OFFSET = _EVENT_STRUCT.discriminantOffset * 2
+
+
+def _message_end(dat, pos):
+  """Returns the end offset of the capnp message starting at pos in dat,
+     or None if dat doesn't contain the whole message yet."""
+  if len(dat) - pos < 4:
+    return None
+  num_segments = struct.unpack_from("<I", dat, pos)[0] + 1
+  # segment table is padded to a full word
+  header_size = (4 + 4*num_segments + 7) & ~7
+  if len(dat) - pos < header_size:
+    return None
+  segment_sizes = struct.unpack_from("<%dI" % num_segments, dat, pos + 4)
+  end = pos + header_size + 8*sum(segment_sizes)
+  return end if end <= len(dat) else None
+
+
+def _event_data(dat, pos):
+  """Returns the offset and size of the data section of the Event starting at
+     pos without parsing it, or None if the raw layout isn't the simple case."""
+  num_segments = struct.unpack_from("<I", dat, pos)[0] + 1
+  segment_start = pos + ((4 + 4*num_segments + 7) & ~7)
+  root = struct.unpack_from("<Q", dat, segment_start)[0]
+  if root & 3 != 0:
+    # far pointer to the root struct
+    return None
+
+  offset = (root >> 2) & 0x3fffffff
+  if offset & 0x20000000:
+    offset -= 0x40000000
+  return segment_start + 8*(1 + offset), ((root >> 32) & 0xffff) * 8
+
+
+def _event_discriminant(dat, pos):
+  data = _event_data(dat, pos)
+  if data is None:
+    return None
+  data_start, data_size = data
+  if _DISCRIMINANT_OFFSET + 2 > data_size:
+    # written with a schema older than the discriminant, defaults to zero
+    return 0
+  return struct.unpack_from("<H", dat, data_start + _DISCRIMINANT_OFFSET)[0]
+
+
+def _event_mono_time(dat, pos):
+  data = _event_data(dat, pos)
+  if data is None:
+    return None
+  data_start, data_size = data
+  return struct.unpack_from("<Q", dat, data_start)[0] if data_size >= 8 else 0
+
+
+def filter_log_bytes(dat, services):
+  """Returns the serialized messages of dat whose event type is in services."""
+  keep = []
+  pos = 0
+  end = _message_end(dat, pos)
+  while end is not None:
+    discriminant = _event_discriminant(dat, pos)
+    # undecidable messages are kept, they get filtered after parsing
+    if discriminant is None or EVENT_WHICH.get(discriminant) in services:
+      keep.append(memoryview(dat)[pos:end])
+    pos = end
+    end = _message_end(dat, pos)
+  return b"".join(keep)
+
+
+def _read_chunks(f, chunk_size, start=0):
+  # URLFiles error out on ranges past the end, so bound the reads by the length
+  length = f.get_length() if hasattr(f, "get_length") else None
+  f.seek(start)
+  pos = start
+  while length is None or pos < length:
+    dat = f.read(chunk_size if length is None else min(chunk_size, length - pos))
+    if not dat:
+      break
+    pos += len(dat)
+    yield dat
+
+
+def _decompress_chunks(chunks):
+  decompressor = bz2.BZ2Decompressor()
+  for dat in chunks:
+    while dat:
+      out = decompressor.decompress(dat)
+      if out:
+        yield out
+      if not decompressor.eof:
+        break
+      # concatenated bz2 streams
+      dat = decompressor.unused_data
+      decompressor = bz2.BZ2Decompressor()
+
+
+def _log_ext(fn):
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  if ext not in ("", ".bz2"):
+    raise Exception(f"unknown extension {ext}")
+  return ext
+
+
+def _check_services(services):
+  if services is None:
+    return None
+  services = set(services)
+  unknown = services - set(EVENT_WHICH.values())
+  if unknown:
+    raise Exception(f"unknown services {sorted(unknown)}")
+  return services
+
+
+def _event_wanted(ent, services):
+  if services is None:
+    return True
+  try:
+    return ent.which() in services
+  except capnp.lib.capnp.KjException:
+    return False
+
+
+def read_log_bytes(fn, services=None):
+  """Returns all serialized messages of a log, decompressed and
+     optionally filtered to services, as one buffer."""
+  ext = _log_ext(fn)
+  with FileReader(fn) as f:
+    dat = f.read()
+
+  # old rlogs weren't bz2 compressed
+  if ext == ".bz2":
+    dat = bz2.decompress(dat)
+  if services is not None:
+    dat = filter_log_bytes(dat, services)
+  return dat
+
+
+def _skip_bytes(chunks, n):
+  for dat in chunks:
+    if n >= len(dat):
+      n -= len(dat)
+      continue
+    yield dat[n:] if n else dat
+    n = 0
+
+
+def stream_log_bytes(fn, chunk_size=STREAM_CHUNK_SIZE, services=None, start=0):
+  """Yields buffers of whole, serialized capnp messages from a log file,
+     decompressing incrementally so only about one chunk is held in memory.
+     If services is given, messages of other types are dropped unparsed.
+
+     start is the decompressed offset of the first message to return, e.g.
+     from a LogIndex. Uncompressed logs are read from there, bz2 has no
+     random access so everything before it is decompressed and skipped."""
+  ext = _log_ext(fn)
+  with FileReader(fn) as f:
+    if ext == ".bz2":
+      chunks = _skip_bytes(_decompress_chunks(_read_chunks(f, chunk_size)), start)
+    else:
+      chunks = _read_chunks(f, chunk_size, start)
+
+    buf = b""
+    for dat in chunks:
+      buf = buf + dat if buf else dat
+      pos = 0
+      end = _message_end(buf, pos)
+      while end is not None:
+        pos = end
+        end = _message_end(buf, pos)
+
+      if pos > 0:
+        dat = buf[:pos] if services is None else filter_log_bytes(buf[:pos], services)
+        if dat:
+          yield dat
+        buf = buf[pos:]
+    # a trailing partial message is a truncated log, drop it
+
+
+def _parse_single(dat):
+  return next(iter(capnp_log.Event.read_multiple_bytes(dat)))
+
+
+def build_log_index(fn):
+  """Walks the raw messages of a log once, recording the logMonoTime,
+     decompressed byte offset and union discriminant of every event."""
+  mono_times, offsets, discriminants = [], [], []
+  base = 0
+  for dat in stream_log_bytes(fn):
+    pos = 0
+    end = _message_end(dat, pos)
+    while end is not None:
+      mono_time = _event_mono_time(dat, pos)
+      discriminant = _event_discriminant(dat, pos)
+      if mono_time is None or discriminant is None:
+        ent = _parse_single(dat[pos:end])
+        mono_time = ent.logMonoTime
+        try:
+          discriminant = EVENT_DISCRIMINANTS[ent.which()]
+        except capnp.lib.capnp.KjException:
+          discriminant = 0xffff
+
+      mono_times.append(mono_time)
+      offsets.append(base + pos)
+      discriminants.append(discriminant)
+      pos = end
+      end = _message_end(dat, pos)
+    base += len(dat)
+
+  return LogIndex(np.array(mono_times, dtype=np.uint64), np.array(offsets, dtype=np.uint64),
+                  np.array(discriminants, dtype=np.uint16))
+
+
+class LogIndex(object):
+  """logMonoTime -> event position lookup for one log segment.
+
+     Positions count events in file order, same as LogReader._ents, so
+     seeking is a binary search instead of a walk over decoded events.
+     offsets are where the events start in the decompressed log, reading
+     can start there with stream_log_bytes."""
+  def __init__(self, mono_times, offsets, discriminants, size=None):
+    self.mono_times = mono_times
+    self.offsets = offsets
+    self.discriminants = discriminants
+    self.size = size
+    # logMonoTime isn't strictly increasing in a log, search the running max
+    self._search_times = np.maximum.accumulate(mono_times) if len(mono_times) else mono_times
+
+  def __len__(self):
+    return len(self.mono_times)
+
+  def select(self, services):
+    """Returns the index of only the given event types, matching the
+       positions of a LogReader created with the same services."""
+    mask = np.isin(self.discriminants, [d for d, name in EVENT_WHICH.items() if name in services])
+    return LogIndex(self.mono_times[mask], self.offsets[mask], self.discriminants[mask], self.size)
+
+  def seek(self, mono_time):
+    """Returns the position of the first event at or after mono_time,
+       len(self) if there is none."""
+    return int(np.searchsorted(self._search_times, mono_time, side='left'))
+
+  def save(self, path):
+    with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+      np.savez(f, mono_times=self.mono_times, offsets=self.offsets,
+               discriminants=self.discriminants, size=np.array(-1 if self.size is None else self.size))
+
+  @classmethod
+  def load(cls, path):
+    with np.load(path) as dat:
+      size = int(dat['size'])
+      return cls(dat['mono_times'], dat['offsets'], dat['discriminants'], None if size < 0 else size)
+
+
+def _local_size(fn):
+  return os.path.getsize(fn) if urllib.parse.urlparse(fn).scheme == '' else None
+
+
+def get_log_index(fn, no_cache=False):
+  """Returns the LogIndex of a log, built once and then cached
+     next to the other tools.lib caches."""
+  if no_cache:
+    return build_log_index(fn)
+
+  cache_path = cache_path_for_file_path(fn) + ".logidx.npz"
+  size = _local_size(fn)
+  if disk_cache().contains(cache_path):
+    try:
+      index = LogIndex.load(cache_path)
+      # local logs may still be growing
+      if index.size == size:
+        return index
+    except FileNotFoundError:
+      pass
+
+  index = build_log_index(fn)
+  index.size = size
+  replaced_size = cached_size(cache_path)
+  index.save(cache_path)
+  disk_cache().add(cache_path, replaced_size)
+  return index
+
 
-# this is an iterator itself, and uses private variables from LogReader
 class MultiLogIterator(object):
-  def __init__(self, log_paths, wraparound=True):
+  """Iterates the events of consecutive log segments. Segments are streamed
+     from the current position, a seek starts reading at the event's offset
+     in the segment's LogIndex instead of parsing the segment up front."""
+  def __init__(self, log_paths, wraparound=True, services=None):
     self._log_paths = log_paths
     self._wraparound = wraparound
+    self._services = _check_services(services)
 
     self._first_log_idx = next(i for i in range(len(log_paths)) if log_paths[i] is not None)
     self._current_log = self._first_log_idx
     self._idx = 0
-    self._log_readers = [None]*len(log_paths)
-    self.start_time = self._log_reader(self._first_log_idx)._ts[0]
+    self._events = None
+    self._log_indexes = [None]*len(log_paths)
+    self.start_time = int(self._log_index(self._first_log_idx).mono_times[0])
+
+  def _stream_events(self, i, idx):
+    start = int(self._log_index(i).offsets[idx])
+    for dat in stream_log_bytes(self._log_paths[i], services=self._services, start=start):
+      for ent in capnp_log.Event.read_multiple_bytes(dat):
+        if _event_wanted(ent, self._services):
+          yield ent
 
-  def _log_reader(self, i):
-    if self._log_readers[i] is None and self._log_paths[i] is not None:
-      log_path = self._log_paths[i]
-      print("LogReader:%s" % log_path)
-      self._log_readers[i] = LogReader(log_path)
+  def _log_index(self, i):
+    if self._log_indexes[i] is None and self._log_paths[i] is not None:
+      print("LogReader:%s" % self._log_paths[i])
+      index = get_log_index(self._log_paths[i])
+      self._log_indexes[i] = index if self._services is None else index.select(self._services)
 
-    return self._log_readers[i]
+    return self._log_indexes[i]
 
   def __iter__(self):
     return self
 
   def _inc(self):
-    lr = self._log_reader(self._current_log)
-    if self._idx < len(lr._ents)-1:
+    if self._idx < len(self._log_index(self._current_log))-1:
       self._idx += 1
     else:
       self._idx = 0
-      self._current_log = next(i for i in range(self._current_log + 1, len(self._log_readers) + 1)
-                               if i == len(self._log_readers) or self._log_paths[i] is not None)
+      self._events = None
+      self._current_log = next(i for i in range(self._current_log + 1, len(self._log_paths) + 1)
+                               if i == len(self._log_paths) or self._log_paths[i] is not None)
       # wraparound
-      if self._current_log == len(self._log_readers):
+      if self._current_log == len(self._log_paths):
         if self._wraparound:
           self._current_log = self._first_log_idx
         else:
@@ -51,14 +357,24 @@ class MultiLogIterator(object):
 
   def __next__(self):
     while 1:
-      lr = self._log_reader(self._current_log)
-      ret = lr._ents[self._idx]
+      if self._idx >= len(self._log_index(self._current_log)):
+        # nothing left in this segment after filtering services
+        self._inc()
+        continue
+      if self._events is None:
+        self._events = self._stream_events(self._current_log, self._idx)
+      ret = next(self._events, None)
+      if ret is None:
+        # truncated segment, shorter than its index
+        self._idx = len(self._log_index(self._current_log)) - 1
+        self._inc()
+        continue
       self._inc()
       return ret
 
   def tell(self):
     # returns seconds from start of log
-    return (self._log_reader(self._current_log)._ts[self._idx] - self.start_time) * 1e-9
+    return (int(self._log_index(self._current_log).mono_times[self._idx]) - self.start_time) * 1e-9
 
   def seek(self, ts):
     # seek to nearest minute
@@ -67,37 +383,86 @@ class MultiLogIterator(object):
       return False
 
     self._current_log = minute
+    self._events = None
 
-    # HACK: O(n) seek afterward
-    self._idx = 0
-    while self.tell() < ts:
+    index = self._log_index(minute)
+    self._idx = index.seek(self.start_time + int(ts * 1e9))
+    if self._idx >= len(index):
+      # past the last event, continue at the next segment
+      self._idx = max(len(index) - 1, 0)
       self._inc()
     return True
 
 
+class RouteLogReader(object):
+  """Iterates the events of consecutive log segments, like a MultiLogIterator
+     without wraparound, while a pool of worker processes reads and decompresses
+     the upcoming segments.
+
+     At most prefetch segments are in flight or waiting to be consumed, which
+     bounds memory. Workers hand over the raw message bytes, only the
+     consuming process builds capnp readers."""
+  def __init__(self, log_paths, services=None, workers=None, prefetch=None):
+    self._log_paths = [p for p in log_paths if p is not None]
+    self._services = _check_services(services)
+    self._workers = workers if workers is not None else multiprocessing.cpu_count()
+    self._prefetch = prefetch if prefetch is not None else self._workers
+
+  def __iter__(self):
+    with multiprocessing.Pool(self._workers) as pool:
+      paths = iter(self._log_paths)
+      pending = deque(pool.apply_async(read_log_bytes, (fn, self._services))
+                      for fn in itertools.islice(paths, self._prefetch))
+      while pending:
+        dat = pending.popleft().get()
+        fn = next(paths, None)
+        if fn is not None:
+          pending.append(pool.apply_async(read_log_bytes, (fn, self._services)))
+
+        for ent in capnp_log.Event.read_multiple_bytes(dat):
+          if _event_wanted(ent, self._services):
+            yield ent
+
+
 class LogReader(object):
-  def __init__(self, fn, canonicalize=True, only_union_types=False):
+  def __init__(self, fn, canonicalize=True, only_union_types=False, stream=False, services=None):
+    """Reads all events of a log.
+
+       With stream=True nothing is read up front, every iteration decompresses
+       and parses the file incrementally with bounded memory. The _ents and _ts
+       lists needed for random access are only built in the default mode.
+
+       services restricts the events to a set of types, e.g. {'can', 'carState'}.
+       Other events are skipped based on their raw bytes and never parsed."""
     data_version = None
-    _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
-    with FileReader(fn) as f:
-      dat = f.read()
-
-    if ext == "":
-      # old rlogs weren't bz2 compressed
-      ents = capnp_log.Event.read_multiple_bytes(dat)
-    elif ext == ".bz2":
-      dat = bz2.decompress(dat)
-      ents = capnp_log.Event.read_multiple_bytes(dat)
-    else:
-      raise Exception(f"unknown extension {ext}")
+    _log_ext(fn)
+    self._fn = fn
+    self._stream = stream
+    self._services = _check_services(services)
+
+    if not stream:
+      ents = capnp_log.Event.read_multiple_bytes(read_log_bytes(fn, self._services))
 
-    self._ents = list(ents)
-    self._ts = [x.logMonoTime for x in self._ents]
+      self._ents = [ent for ent in ents if self._wanted(ent)]
+      self._ts = [x.logMonoTime for x in self._ents]
     self.data_version = data_version
     self._only_union_types = only_union_types
 
+  def _wanted(self, ent):
+    return _event_wanted(ent, self._services)
+
+  def _iter_ents(self):
+    if not self._stream:
+      yield from self._ents
+      return
+
+    for dat in stream_log_bytes(self._fn, services=self._services):
+      for ent in capnp_log.Event.read_multiple_bytes(dat):
+        if self._wanted(ent):
+          yield ent
+
   def __iter__(self):
-    for ent in self._ents:
+    for ent in self._iter_ents():
       if self._only_union_types:
         try:
           ent.which()
@@ -113,6 +478,6 @@ if __name__ == "__main__":
   # below line catches those errors and replaces the bytes with \x__
   codecs.register_error("strict", codecs.backslashreplace_errors)
   log_path = sys.argv[1]
-  lr = LogReader(log_path)
+  lr = LogReader(log_path, stream=True)
   for msg in lr:
     print(msg)
@@ -1,10 +1,169 @@
 #!/usr/bin/env python3
 import os
+import re
 import shutil
+import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 os.environ["COMMA_CACHE"] = "/tmp/__test_cache__"
-from tools.lib.url_file import URLFile, CACHE_DIR
+from tools.lib.cache import DiskCache, cached_size
+from tools.lib.url_file import URLFile, CACHE_DIR, CHUNK_SIZE
+
+
+class TestDiskCache(unittest.TestCase):
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def _write(self, cache, name, size):
+    path = os.path.join(self.cache_dir, name)
+    replaced_size = cached_size(path)
+    with open(path, "wb") as f:
+      f.write(b"\0" * size)
+    cache.add(path, replaced_size)
+    return path
+
+  def test_lru_eviction(self):
+    cache = DiskCache(self.cache_dir, max_bytes=1000)
+    paths = []
+    t = time.time() - 100
+    for i in range(4):
+      paths.append(self._write(cache, str(i), 300))
+      # access times need to differ
+      os.utime(paths[-1], (t + i, t + i))
+    self.assertLessEqual(cache.usage(), 1000)
+
+    # oldest is gone, most recent ones are kept
+    self.assertFalse(cache.contains(paths[0]))
+    self.assertTrue(cache.contains(paths[3]))
+    self.assertEqual(cache.evictions, 1)
+
+    # a hit makes a file the most recently used
+    self.assertTrue(cache.contains(paths[1]))
+    self._write(cache, "4", 300)
+    self.assertTrue(cache.contains(paths[1]))
+    self.assertFalse(cache.contains(paths[2]))
+
+    stats = cache.stats()
+    self.assertEqual(stats['hits'], 3)
+    self.assertEqual(stats['misses'], 2)
+    self.assertEqual(stats['usage'], sum(os.path.getsize(os.path.join(self.cache_dir, f)) for f in ["1", "3", "4"]))
+
+  def test_shared_usage(self):
+    # two instances, like two processes, account into the same directory
+    a, b = DiskCache(self.cache_dir, 1000), DiskCache(self.cache_dir, 1000)
+    self._write(a, "a", 400)
+    self._write(b, "b", 400)
+    self.assertEqual(a.usage(), 800)
+    self._write(a, "c", 400)
+    self.assertLessEqual(b.usage(), 900)
+
+  def test_overwrite(self):
+    # rebuilding a cached file only accounts for the change in size
+    cache = DiskCache(self.cache_dir, 1000)
+    self._write(cache, "a", 400)
+    for _ in range(5):
+      self._write(cache, "b", 300)
+    self.assertEqual(cache.usage(), 700)
+    self._write(cache, "b", 100)
+    self.assertEqual(cache.usage(), 500)
+    self.assertEqual(cache.evictions, 0)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, *args):
+    pass
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.server.data)))
+    self.end_headers()
+
+  def do_GET(self):
+    start, end = map(int, re.match(r"bytes=(\d+)-(\d+)", self.headers["Range"]).groups())
+    with self.server.lock:
+      self.server.requests.append(start)
+      fail = start in self.server.fail_once
+      self.server.fail_once.discard(start)
+      self.server.active += 1
+      self.server.max_active = max(self.server.max_active, self.server.active)
+    try:
+      self.respond(start, end, fail)
+    finally:
+      with self.server.lock:
+        self.server.active -= 1
+
+  def respond(self, start, end, fail):
+    if fail:
+      # let the other chunks finish first
+      time.sleep(0.5)
+      self.send_response(500)
+      self.send_header("Content-Length", "0")
+      self.end_headers()
+      return
+
+    # slow enough that concurrent requests overlap
+    time.sleep(0.05)
+    body = self.server.data[start:end + 1]
+    self.send_response(206)
+    self.send_header("Content-Range", f"bytes {start}-{start + len(body) - 1}/{len(self.server.data)}")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+class TestChunkDownload(unittest.TestCase):
+  def setUp(self):
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    self.server.data = os.urandom(3 * CHUNK_SIZE + 12345)
+    self.server.requests = []
+    self.server.fail_once = set()
+    self.server.lock = threading.Lock()
+    self.server.active = self.server.max_active = 0
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.url = f"http://127.0.0.1:{self.server.server_address[1]}/file"
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def read(self, start, length=None):
+    f = URLFile(self.url, cache=True)
+    f.seek(start)
+    return f.read(ll=length)
+
+  def test_multi_chunk(self):
+    self.assertEqual(self.read(0), self.server.data)
+    self.assertEqual(sorted(self.server.requests), [i * CHUNK_SIZE for i in range(4)])
+    self.assertGreater(self.server.max_active, 1)
+
+    # served from the cache now
+    self.server.requests.clear()
+    self.assertEqual(self.read(CHUNK_SIZE - 10, 2 * CHUNK_SIZE), self.server.data[CHUNK_SIZE - 10:3 * CHUNK_SIZE - 10])
+    self.assertEqual(self.server.requests, [])
+
+  def test_retry_resumes(self):
+    self.server.fail_once.add(2 * CHUNK_SIZE)
+    self.assertEqual(self.read(0), self.server.data)
+    # only the failed chunk is fetched again
+    self.assertEqual(sorted(self.server.requests), [0, CHUNK_SIZE, 2 * CHUNK_SIZE, 2 * CHUNK_SIZE, 3 * CHUNK_SIZE])
+
+  def test_partially_cached(self):
+    self.assertEqual(self.read(CHUNK_SIZE + 100, 100), self.server.data[CHUNK_SIZE + 100:CHUNK_SIZE + 200])
+    self.assertEqual(self.server.requests, [CHUNK_SIZE])
+
+    self.server.requests.clear()
+    start, end = 500, 3 * CHUNK_SIZE + 500
+    self.assertEqual(self.read(start, end - start), self.server.data[start:end])
+    self.assertEqual(sorted(self.server.requests), [0, 2 * CHUNK_SIZE, 3 * CHUNK_SIZE])
 
 
 class TestFileDownload(unittest.TestCase):
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+import threading
+import unittest
+
+import numpy as np
+
+from tools.lib.framereader import FrameCache, GOPFrameReader, frame_shape
+
+
+class TestFrameCache(unittest.TestCase):
+  def test_lru(self):
+    cache = FrameCache(3 * 100)
+    for i in range(3):
+      cache[i] = np.zeros(100, dtype=np.uint8)
+    cache.get(0)
+    cache[3] = np.zeros(100, dtype=np.uint8)
+    self.assertIsNone(cache.get(1))
+    self.assertEqual([k for k in range(4) if k in cache], [0, 2, 3])
+    with self.assertRaises(KeyError):
+      cache[1]  # pylint: disable=pointless-statement
+
+  def test_concurrent(self):
+    # a readahead thread inserting and evicting while frames are looked up
+    cache = FrameCache(10 * 100)
+    frame = np.zeros(100, dtype=np.uint8)
+    done = threading.Event()
+    errors = []
+
+    def insert():
+      for i in range(20000):
+        cache[i % 50] = frame
+      done.set()
+
+    def lookup():
+      try:
+        while not done.is_set():
+          for i in range(50):
+            cached = cache.get(i)
+            self.assertTrue(cached is None or cached is frame)
+      except Exception as e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=insert)] + [threading.Thread(target=lookup) for _ in range(2)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(errors, [])
+    self.assertEqual(cache.nbytes, len(cache) * 100)
+    self.assertLessEqual(len(cache), 10)
+
+  def test_get_into_cached(self):
+    # cached frames are copied while the readahead thread is busy decoding a GOP
+    fr = GOPFrameReader(readahead=True)
+    fr.w, fr.h, fr.frame_count = 8, 8, 4
+    frames = [np.full(frame_shape(8, 8, "yuv420p"), i, dtype=np.uint8) for i in range(4)]
+    for i, f in enumerate(frames):
+      fr.frame_cache[(i, "yuv420p")] = f
+
+    out = np.empty((4,) + frame_shape(8, 8, "yuv420p"), dtype=np.uint8)
+    with fr.cache_lock:
+      t = threading.Thread(target=fr.get_into, args=(0, out))
+      t.start()
+      t.join(5)
+      self.assertFalse(t.is_alive())
+    fr.close()
+    np.testing.assert_array_equal(out, np.stack(frames))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import unittest
+
+from cereal import log as capnp_log
+from tools.lib.latency import LatencyTracer
+
+MS = 1000000
+
+
+def event(which, t, **fields):
+  msg = capnp_log.Event.new_message()
+  msg.logMonoTime = t
+  if which in ("can", "sendcan"):
+    msg.init(which, 1)
+  else:
+    msg.init(which)
+    for k, v in fields.items():
+      setattr(getattr(msg, which), k, v)
+  return msg.as_reader()
+
+
+def frame_events(base):
+  return [
+    event("roadCameraState", base, frameId=base // MS),
+    event("carState", base + 2 * MS),
+    event("modelV2", base + 30 * MS, frameId=base // MS),
+    event("lateralPlan", base + 35 * MS),
+    event("longitudinalPlan", base + 36 * MS, modelMonoTime=base + 30 * MS),
+    event("radarState", base + 37 * MS, mdMonoTime=base + 30 * MS, carStateMonoTime=base + 2 * MS),
+    event("can", base + 40 * MS),
+    event("sendcan", base + 42 * MS),
+    event("controlsState", base + 43 * MS, startMonoTime=base + 41 * MS,
+          lateralPlanMonoTime=base + 35 * MS, longitudinalPlanMonoTime=base + 36 * MS),
+    # a later step using the same plans doesn't count again
+    event("can", base + 50 * MS),
+    event("sendcan", base + 52 * MS),
+    event("controlsState", base + 53 * MS, startMonoTime=base + 51 * MS,
+          lateralPlanMonoTime=base + 35 * MS, longitudinalPlanMonoTime=base + 36 * MS),
+  ]
+
+
+class TestLatencyTracer(unittest.TestCase):
+  def test_chains(self):
+    tracer = LatencyTracer()
+    for i in range(10):
+      for msg in frame_events(1000 * MS + i * 100 * MS):
+        tracer.update(msg)
+
+    report = tracer.report()
+    self.assertEqual(report["lateral"]["total"]["count"], 10)
+    self.assertAlmostEqual(report["lateral"]["total"]["p50"], 42.)
+    self.assertAlmostEqual(report["lateral"]["modelV2->lateralPlan"]["max"], 5.)
+    self.assertAlmostEqual(report["longitudinal"]["longitudinalPlan->controlsStart"]["p99"], 5.)
+    self.assertEqual(report["can"]["total"]["count"], 20)
+    self.assertAlmostEqual(report["can"]["can->controlsStart"]["mean"], 1.)
+    self.assertAlmostEqual(report["can"]["total"]["max"], 3.)
+    self.assertAlmostEqual(report["radarModel"]["total"]["p50"], 7.)
+    self.assertAlmostEqual(report["radarCarState"]["total"]["p50"], 35.)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+import bz2
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from tools.lib.log_columns import get_columns, extract_columns
+from tools.lib.logreader import LogReader
+from tools.lib.tests.test_logreader import make_log
+
+
+class TestLogColumns(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.fn = os.path.join(self.tmp, "rlog.bz2")
+    with open(self.fn, "wb") as f:
+      f.write(bz2.compress(make_log(200)))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def test_extract(self):
+    columns = extract_columns([self.fn, self.fn], ["carState.vEgo"], workers=1)
+    mono_times, values = columns["carState.vEgo"]
+
+    car_states = [m for m in LogReader(self.fn) if m.which() == 'carState'] * 2
+    np.testing.assert_equal(mono_times, [m.logMonoTime for m in car_states])
+    np.testing.assert_equal(values, [m.carState.vEgo for m in car_states])
+    self.assertEqual(values.dtype, np.float64)
+
+  def test_cache(self):
+    cache_path = os.path.join(self.tmp, "columns")
+    fields = ["carState.vEgo", "carState.cruiseState.speed"]
+    columns = get_columns([self.fn], fields, cache_path, workers=1)
+
+    # the cache is used even once the logs are gone
+    os.remove(self.fn)
+    cached = get_columns([self.fn], fields, cache_path)
+    for field in fields:
+      self.assertIsInstance(cached[field][1], np.memmap)
+      np.testing.assert_equal(cached[field], columns[field])
+
+
+if __name__ == "__main__":
+  unittest.main()
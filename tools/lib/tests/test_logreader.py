@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import bz2
+import os
+import shutil
+import tempfile
+import unittest
+
+from cereal import log as capnp_log
+import tools.lib.cache
+from tools.lib.logreader import LogReader, MultiLogIterator, RouteLogReader, get_log_index, stream_log_bytes
+
+
+def make_log(n):
+  msgs = []
+  for i in range(n):
+    msg = capnp_log.Event.new_message()
+    # slightly out of order, like real logs
+    msg.logMonoTime = i * 10000000 + (5000000 if i % 10 == 3 else 0)
+    if i % 2 == 0:
+      msg.init('can', 1)
+      msg.can[0].address = i
+      msg.can[0].dat = bytes(i % 256 for _ in range(8))
+    else:
+      msg.init('carState')
+      msg.carState.vEgo = float(i)
+    msgs.append(msg.to_bytes())
+  return b"".join(msgs)
+
+
+class TestLogReader(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.cache_dir = tools.lib.cache.DEFAULT_CACHE_DIR
+    tools.lib.cache.DEFAULT_CACHE_DIR = os.path.join(self.tmp, "cache")
+    self.dat = make_log(1000)
+    self.fn = os.path.join(self.tmp, "rlog.bz2")
+    with open(self.fn, "wb") as f:
+      # two concatenated bz2 streams, like appended logs
+      half = len(self.dat) // 2
+      f.write(bz2.compress(self.dat[:half]) + bz2.compress(self.dat[half:]))
+
+  def tearDown(self):
+    tools.lib.cache.DEFAULT_CACHE_DIR = self.cache_dir
+    shutil.rmtree(self.tmp)
+
+  def test_stream_matches_list(self):
+    expected = [m.as_builder().to_bytes() for m in LogReader(self.fn)]
+    self.assertEqual(len(expected), 1000)
+
+    lr = LogReader(self.fn, stream=True)
+    self.assertFalse(hasattr(lr, "_ents"))
+    for _ in range(2):
+      streamed = [m.as_builder().to_bytes() for m in lr]
+      self.assertEqual(streamed, expected)
+
+  def test_stream_small_chunks(self):
+    times = []
+    for dat in stream_log_bytes(self.fn, chunk_size=7):
+      times += [m.logMonoTime for m in capnp_log.Event.read_multiple_bytes(dat)]
+    self.assertEqual(times, [m.logMonoTime for m in LogReader(self.fn)])
+
+  def test_services(self):
+    for stream in (False, True):
+      lr = LogReader(self.fn, stream=stream, services={'carState'})
+      msgs = list(lr)
+      self.assertEqual(len(msgs), 500)
+      self.assertTrue(all(m.which() == 'carState' for m in msgs))
+      self.assertEqual([m.carState.vEgo for m in msgs], [float(i) for i in range(1, 1000, 2)])
+
+    with self.assertRaises(Exception):
+      LogReader(self.fn, services={'notAService'})
+
+  def test_index(self):
+    lr = LogReader(self.fn)
+    index = get_log_index(self.fn)
+    self.assertEqual(list(index.mono_times), lr._ts)
+    self.assertEqual(list(get_log_index(self.fn).mono_times), lr._ts)
+
+    def linear_seek(ts, mono_times):
+      return next((i for i, t in enumerate(mono_times) if t >= ts), len(mono_times))
+
+    for ts in (0, 1, 30000000, 33000000, 35000000, 5e9, 1e12):
+      self.assertEqual(index.seek(ts), linear_seek(ts, lr._ts))
+
+    can_ts = [m.logMonoTime for m in LogReader(self.fn, services={'can'})]
+    self.assertEqual(list(index.select({'can'}).mono_times), can_ts)
+
+  def test_multilog_seek(self):
+    lr = MultiLogIterator([self.fn], wraparound=False)
+    self.assertTrue(lr.seek(3.2))
+    self.assertGreaterEqual(lr.tell(), 3.2)
+    self.assertEqual(next(lr).logMonoTime, 3.2e9)
+
+  def test_multilog_iterate(self):
+    fns = [self.fn, None, self.fn]
+    expected = [m.as_builder().to_bytes() for m in LogReader(self.fn)]
+    lr = MultiLogIterator(fns, wraparound=True)
+    self.assertEqual([next(lr).as_builder().to_bytes() for _ in range(2500)], expected * 2 + expected[:500])
+
+    # reading continues from a seek into the next segment
+    lr = MultiLogIterator(fns, wraparound=False, services={'carState'})
+    self.assertTrue(lr.seek(5.))
+    vEgo = [next(lr).carState.vEgo for _ in range(300)]
+    self.assertEqual(vEgo, [float(i) for i in list(range(501, 1000, 2)) + list(range(1, 100, 2))])
+
+  def test_multilog_seek_offset(self):
+    # uncompressed logs are read from the seek offset, what comes before it isn't touched
+    fn = os.path.join(self.tmp, "rlog")
+    with open(fn, "wb") as f:
+      f.write(self.dat)
+    lr = MultiLogIterator([fn], wraparound=False)
+    with open(fn, "r+b") as f:
+      f.write(b"\xff" * (len(self.dat) // 2))
+
+    self.assertTrue(lr.seek(7.5))
+    expected = [m.logMonoTime for m in LogReader(self.fn) if m.logMonoTime >= 7.5e9][:200]
+    self.assertEqual([next(lr).logMonoTime for _ in range(200)], expected)
+
+  def test_route_reader(self):
+    fns = [self.fn, None, self.fn, self.fn]
+    expected = [m.logMonoTime for m in LogReader(self.fn)] * 3
+    self.assertEqual([m.logMonoTime for m in RouteLogReader(fns, workers=2, prefetch=1)], expected)
+
+    msgs = list(RouteLogReader(fns, services={'carState'}, workers=2))
+    self.assertEqual(len(msgs), 1500)
+    self.assertTrue(all(m.which() == 'carState' for m in msgs))
+
+  def test_stream_truncated(self):
+    fn = os.path.join(self.tmp, "rlog")
+    with open(fn, "wb") as f:
+      f.write(self.dat[:-10])
+    self.assertEqual(len(list(LogReader(fn, stream=True))), 999)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+from tools.lib.framereader import HEVC_NAL_SPS, PersistentDecoder, decompress_video_data, hevc_output_delay
+
+W, H = 320, 240
+GOP_SIZE = 20
+
+
+def nal_starts(dat):
+  starts = []
+  i = dat.find(b"\x00\x00\x01")
+  while i >= 0:
+    starts.append(i + 3)
+    i = dat.find(b"\x00\x00\x01", i + 3)
+  return starts
+
+
+def encode(fn, bframes):
+  subprocess.check_call(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", f"testsrc=size={W}x{H}:rate=20",
+                         "-frames:v", str(3 * GOP_SIZE), "-c:v", "libx265", "-x265-params",
+                         f"keyint={GOP_SIZE}:min-keyint={GOP_SIZE}:bframes={bframes}:open-gop=0:repeat-headers=1:log-level=error",
+                         "-f", "hevc", fn])
+  with open(fn, "rb") as f:
+    dat = f.read()
+
+  # every GOP starts with its own headers, the keyframe is everything up to the second slice
+  gops = []
+  starts = nal_starts(dat)
+  gop_starts = [s - 4 for s in starts if (dat[s] >> 1) & 0x3f == 32] + [len(dat)]
+  for b, e in zip(gop_starts, gop_starts[1:]):
+    slices = [s for s in starts if b < s < e and (dat[s] >> 1) & 0x3f < 32]
+    gops.append((dat[b:e], dat[b:slices[1] - 3]))
+  return gops
+
+
+@unittest.skipIf(shutil.which("ffmpeg") is None, "no ffmpeg")
+class TestPersistentDecoder(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.load = []
+
+  def tearDown(self):
+    for p in self.load:
+      p.kill()
+      p.wait()
+    shutil.rmtree(self.tmp)
+
+  def decode(self, bframes):
+    gops = encode(os.path.join(self.tmp, f"b{bframes}.hevc"), bframes)
+    # b-frames are reordered, so ffmpeg holds back more than the parser's access unit
+    self.assertEqual(hevc_output_delay(gops[0][1]) > 1, bframes > 0)
+
+    refs = [decompress_video_data(rawdat, "hevc", W, H, "yuv420p") for rawdat, _ in gops]
+    dec = PersistentDecoder("hevc", W, H, "yuv420p")
+    try:
+      for g in [2, 0, 1, 1, 2, 0]:
+        out = np.empty((GOP_SIZE - 5, W * H * 3 // 2), dtype=np.uint8)
+        dec.decode_into(gops[g][0], gops[g][1], GOP_SIZE, out, first=5)
+        np.testing.assert_array_equal(out, refs[g][5:])
+    finally:
+      dec.close()
+
+  def test_ip(self):
+    self.decode(0)
+
+  def test_bframes(self):
+    self.decode(3)
+
+  def test_under_load(self):
+    # a slow decoder only takes longer, no frames are skipped or repeated
+    self.load = [subprocess.Popen([sys.executable, "-c", "while True: pass"]) for _ in range(2 * (os.cpu_count() or 1))]
+    self.decode(3)
+
+  def test_no_sps(self):
+    self.assertEqual(hevc_output_delay(b"\x00\x00\x01" + bytes([HEVC_NAL_SPS << 1, 1])), 17)
+
+
+if __name__ == "__main__":
+  unittest.main()
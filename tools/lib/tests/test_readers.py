@@ -5,7 +5,7 @@ import tempfile
 
 from collections import defaultdict
 import numpy as np
-from tools.lib.framereader import FrameReader
+from tools.lib.framereader import FrameReader, YUV_FROM_RGB, rgb24toyuv420
 from tools.lib.logreader import LogReader
 
 
@@ -63,5 +63,18 @@ class TestReaders(unittest.TestCase):
     fr_url = FrameReader("https://github.com/commaai/comma2k19/blob/master/Example_1/b0c9d2329ad1606b%7C2018-08-02--08-34-47/40/video.hevc?raw=true")
     _check_data(fr_url)
 
+  def test_rgb24toyuv420(self):
+    rgb = np.random.default_rng(0).integers(0, 256, (874, 1164, 3), dtype=np.uint8)
+
+    img = np.dot(rgb.reshape(-1, 3), YUV_FROM_RGB.T).reshape(rgb.shape)
+    us = (img[::2, ::2, 1] + img[1::2, ::2, 1] + img[::2, 1::2, 1] + img[1::2, 1::2, 1]) / 4 + 128
+    vs = (img[::2, ::2, 2] + img[1::2, ::2, 2] + img[::2, 1::2, 2] + img[1::2, 1::2, 2]) / 4 + 128
+    expected = np.concatenate([img[:, :, 0].reshape(-1), us.reshape(-1), vs.reshape(-1)]).clip(0, 255).astype(np.uint8)
+
+    out = np.zeros(expected.shape, dtype=np.uint8)
+    self.assertIs(rgb24toyuv420(rgb, out), out)
+    # fixed point rounding is off by at most one
+    self.assertLessEqual(np.abs(out.astype(np.int32) - expected).max(), 1)
+
 if __name__ == "__main__":
   unittest.main()
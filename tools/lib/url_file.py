@@ -9,12 +9,15 @@ import pycurl
 from hashlib import sha256
 from io import BytesIO
 from tenacity import retry, wait_random_exponential, stop_after_attempt
+from tools.lib.cache import disk_cache
 from tools.lib.file_helpers import mkdirs_exists_ok, atomic_write_in_dir
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
 
 CACHE_DIR = os.environ.get("COMMA_CACHE", "/tmp/comma_download_cache/")
+#  Number of chunks fetched concurrently when filling the cache
+MAX_CONNECTIONS = int(os.environ.get("URLFILE_MAX_CONNECTIONS", "8"))
 
 
 def hash_256(link):
@@ -25,8 +28,9 @@ def hash_256(link):
 class URLFile(object):
   _tlocal = threading.local()
 
-  def __init__(self, url, debug=False, cache=None):
+  def __init__(self, url, debug=False, cache=None, max_connections=MAX_CONNECTIONS):
     self._url = url
+    self._max_connections = max(1, max_connections)
     self._pos = 0
     self._length = None
     self._local_file = None
@@ -69,18 +73,26 @@ class URLFile(object):
     if self._length is not None:
       return self._length
     file_length_path = os.path.join(CACHE_DIR, hash_256(self._url) + "_length")
-    if os.path.exists(file_length_path) and not self._force_download:
-      with open(file_length_path, "r") as file_length:
-          content = file_length.read()
-          self._length = int(content)
+    if not self._force_download and disk_cache(CACHE_DIR).contains(file_length_path):
+      try:
+        with open(file_length_path, "r") as file_length:
+          self._length = int(file_length.read())
           return self._length
+      except FileNotFoundError:
+        # evicted in the meantime
+        pass
 
     self._length = self.get_length_online()
     if not self._force_download:
       with atomic_write_in_dir(file_length_path, mode="w") as file_length:
         file_length.write(str(self._length))
+      disk_cache(CACHE_DIR).add(file_length_path)
     return self._length
 
+  def _chunk_path(self, position):
+    # chunk numbers are floats, keep that so existing caches stay valid
+    return os.path.join(CACHE_DIR, hash_256(self._url) + "_" + str(position / CHUNK_SIZE))
+
   def read(self, ll=None):
     if self._force_download:
       return self.read_aux(ll=ll)
@@ -88,29 +100,103 @@ class URLFile(object):
     file_begin = self._pos
     file_end = self._pos + ll if ll is not None else self.get_length()
     #  We have to allign with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(CACHE_DIR, str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb") as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
-
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
-
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    positions = range((file_begin // CHUNK_SIZE) * CHUNK_SIZE, max(file_end, file_begin + 1), CHUNK_SIZE)
+
+    #  Fetch all chunks we don't have at once, they are written to the cache as they arrive
+    downloaded = {}
+    missing = [position for position in positions if not disk_cache(CACHE_DIR).contains(self._chunk_path(position))]
+    if missing:
+      self._download_chunks(missing, downloaded)
+
+    response = bytearray(max(file_end - file_begin, 0))
+    offset = 0
+    for position in positions:
+      data = downloaded.get(position)
+      if data is None:
+        try:
+          with open(self._chunk_path(position), "rb") as cached_file:
+            data = cached_file.read()
+        except FileNotFoundError:
+          #  Evicted by another process since we checked
+          self._download_chunks([position], downloaded)
+          data = downloaded[position]
+
+      piece = memoryview(data)[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
+      response[offset:offset + len(piece)] = piece
+      offset += len(piece)
+
+    self._pos = file_end
+    del response[offset:]
+    return bytes(response)
+
+  def _curl_pool(self, n):
+    #  Keep-alive handles are reused across files, like the single handle
+    try:
+      pool = self._tlocal.curl_pool
+    except AttributeError:
+      pool = self._tlocal.curl_pool = []
+    while len(pool) < n:
+      pool.append(pycurl.Curl())
+    return pool[:n]
+
+  @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
+  def _download_chunks(self, positions, downloaded):
+    """Downloads the chunks starting at positions concurrently over up to
+       max_connections handles, storing them in downloaded and in the cache.
+       Chunks in downloaded already are skipped, so retries resume."""
+    queue = [position for position in positions if position not in downloaded]
+    handles = self._curl_pool(min(self._max_connections, len(queue)))
+    multi = pycurl.CurlMulti()
+    active = {}
+
+    if self._debug:
+      print("downloading", self._url, "chunks", [position // CHUNK_SIZE for position in queue])
+
+    try:
+      free = list(handles)
+      while queue or active:
+        while queue and free:
+          position = queue.pop(0)
+          headers = ["Connection: keep-alive", f"Range: bytes={position}-{position + CHUNK_SIZE - 1}"]
+          dats = BytesIO()
+          c = free.pop()
+          c.reset()
+          c.setopt(pycurl.URL, self._url)
+          c.setopt(pycurl.WRITEDATA, dats)
+          c.setopt(pycurl.NOSIGNAL, 1)
+          c.setopt(pycurl.TIMEOUT_MS, 500000)
+          c.setopt(pycurl.HTTPHEADER, headers)
+          c.setopt(pycurl.FOLLOWLOCATION, True)
+          multi.add_handle(c)
+          active[c] = (position, headers, dats)
+
+        multi.select(1.0)
+        while multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+          pass
+
+        _, ok_list, err_list = multi.info_read()
+        for c, errno, errmsg in err_list:
+          _, headers, _ = active[c]
+          raise Exception(f"Error, download failed {errno} {errmsg} {headers} ({self._url})")
+
+        for c in ok_list:
+          position, headers, dats = active.pop(c)
+          multi.remove_handle(c)
+          free.append(c)
+
+          response_code = c.getinfo(pycurl.RESPONSE_CODE)
+          if response_code != 206:  # Partial Content
+            raise Exception(f"Error, requested range but got unexpected response {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
+
+          data = dats.getvalue()
+          with atomic_write_in_dir(self._chunk_path(position), mode="wb") as new_cached_file:
+            new_cached_file.write(data)
+          disk_cache(CACHE_DIR).add(self._chunk_path(position))
+          downloaded[position] = data
+    finally:
+      for c in active:
+        multi.remove_handle(c)
+      multi.close()
 
   @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
   def read_aux(self, ll=None):